@@ -1,16 +1,16 @@
 import logging
-import aiohttp
 import traceback
 from typing import Dict, Any
 
-# Настройка логирования
-logging.basicConfig(level=logging.DEBUG)
+# Логирование настраивается в main.py; здесь только уровни
 log = logging.getLogger("api")
 # Включаем подробное логирование для aiohttp
 logging.getLogger("aiohttp").setLevel(logging.DEBUG)
 
 async def update_api_host(host: str, api_domain: str, api_token: str, vpn_config: Dict[str, Any]) -> bool:
     """Обновление host в API"""
+    import aiohttp
+
     url = f"{api_domain}/api/hosts"
     headers = {
         "Authorization": f"Bearer {api_token}",
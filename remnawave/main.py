@@ -1,20 +1,18 @@
 import asyncio
+import importlib.util
 import logging
-import socket
+import os
+import re
 import sys
 import time
-import json
-import psutil
-from asyncio.subprocess import PIPE
-from logging.handlers import TimedRotatingFileHandler
-from api import update_api_host
-import os
-try:
-    import aiohttp
-except ImportError:
-    print("Ошибка: модуль aiohttp не найден. Установите его: pip install aiohttp", file=sys.stderr)
-    sys.exit(1)
 
+STARTED_AT = time.perf_counter()
+
+# Общее ядро менеджеров: в репозитории лежит уровнем выше, в Docker-образе - рядом со скриптом
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tunnel_core import TunnelSupervisor, new_state, setup_logging
+from api import update_api_host
 from handlers import TelegramCommandHandler
 
 # --- НАСТРОЙКИ (РЕДАКТИРОВАТЬ ЗДЕСЬ) ---
@@ -24,6 +22,21 @@ ALLOWED_USER_ID = os.getenv("ALLOWED_USER_ID")
 API_TOKEN = os.getenv("API_TOKEN")
 API_DOMAIN = os.getenv("API_DOMAIN")
 HEALTH_CHECK_INTERVAL_SECONDS = int(os.getenv("HEALTH_CHECK_INTERVAL_SECONDS", "30"))
+# Перезапуск по телеметрии vk-tunnel (tunnel_core/telemetry.py); 0 - проверка выключена
+TELEMETRY_INTERVAL_SECONDS = float(os.getenv("TELEMETRY_INTERVAL_SECONDS", "30"))
+LEAK_WINDOW_SECONDS = float(os.getenv("LEAK_WINDOW_SECONDS", "3600"))
+LEAK_RSS_MB_PER_HOUR = float(os.getenv("LEAK_RSS_MB_PER_HOUR", "50"))
+LEAK_FDS_PER_HOUR = float(os.getenv("LEAK_FDS_PER_HOUR", "200"))
+SPIN_CPU_PERCENT = float(os.getenv("SPIN_CPU_PERCENT", "95"))
+SPIN_SECONDS = float(os.getenv("SPIN_SECONDS", "600"))
+# Флот (tunnel_core/fleet.py): один бот на много серверов
+FLEET_LISTEN = os.getenv("FLEET_LISTEN", "")              # Координатор: "0.0.0.0:8790"
+FLEET_COORDINATOR = os.getenv("FLEET_COORDINATOR", "")    # Узел: "<IP координатора>:8790"
+FLEET_SECRET = os.getenv("FLEET_SECRET", "")
+FLEET_NODE_NAME = os.getenv("FLEET_NODE_NAME", "")
+FLEET_TIMEOUT_SECONDS = float(os.getenv("FLEET_TIMEOUT_SECONDS", "10"))
+FLEET_RESTART_TIMEOUT_SECONDS = float(os.getenv("FLEET_RESTART_TIMEOUT_SECONDS", "300"))
+FLEET_MAX_DOWN = int(os.getenv("FLEET_MAX_DOWN", "1"))
 TUNNEL_HOST = "127.0.0.1"
 TUNNEL_PORT = int(os.getenv("TUNNEL_PORT", "10001"))
 
@@ -59,349 +72,137 @@ VPN_CONFIG = {
 }
 # ----------------------------------------------------
 
-# Проверка конфигурации при старте
-# Проверка конфигурации при старте
-if not all([BOT_TOKEN, CHAT_ID, os.getenv("ALLOWED_USER_ID")]):
-    print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
-    print("Пожалуйста, заполните переменные BOT_TOKEN, CHAT_ID и ALLOWED_USER_ID в .env файле.", file=sys.stderr)
-    sys.exit(1)
-
-# Преобразуем ALLOWED_USER_ID в int после проверки
-try:
-    ALLOWED_USER_ID = int(os.getenv("ALLOWED_USER_ID"))
-except (ValueError, TypeError):
-    print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
-    print("ALLOWED_USER_ID должен быть числом.", file=sys.stderr)
-    sys.exit(1)
-
-if not all([API_TOKEN, VPN_CONFIG["uuid"], VPN_CONFIG["inbound"]["configProfileUuid"], VPN_CONFIG["inbound"]["configProfileInboundUuid"]]):
-    print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
-    print("Пожалуйста, заполните API_TOKEN и параметры VPN_CONFIG.", file=sys.stderr)
-    sys.exit(1)
-# --- КОНФИГУРАЦИЯ ЛОГОВ С АВТОМАТИЧЕСКОЙ РОТАЦИЕЙ ---
-log_formatter = logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s")
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(log_formatter)
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO)
-root_logger.addHandler(console_handler)
-
 log = logging.getLogger("manager")
-log_vktunnel = logging.getLogger("vk-tunnel")
-log_telegram = logging.getLogger("telegram")
-
-# --- ГЛОБАЛЬНОЕ СОСТОЯНИЕ ---
-STATE = {
-    'notification_sent': False,
-    'process_start_time': None,
-    'last_output_time': None,
-    'process_pid': None,
-    'last_health_check_time': None,
-    'current_wss_url': None,
-    'current_host': None,
-    'consecutive_failures': 0,
-    'total_crashes': 0, 
-    'is_stopped': False,
-    'auth_url': None,          
-    'waiting_for_auth': False,  
-    'vk_process': None
-}
-
-def get_server_info():
-    try:
-        hostname = socket.getfqdn()
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.connect(("8.8.8.8", 80))
-            ip_address = s.getsockname()[0]
-        return ip_address, hostname
-    except Exception:
-        return "127.0.0.1", "localhost"
 
-SERVER_IP, SERVER_HOSTNAME = get_server_info()
 
-# Создаем обработчик команд
-telegram_handler = TelegramCommandHandler(BOT_TOKEN, ALLOWED_USER_ID, STATE)
+class RemnawaveSupervisor(TunnelSupervisor):
+    """vk-tunnel для Remnawave: авторизация VK через бота и обновление host в панели"""
+    health_check_interval = HEALTH_CHECK_INTERVAL_SECONDS
+    health_check_start_delay = 20
+    health_failures_before_restart = 3
+    max_crashes = 5
+    restart_pause = 10
+    stdin_pipe = True
+    telemetry_interval = TELEMETRY_INTERVAL_SECONDS
 
-async def send_telegram_message(text: str, chat_id=None):
-    """Отправка сообщения в Telegram"""
-    target_chat_id = chat_id or CHAT_ID
-    await telegram_handler.send_message(text, target_chat_id)
+    async def probe_health(self) -> bool:
+        """Проверка здоровья туннеля через HTTP запрос"""
+        import aiohttp
 
-
-
-async def monitor_stream(stream: asyncio.StreamReader, stream_name: str = "unknown"):
-    """Мониторинг вывода процесса"""
-    while True:
-        try:
-            line_bytes = await stream.readline()
-            if not line_bytes:
-                log.warning(f"Поток {stream_name} процесса был закрыт.")
-                break
-
-            STATE['last_output_time'] = time.time()
-            line = line_bytes.decode('utf-8', errors='ignore').strip()
-            
-            # Логируем все строки для отладки
-            log_vktunnel.info(f"[{stream_name}] {line}")
-
-            # Ищем ссылку авторизации VK в любом потоке
-            if "oauth.vk.ru" in line or "Please open the following link" in line:
-                log.info(f"Обнаружена строка авторизации в {stream_name}: {line}")
-                
-                # Если это строка с URL
-                if "https://oauth.vk.ru" in line:
-                    import re
-                    url_match = re.search(r'https://oauth\.vk\.ru/[^\s]*', line)
-                    if url_match:
-                        auth_url = url_match.group(0)
-                        STATE['auth_url'] = auth_url
-                        STATE['waiting_for_auth'] = True
-                        
-                        message = (f"🔐 *Требуется авторизация VK*\n\n"
-                                  f"Откройте ссылку в браузере:\n"
-                                  f"`{auth_url}`\n\n"
-                                  f"После авторизации нажмите /accept")
-                        
-                        await send_telegram_message(message)
-                        log.info(f"Отправлена ссылка авторизации VK: {auth_url}")
-                # Если это просто упоминание о ссылке, ждем следующую строку
-                elif "Please open the following link" in line:
-                    STATE['waiting_for_auth'] = True
-                    log.info("Ожидаем ссылку авторизации в следующих строках...")
-                continue
-
-            # Проверяем на WSS URL для успешного подключения
-            if not STATE['notification_sent'] and line.startswith("wss:"):
-                try:
-                    wss_url = line.split(maxsplit=1)[1] if len(line.split()) > 1 else line
-                    STATE['current_wss_url'] = wss_url
-                    STATE['waiting_for_auth'] = False
-                    
-                    # Извлекаем host из WSS URL
-                    import re
-                    match = re.search(r'wss://([^/]+)', wss_url)
-                    if match:
-                        host = match.group(1)
-                        STATE['current_host'] = host
-                        
-                        # Обновляем API
-                        from api import update_api_host
-                        api_updated = await update_api_host(host, API_DOMAIN, API_TOKEN, VPN_CONFIG)
-                        
-                        log.info(f"Обнаружен WSS адрес: {wss_url}. Host: {host}")
-                        
-                        message = (f"✅ *VK Tunnel запущен*\n\n"
-                                   f"🖥️ *Сервер:* `{SERVER_HOSTNAME}`\n"
-                                   f"🌐 *IP:* `{SERVER_IP}`\n"
-                                   f"🔗 *Host:* `{host}`\n\n")
-                        
-                        if api_updated:
-                            message += "✅ *API обновлен успешно*\n\n"
-                        else:
-                            message += "❌ *Ошибка обновления API*\n\n"
-                        
-                        message += "📱 *Обновите подписку в вашем VPN клиенте*"
-                        
-                        await send_telegram_message(message)
-                        STATE['notification_sent'] = True
-                        STATE['consecutive_failures'] = 0
-                except Exception as e:
-                    log.error(f"Ошибка при обработке WSS URL: {e}")
-                    
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            log.error(f"Ошибка в monitor_stream ({stream_name}): {e}")
-
-async def check_tunnel_health():
-    """Проверка здоровья туннеля через HTTP запрос"""
-    log.info(f"Проверка здоровья туннеля запущена. Интервал: {HEALTH_CHECK_INTERVAL_SECONDS}с.")
-    await asyncio.sleep(20)  # Даем время на запуск
-
-    while True:
         try:
-            # Пробуем сделать HTTP запрос к туннелю
-            url = f"http://{TUNNEL_HOST}:{TUNNEL_PORT}"
+            url = f"http://{self.tunnel_host}:{self.tunnel_port}"
             async with aiohttp.ClientSession() as session:
                 async with session.get(url, timeout=5) as response:
                     # Любой ответ означает, что туннель работает
-                    STATE['last_health_check_time'] = time.time()
-                    STATE['consecutive_failures'] = 0
                     log.info(f"Health check: туннель отвечает (статус: {response.status})")
-
+                    return True
         except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            STATE['consecutive_failures'] += 1
-            log.warning(f"Health check failed ({STATE['consecutive_failures']}): {type(e).__name__}")
-            
-            # Если 3 неудачные проверки подряд - перезапускаем
-            if STATE['consecutive_failures'] >= 3:
-                log.error("Туннель не отвечает после 3 проверок. Инициирую перезапуск.")
-                await send_telegram_message("⚠️ *Туннель не отвечает*\n\nИнициирую перезапуск...")
-                telegram_handler.manual_restart_event.set()
-                break
-                
-        except asyncio.CancelledError:
-            log.info("Проверка здоровья остановлена.")
-            break
-        except Exception as e:
-            log.error(f"Неизвестная ошибка при проверке здоровья: {e}")
-
-        await asyncio.sleep(HEALTH_CHECK_INTERVAL_SECONDS)
-
-async def manage_vk_tunnel_lifecycle():
-    """Основной цикл управления жизненным циклом vk-tunnel"""
-    while True:
-        # Проверяем, остановлен ли процесс
-        if STATE['is_stopped']:
-            await asyncio.sleep(5)
-            continue
-            
-        # Проверяем количество падений (увеличим лимит до 5 для большей устойчивости)
-        if STATE['total_crashes'] >= 5:
-            await send_telegram_message(
-                "❌ *Туннель упал 5 раз*\n\n"
-                "Автоматический перезапуск отключен.\n"
-                "Используйте /start для запуска вручную."
-            )
-            STATE['is_stopped'] = True
-            continue
-            
-        log.info("Запуск нового цикла vk-tunnel.")
-        STATE.update({
-            'notification_sent': False,
-            'process_start_time': time.time(),
-            'last_output_time': time.time(),
-            'process_pid': None,
-            'last_health_check_time': time.time(),
-            'current_wss_url': None,
-            'current_host': None,
-            'consecutive_failures': 0
-        })
-        telegram_handler.manual_restart_event.clear()
+            log.warning(f"Health check: {type(e).__name__}")
+            return False
+
+    async def on_output_line(self, line: str, stream_name: str):
+        # Ищем ссылку авторизации VK в любом потоке
+        if "oauth.vk.ru" in line or "Please open the following link" in line:
+            log.info(f"Обнаружена строка авторизации в {stream_name}: {line}")
+
+            # Если это строка с URL
+            if "https://oauth.vk.ru" in line:
+                url_match = re.search(r'https://oauth\.vk\.ru/[^\s]*', line)
+                if url_match:
+                    auth_url = url_match.group(0)
+                    self.state['auth_url'] = auth_url
+                    self.state['waiting_for_auth'] = True
+
+                    message = (f"🔐 *Требуется авторизация VK*\n\n"
+                               f"Откройте ссылку в браузере:\n"
+                               f"`{auth_url}`\n\n"
+                               f"После авторизации нажмите /accept")
+
+                    await self.send_message(message)
+                    log.info(f"Отправлена ссылка авторизации VK: {auth_url}")
+            # Если это просто упоминание о ссылке, ждем следующую строку
+            elif "Please open the following link" in line:
+                self.state['waiting_for_auth'] = True
+                log.info("Ожидаем ссылку авторизации в следующих строках...")
+            return
+
+        await super().on_output_line(line, stream_name)
+
+    async def on_wss_url(self, wss_url: str, host):
+        if not host:
+            return
+
+        # Обновляем API
+        api_updated = await update_api_host(host, API_DOMAIN, API_TOKEN, VPN_CONFIG)
+        log.info(f"Обнаружен WSS адрес: {wss_url}. Host: {host}")
+
+        server_ip, server_hostname = await self.server_info()
+        message = (f"✅ *VK Tunnel запущен*\n\n"
+                   f"🖥️ *Сервер:* `{server_hostname}`\n"
+                   f"🌐 *IP:* `{server_ip}`\n"
+                   f"🔗 *Host:* `{host}`\n\n")
+
+        if api_updated:
+            message += "✅ *API обновлен успешно*\n\n"
+        else:
+            message += "❌ *Ошибка обновления API*\n\n"
+
+        message += "📱 *Обновите подписку в вашем VPN клиенте*"
+
+        await self.send_message(message)
+
+
+def check_config() -> int:
+    """Проверка конфигурации при старте; возвращает ALLOWED_USER_ID числом"""
+    if importlib.util.find_spec("aiohttp") is None:
+        print("Ошибка: модуль aiohttp не найден. Установите его: pip install aiohttp", file=sys.stderr)
+        sys.exit(1)
+
+    if not all([BOT_TOKEN, CHAT_ID, ALLOWED_USER_ID]):
+        print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
+        print("Пожалуйста, заполните переменные BOT_TOKEN, CHAT_ID и ALLOWED_USER_ID в .env файле.", file=sys.stderr)
+        sys.exit(1)
+
+    # Преобразуем ALLOWED_USER_ID в int после проверки
+    try:
+        allowed_user_id = int(ALLOWED_USER_ID)
+    except (ValueError, TypeError):
+        print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
+        print("ALLOWED_USER_ID должен быть числом.", file=sys.stderr)
+        sys.exit(1)
+
+    if (FLEET_LISTEN or FLEET_COORDINATOR) and not FLEET_SECRET:
+        print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
+        print("Для флота (FLEET_LISTEN/FLEET_COORDINATOR) задайте FLEET_SECRET.", file=sys.stderr)
+        sys.exit(1)
+
+    if not all([API_TOKEN, VPN_CONFIG["uuid"], VPN_CONFIG["inbound"]["configProfileUuid"], VPN_CONFIG["inbound"]["configProfileInboundUuid"]]):
+        print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
+        print("Пожалуйста, заполните API_TOKEN и параметры VPN_CONFIG.", file=sys.stderr)
+        sys.exit(1)
+
+    return allowed_user_id
 
-        try:
-            process = await asyncio.create_subprocess_exec(
-                *VK_TUNNEL_COMMAND,
-                stdout=PIPE,
-                stderr=PIPE,
-                stdin=PIPE
-            )
-            STATE['process_pid'] = process.pid
-            STATE['vk_process'] = process
-            log.info(f"Процесс vk-tunnel запущен с PID: {process.pid}")
-        except FileNotFoundError:
-            log.critical("Команда 'vk-tunnel' не найдена! Повтор через 30с...")
-            await asyncio.sleep(30)
-            continue
-        except Exception as e:
-            log.critical(f"Не удалось запустить процесс vk-tunnel: {e}. Повтор через 30с...")
-            await asyncio.sleep(30)
-            continue
-
-        # Создаем задачи мониторинга
-        monitor_stdout_task = asyncio.create_task(monitor_stream(process.stdout, "stdout"))
-        monitor_stderr_task = asyncio.create_task(monitor_stream(process.stderr, "stderr"))
-        health_check_task = asyncio.create_task(check_tunnel_health())
-
-        # Создаем задачи ожидания событий (ЭТО ИСПРАВЛЕНИЕ: задачи определяются здесь, перед asyncio.wait)
-        wait_process_task = asyncio.create_task(process.wait())
-        wait_command_task = asyncio.create_task(telegram_handler.manual_restart_event.wait())
-        wait_start_task = asyncio.create_task(telegram_handler.start_event.wait())
-
-        # Ждем первое событие
-        done, pending = await asyncio.wait(
-            [wait_process_task, wait_command_task, wait_start_task, health_check_task],
-            return_when=asyncio.FIRST_COMPLETED
-        )
-
-        # Определяем причину остановки
-        reason = "неизвестная причина"
-        if wait_process_task in done:
-            STATE['total_crashes'] += 1
-            reason = f"процесс завершился сам с кодом {process.returncode} (падение {STATE['total_crashes']}/5)"
-            await send_telegram_message(f"⚠️ *Туннель упал*\n\nПричина: {reason}\nПерезапускаю...")
-        elif wait_command_task in done:
-            reason = "получена команда перезапуска"
-            STATE['total_crashes'] = 0  # Сбрасываем счетчик при ручном перезапуске
-        elif wait_start_task in done:
-            reason = "получена команда запуска"
-            STATE['total_crashes'] = 0  # Сбрасываем счетчик при ручном запуске
-        elif health_check_task in done:
-            STATE['total_crashes'] += 1
-            reason = f"health check обнаружил проблему (падение {STATE['total_crashes']}/5)"
-
-        log.warning(f"Инициирован перезапуск vk-tunnel (PID: {process.pid}). Причина: {reason}.")
-
-        # Отменяем все незавершенные задачи
-        for task in pending:
-            task.cancel()
-
-        monitor_stdout_task.cancel()
-        monitor_stderr_task.cancel()
-        health_check_task.cancel()
-
-        await asyncio.gather(
-            monitor_stdout_task,
-            monitor_stderr_task,
-            health_check_task,
-            return_exceptions=True
-        )
-
-        # Улучшенный раздел убийства процесса
-        if process.returncode is None:
-            log.warning(f"Пытаюсь убить процесс {process.pid}...")
-            try:
-                # Сначала SIGTERM
-                process.terminate()
-                await asyncio.wait_for(process.wait(), timeout=5)
-                log.info(f"Процесс {process.pid} успешно завершен (SIGTERM).")
-            except asyncio.TimeoutError:
-                log.warning(f"Процесс {process.pid} не ответил на SIGTERM. Пытаюсь SIGKILL...")
-                process.kill()
-                await asyncio.wait_for(process.wait(), timeout=5)
-                log.info(f"Процесс {process.pid} успешно убит (SIGKILL).")
-            except Exception as e:
-                log.error(f"Ошибка при убийстве процесса {process.pid}: {e}. Принудительное убийство через psutil...")
-                # Fallback через psutil для надёжности
-                try:
-                    p = psutil.Process(process.pid)
-                    p.terminate()
-                    p.wait(timeout=5)
-                except (psutil.NoSuchProcess, psutil.TimeoutExpired):
-                    log.info(f"Процесс {process.pid} уже не существует.")
-                except Exception as kill_e:
-                    log.critical(f"Не удалось убить процесс {process.pid}: {kill_e}. Возможно, требуется ручное вмешательство.")
-
-            # Дополнительная проверка: убедимся, что PID мёртв
-            await asyncio.sleep(2)  # Задержка для ОС
-            if psutil.pid_exists(process.pid):
-                log.error(f"Процесс {process.pid} всё ещё жив! Принудительное убийство через psutil...")
-                try:
-                    p = psutil.Process(process.pid)
-                    p.kill()  # Эквивалент SIGKILL
-                    p.wait(timeout=5)  # Ждём завершения
-                    log.info(f"Процесс {process.pid} успешно убит через psutil.")
-                except psutil.NoSuchProcess:
-                    log.info(f"Процесс {process.pid} уже не существует.")
-                except psutil.TimeoutExpired:
-                    log.warning(f"Таймаут при ожидании завершения {process.pid}.")
-                except Exception as e:
-                    log.error(f"Ошибка при убийстве через psutil: {e}")
-
-        log.info("Пауза 10 секунд перед перезапуском...")
-        await asyncio.sleep(10)
 
 async def main():
     """Главная функция"""
+    allowed_user_id = check_config()
+    setup_logging()
     log.info("Запуск менеджера vk-tunnel с управлением через Telegram.")
-    log.info(f"Конфигурация: BOT_TOKEN={'*' * 10}, CHAT_ID={CHAT_ID}, ALLOWED_USER_ID={ALLOWED_USER_ID}")
+    log.info(f"Конфигурация: BOT_TOKEN={'*' * 10}, CHAT_ID={CHAT_ID}, ALLOWED_USER_ID={allowed_user_id}")
     log.info(f"API: {API_DOMAIN}")
 
-    # Запускаем обе задачи параллельно
-    await asyncio.gather(
-        manage_vk_tunnel_lifecycle(),
-        telegram_handler.listen_for_commands()
-    )
+    telegram_handler = TelegramCommandHandler(BOT_TOKEN, allowed_user_id, new_state())
+    supervisor = RemnawaveSupervisor(telegram_handler, CHAT_ID, TUNNEL_HOST, TUNNEL_PORT,
+                                     VK_TUNNEL_COMMAND, started_at=STARTED_AT)
+    supervisor.restart_policy.configure(LEAK_WINDOW_SECONDS, LEAK_RSS_MB_PER_HOUR, LEAK_FDS_PER_HOUR,
+                                        SPIN_CPU_PERCENT, SPIN_SECONDS)
+    supervisor.configure_fleet(FLEET_LISTEN, FLEET_COORDINATOR, FLEET_SECRET, FLEET_NODE_NAME)
+    if supervisor.fleet_agent is not None:
+        supervisor.fleet_agent.timeout = FLEET_TIMEOUT_SECONDS
+        supervisor.fleet_agent.restart_timeout = FLEET_RESTART_TIMEOUT_SECONDS
+        supervisor.fleet_agent.max_down = FLEET_MAX_DOWN
+    await supervisor.run()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,158 @@
+# auth.py
+"""Пользователи SOCKS5-листенера клиента: логин/пароль (RFC 1929), лимит потоков и полосы.
+
+Пользователи задаются в client.users и меняются на лету (SIGHUP клиенту):
+    "users": {
+        "alice": {"password": "secret", "max_streams": 32, "rate_kbps": 4096},
+        "bob":   {"password_sha256": "<hex>", "rate_kbps": 1024},
+    }
+Пустой словарь - аутентификация выключена (как раньше). Счетчики и ведра токенов
+живут в UserState и переживают перечитывание конфигурации.
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+log = logging.getLogger("auth")
+
+METHOD_NO_AUTH = 0x00
+METHOD_USER_PASSWORD = 0x02
+METHOD_NO_ACCEPTABLE = 0xFF
+BURST_SECONDS = 1.0   # Ведро вмещает секунду трафика на полной скорости
+
+
+@dataclass(frozen=True)
+class UserPolicy:
+    password: str = ""
+    password_sha256: str = ""
+    max_streams: int = 0      # 0 - без ограничения
+    rate_kbps: float = 0      # На каждое направление; 0 - без ограничения
+
+    def check_password(self, password: str) -> bool:
+        if self.password_sha256:
+            digest = hashlib.sha256(password.encode("utf-8")).hexdigest()
+            return hmac.compare_digest(digest, self.password_sha256.lower())
+        return bool(self.password) and hmac.compare_digest(password.encode("utf-8"), self.password.encode("utf-8"))
+
+
+class TokenBucket:
+    """Ведро токенов с долгом: take() не блокирует, а возвращает, сколько подождать"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'total')
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.burst = rate * BURST_SECONDS
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.total = 0
+
+    def set_rate(self, rate: float):
+        self.rate = rate
+        self.burst = rate * BURST_SECONDS
+        self.tokens = min(self.tokens, self.burst)
+
+    def take(self, amount: int) -> float:
+        self.total += amount
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class UserState:
+    __slots__ = ('name', 'policy', 'active', 'upload', 'download')
+
+    def __init__(self, name: str, policy: UserPolicy):
+        self.name = name
+        self.policy = policy
+        self.active = 0
+        rate = policy.rate_kbps * 1024
+        self.upload = TokenBucket(rate)
+        self.download = TokenBucket(rate)
+
+    def update(self, policy: UserPolicy):
+        self.policy = policy
+        rate = policy.rate_kbps * 1024
+        self.upload.set_rate(rate)
+        self.download.set_rate(rate)
+
+
+class UserRegistry:
+    def __init__(self):
+        self.users: Dict[str, UserState] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.users)
+
+    def configure(self, raw: Dict[str, dict]):
+        """Применить client.users; состояние существующих пользователей сохраняется"""
+        policies = {}
+        for name, options in raw.items():
+            try:
+                policies[name] = UserPolicy(**options)
+            except TypeError as e:
+                raise ValueError(f"client.users.{name}: {e}") from e
+        for name, policy in policies.items():
+            if name in self.users:
+                self.users[name].update(policy)
+            else:
+                self.users[name] = UserState(name, policy)
+        for name in set(self.users) - set(policies):
+            del self.users[name]   # открытые потоки удаленного пользователя доживут сами
+
+    def authenticate(self, username: str, password: str) -> Optional[UserState]:
+        user = self.users.get(username)
+        if user is None or not user.policy.check_password(password):
+            return None
+        return user
+
+    def acquire(self, user: UserState) -> bool:
+        if user.policy.max_streams and user.active >= user.policy.max_streams:
+            return False
+        user.active += 1
+        return True
+
+    def release(self, user: UserState):
+        user.active -= 1
+
+    def summary(self) -> str:
+        return ", ".join(f"{u.name}: потоков {u.active}, ↑{u.upload.total // 1024} КБ ↓{u.download.total // 1024} КБ"
+                         for u in self.users.values())
+
+
+async def negotiate(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    registry: UserRegistry) -> Optional[UserState]:
+    """Выбор метода SOCKS5 и, если пользователи заданы, проверка логина/пароля.
+
+    Возвращает пользователя (None - аутентификация выключена); при отказе закрывает соединение
+    и выбрасывает PermissionError.
+    """
+    ver, nmethods = await reader.readexactly(2)
+    methods = await reader.readexactly(nmethods)
+    if not registry.enabled:
+        writer.write(bytes([0x05, METHOD_NO_AUTH])); await writer.drain()
+        return None
+
+    if METHOD_USER_PASSWORD not in methods:
+        writer.write(bytes([0x05, METHOD_NO_ACCEPTABLE])); await writer.drain()
+        raise PermissionError("клиент не предложил аутентификацию по паролю")
+    writer.write(bytes([0x05, METHOD_USER_PASSWORD])); await writer.drain()
+
+    # RFC 1929: VER(1) | ULEN(1) | UNAME | PLEN(1) | PASSWD
+    _, ulen = await reader.readexactly(2)
+    username = (await reader.readexactly(ulen)).decode("utf-8", "replace")
+    plen = (await reader.readexactly(1))[0]
+    password = (await reader.readexactly(plen)).decode("utf-8", "replace")
+
+    user = registry.authenticate(username, password)
+    writer.write(b"\x01\x00" if user else b"\x01\x01"); await writer.drain()
+    if user is None:
+        raise PermissionError(f"неверный логин или пароль для {username!r}")
+    return user
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# bench.py
+"""Замеры производительности клиента и шлюза.
+
+    python bench.py setup --wss wss://<host>/ [-n 50] [--cafile ca.pem]
+        Установка соединения со шлюзом: как раньше (новый SSL-контекст и полное
+        TLS-рукопожатие на каждое соединение) и через Endpoint (общий контекст,
+        возобновление TLS-сессии). Печатает задержку и CPU процесса на соединение.
+
+    python bench.py datapath [--mb 64] [--streams 1,32]
+        Передача данных на шлюзе: трубы server.py против data_path = "buffered" (fastpath.py).
+        Цель и клиенты WebSocket работают в дочернем процессе, так что CPU и память
+        этого процесса - только шлюз. Каждый поток передает свою долю --mb в обе стороны.
+        Печатает CPU мс на МБ, скорость, пик выделенной памяти (tracemalloc, отдельный
+        проход) и minor page faults на МБ. Нужен ключ шлюза в конфигурации, как для server.py.
+
+    python bench.py idle [--streams 20000] [--data-path streams,buffered]
+        Память молчащих соединений: запускает server.py и client.py, открывает через них
+        --streams соединений к локальной цели и печатает прирост RSS каждого процесса
+        на соединение. На каждое соединение нужно по 2 файловых дескриптора в этом
+        процессе, клиенте и шлюзе: лимит (ulimit -n) поднимается до жесткого, а число
+        соединений при необходимости урезается. Ключ шлюза - из конфигурации.
+
+    python bench.py crypto [--seconds 5] [--bulk 4] [--small 16] [--data-path streams,buffered]
+        Задержка мелких потоков рядом с большими кадрами на шлюзе (crypto_pool.py).
+        --bulk потоков шлют кадры по 4 МБ, --small потоков раз в 10 мс обмениваются
+        с эхо-целью короткими кадрами. Печатает задержку обмена (медиана, p99, максимум),
+        p99 опоздания цикла событий шлюза и скорость больших потоков: все кадры в цикле
+        событий и большие - в пуле потоков.
+        Клиенты и цели - в дочернем процессе, как в datapath.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import resource
+import ssl
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Awaitable, Callable, List, Tuple
+from urllib.parse import urlparse
+
+import websockets
+
+from crypto_aead_light import FrameCipher
+from crypto_pool import DEFAULT_OFFLOAD_BYTES, crypto
+from endpoint import Endpoint, create_client_context
+from protocol import decode_open, encode_open
+
+DATAPATH_PORT = 18700          # Шлюз замера; цель - следующий порт
+DATAPATH_CHUNK = 65536
+IDLE_PORT = 18710
+IDLE_BATCH = 200              # Соединений, открываемых одновременно
+IDLE_FDS_RESERVED = 128
+CRYPTO_PORT = 18720           # Шлюз замера; эхо-цель и приемник - следующие порты
+CRYPTO_BULK_FRAME = 2 ** 22 - 64   # Самый большой кадр, который пропустит max_size шлюза
+CRYPTO_SMALL_FRAME = 64
+CRYPTO_SMALL_INTERVAL = 0.01
+
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+def report(name: str, latencies: List[float], cpu: List[float], extra: str = ""):
+    print(f"{name:<28} задержка мс: медиана {statistics.median(latencies) * 1000:7.2f}, "
+          f"p90 {percentile(latencies, 0.9) * 1000:7.2f}; CPU мс: {statistics.mean(cpu) * 1000:6.2f}{extra}")
+
+
+async def measure(count: int, connect: Callable[[], Awaitable]) -> Tuple[List[float], List[float]]:
+    latencies, cpu = [], []
+    for _ in range(count):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        ws = await connect()
+        latencies.append(time.perf_counter() - started)
+        cpu.append(time.process_time() - cpu_started)
+        await ws.close()
+    return latencies, cpu
+
+
+async def bench_setup(args):
+    async def connect_uncached():
+        # Как было в client.py до Endpoint: все заново на каждое соединение
+        u = urlparse(args.wss)
+        context = ssl.create_default_context(cafile=args.cafile) if u.scheme == "wss" else None
+        return await websockets.connect(args.wss, ssl=context, compression=None, origin=f"https://{u.hostname}")
+
+    endpoint = Endpoint(args.wss, context=create_client_context(args.cafile))
+    await measure(1, connect_uncached)   # DNS и прогрев
+    report("без кэша", *await measure(args.count, connect_uncached))
+    report("Endpoint (кэш + resumption)", *await measure(args.count, endpoint.open),
+           f"; возобновлено {endpoint.resumed}/{endpoint.handshakes}")
+
+
+async def datapath_peer_streams(key_id: int, key: bytes, port: int, size: int, streams: int):
+    """Дочерний процесс: цель (отдает и принимает size байт) и клиенты WebSocket"""
+    cipher = FrameCipher(key_id, key)
+    payload = bytes(DATAPATH_CHUNK)
+
+    async def target(reader, writer):
+        async def sink():
+            left = size
+            while left > 0:
+                data = await reader.read(DATAPATH_CHUNK)
+                if not data:
+                    break
+                left -= len(data)
+        receiving = asyncio.create_task(sink())
+        for offset in range(0, size, DATAPATH_CHUNK):
+            writer.write(payload[:min(DATAPATH_CHUNK, size - offset)])
+            await writer.drain()
+        await receiving
+        writer.close()
+
+    async def stream():
+        async with websockets.connect(f"ws://127.0.0.1:{port}/", compression=None, max_size=None) as ws:
+            await ws.send(cipher.seal(encode_open("127.0.0.1", port + 1)))
+
+            async def upload():
+                for offset in range(0, size, DATAPATH_CHUNK):
+                    await ws.send(cipher.seal(payload[:min(DATAPATH_CHUNK, size - offset)]))
+
+            sending = asyncio.create_task(upload())
+            received = 0
+            async for msg in ws:
+                received += len(cipher.open(msg))
+            await sending
+            if received != size:
+                raise RuntimeError(f"получено {received} из {size} байт")
+
+    server = await asyncio.start_server(target, "127.0.0.1", port + 1)
+    for _ in range(100):   # Шлюз в родительском процессе мог еще не начать слушать
+        try:
+            (await asyncio.open_connection("127.0.0.1", port))[1].close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    await asyncio.gather(*(stream() for _ in range(streams)))
+    server.close()
+
+
+def datapath_peer(*args):
+    asyncio.run(datapath_peer_streams(*args))
+
+
+async def bench_datapath(args):
+    # Трубы и ключ берутся из server.py - замер того же кода, что работает на шлюзе
+    import server
+    from fastpath import TunnelConnection
+
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    cipher = server.keys.keyring.cipher()
+    read_size = server.get_settings().server.read_chunk_size
+    loop = asyncio.get_running_loop()
+    mode = "streams"
+
+    async def gateway(ws):
+        request = decode_open(cipher.open(await ws.recv()))
+        if mode == "buffered":
+            _, connection = await loop.create_connection(
+                lambda: TunnelConnection(ws, cipher, read_size), request.addr, request.port)
+            connection.start()
+            await connection.run(lambda e, failures: True)
+        else:
+            reader, writer = await asyncio.open_connection(request.addr, request.port)
+            await asyncio.gather(server.pipe_tcp_to_ws(reader, ws, cipher), server.pipe_ws_to_tcp(ws, writer, cipher))
+
+    async def run(streams: int, size: int) -> Tuple[float, float, int]:
+        context = multiprocessing.get_context("spawn")
+        peer = context.Process(target=datapath_peer, args=(cipher.key_id, cipher.key, args.port, size, streams))
+        before, started = resource.getrusage(resource.RUSAGE_SELF), time.perf_counter()
+        peer.start()
+        await loop.run_in_executor(None, peer.join)
+        elapsed, after = time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF)
+        if peer.exitcode:
+            raise SystemExit("замер не удался: ошибка в дочернем процессе")
+        cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+        return cpu, elapsed, after.ru_minflt - before.ru_minflt
+
+    async with websockets.serve(gateway, "127.0.0.1", args.port, compression=None, max_size=None):
+        await run(1, DATAPATH_CHUNK)   # Прогрев: импорты и первые буферы не в счет
+        for streams in (int(n) for n in args.streams.split(",")):
+            size = args.mb * 2 ** 20 // streams
+            megabytes = 2 * size * streams / 2 ** 20   # В обе стороны
+            for mode in ("streams", "buffered"):
+                cpu, elapsed, faults = await run(streams, size)
+                tracemalloc.start()
+                await run(streams, size)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print(f"{mode:<9} потоков {streams:>4}: CPU {cpu * 1000 / megabytes:6.2f} мс/МБ, "
+                      f"{megabytes / elapsed:7.1f} МБ/с, пик памяти {peak / 2 ** 20:6.1f} МБ, "
+                      f"page faults {faults / megabytes:6.1f}/МБ")
+
+
+async def crypto_peer_streams(key_id: int, key: bytes, port: int, seconds: float, bulk: int, small: int, results):
+    """Дочерний процесс: эхо-цель, приемник, клиенты больших и мелких потоков"""
+    cipher = FrameCipher(key_id, key)
+    frame = cipher.seal(bytes(CRYPTO_BULK_FRAME))   # Шлюзу все равно, что кадр повторяется
+    latencies: List[float] = []
+    received = 0
+    handlers = set()
+
+    async def echo(reader, writer):
+        handlers.add(asyncio.current_task())
+        while data := await reader.read(DATAPATH_CHUNK):
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    async def sink(reader, writer):
+        nonlocal received
+        handlers.add(asyncio.current_task())
+        while data := await reader.read(2 ** 20):
+            received += len(data)
+        writer.close()
+
+    async def bulk_stream(deadline: float):
+        async with websockets.connect(f"ws://127.0.0.1:{port}/", compression=None, max_size=None) as ws:
+            await ws.send(cipher.seal(encode_open("127.0.0.1", port + 2)))
+            while time.perf_counter() < deadline:
+                await ws.send(frame)
+
+    async def small_stream(deadline: float):
+        payload = bytes(CRYPTO_SMALL_FRAME)
+        async with websockets.connect(f"ws://127.0.0.1:{port}/", compression=None) as ws:
+            await ws.send(cipher.seal(encode_open("127.0.0.1", port + 1)))
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                await ws.send(cipher.seal(payload))
+                cipher.open(await ws.recv())
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(CRYPTO_SMALL_INTERVAL)
+
+    servers = [await asyncio.start_server(echo, "127.0.0.1", port + 1),
+               await asyncio.start_server(sink, "127.0.0.1", port + 2)]
+    for _ in range(100):
+        try:
+            (await asyncio.open_connection("127.0.0.1", port))[1].close()
+            break
+        except OSError:
+            await asyncio.sleep(0.05)
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(bulk_stream(deadline) for _ in range(bulk)),
+                         *(small_stream(deadline) for _ in range(small)))
+    await asyncio.wait(handlers, timeout=5)   # Шлюз закрывает сокеты к целям вслед за WebSocket
+    for server in servers:
+        server.close()
+    results.send((latencies, received))
+
+
+def crypto_peer(*args):
+    asyncio.run(crypto_peer_streams(*args))
+
+
+async def bench_crypto(args):
+    import server
+    from fastpath import TunnelConnection
+
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    cipher = server.keys.keyring.cipher()
+    read_size = server.get_settings().server.read_chunk_size
+    loop = asyncio.get_running_loop()
+    mode = "streams"
+
+    async def gateway(ws):
+        request = decode_open(cipher.open(await ws.recv()))
+        if mode == "buffered":
+            _, connection = await loop.create_connection(
+                lambda: TunnelConnection(ws, cipher, read_size), request.addr, request.port)
+            connection.start()
+            await connection.run(lambda e, failures: True)
+        else:
+            reader, writer = await asyncio.open_connection(request.addr, request.port)
+            await asyncio.gather(server.pipe_tcp_to_ws(reader, ws, cipher), server.pipe_ws_to_tcp(ws, writer, cipher))
+
+    async def lag(stalls: List[float]):
+        """Опоздание пробуждений цикла событий шлюза: сколько его держал чужой код"""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(CRYPTO_SMALL_INTERVAL)
+            stalls.append(time.perf_counter() - started - CRYPTO_SMALL_INTERVAL)
+
+    async def run(seconds: float) -> Tuple[List[float], int, List[float]]:
+        context = multiprocessing.get_context("spawn")
+        results, sender = context.Pipe(duplex=False)
+        peer = context.Process(target=crypto_peer,
+                               args=(cipher.key_id, cipher.key, args.port, seconds, args.bulk, args.small, sender))
+        stalls: List[float] = []
+        peer.start()
+        ticker = asyncio.create_task(lag(stalls))
+        await loop.run_in_executor(None, peer.join)
+        ticker.cancel()
+        if peer.exitcode:
+            raise SystemExit("замер не удался: ошибка в дочернем процессе")
+        return (*results.recv(), stalls)
+
+    print(f"CPU: {os.cpu_count()}; больших потоков {args.bulk} (кадры {CRYPTO_BULK_FRAME / 2 ** 20:.0f} МБ), "
+          f"мелких {args.small}")
+    async with websockets.serve(gateway, "127.0.0.1", args.port, compression=None, max_size=2 ** 22):
+        for mode in args.data_path.split(","):
+            for offload in (0, args.offload):
+                crypto.configure(offload, args.threads)
+                await run(1)   # Прогрев: импорты, первые буферы и потоки пула не в счет
+                latencies, received, stalls = await run(args.seconds)
+                label = f"пул от {offload // 1024} КБ" if offload else "все в цикле"
+                print(f"{mode:<9} {label:<17}: задержка мс: медиана {statistics.median(latencies) * 1000:6.2f}, "
+                      f"p99 {percentile(latencies, 0.99) * 1000:7.2f}, макс {max(latencies) * 1000:7.2f}; "
+                      f"цикл шлюза p99 {percentile(stalls, 0.99) * 1000:6.2f}; "
+                      f"большие потоки {received / args.seconds / 2 ** 20:6.1f} МБ/с")
+
+
+def rss_bytes(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def bench_idle(args):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    streams = min(args.streams, (hard - IDLE_FDS_RESERVED) // 2)
+    if streams < args.streams:
+        print(f"лимит файловых дескрипторов {hard}: соединений {streams} вместо {args.streams}")
+    held = []
+
+    async def target(reader, writer):
+        held.append(writer)
+        writer.write(await reader.readexactly(1))
+
+    async def open_stream(socks_port: int, target_port: int):
+        reader, writer = await asyncio.open_connection("127.0.0.1", socks_port)
+        writer.write(b"\x05\x01\x00")
+        await reader.readexactly(2)
+        writer.write(b"\x05\x01\x00\x01" + bytes([127, 0, 0, 1]) + target_port.to_bytes(2, "big") + b"x")
+        await reader.readexactly(10)
+        await reader.readexactly(1)   # Эхо: соединение прошло туннель до цели
+        return writer
+
+    target_server = await asyncio.start_server(target, "127.0.0.1", args.port + 2, backlog=4096)
+    for data_path in args.data_path.split(","):
+        env = dict(os.environ, VKTUN_SERVER_PORT=str(args.port), VKTUN_CLIENT_SOCKS_PORT=str(args.port + 1),
+                   VKTUN_SERVER_DATA_PATH=data_path, VKTUN_CLIENT_DATA_PATH=data_path,
+                   VKTUN_SERVER_CONN_RATE_PER_IP="0", VKTUN_SERVER_MAX_PENDING_OPENS="0",
+                   VKTUN_SERVER_LOG_LEVEL="WARNING", VKTUN_CLIENT_LOG_LEVEL="WARNING")
+        here = os.path.dirname(os.path.abspath(__file__))
+        processes = {"server.py": None, "client.py": None}
+        processes["server.py"] = subprocess.Popen([sys.executable, os.path.join(here, "server.py")], env=env,
+                                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        await asyncio.sleep(1)
+        processes["client.py"] = subprocess.Popen([sys.executable, os.path.join(here, "client.py"),
+                                                   "--wss", f"ws://127.0.0.1:{args.port}/"], env=env,
+                                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        writers = []
+        try:
+            await asyncio.sleep(1)
+            before = {name: rss_bytes(p.pid) for name, p in processes.items()}
+            started = time.perf_counter()
+            for i in range(0, streams, IDLE_BATCH):
+                writers += await asyncio.gather(*(open_stream(args.port + 1, args.port + 2)
+                                                  for _ in range(min(IDLE_BATCH, streams - i))))
+            opened = time.perf_counter() - started
+            await asyncio.sleep(args.settle)
+            after = {name: rss_bytes(p.pid) for name, p in processes.items()}
+            parts = [f"{name} {(after[name] - before[name]) / len(writers) / 1024:5.1f} КБ "
+                     f"(всего {after[name] / 2 ** 20:.0f} МБ)" for name in processes]
+            print(f"data_path {data_path:<8} соединений {len(writers)} за {opened:.1f} с; RSS на соединение: "
+                  + ", ".join(parts))
+        finally:
+            for writer in writers + held:
+                writer.close()
+            held.clear()
+            for p in processes.values():
+                p.terminate()
+                p.wait()
+    target_server.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Замеры производительности клиента и шлюза")
+    sub = ap.add_subparsers(dest="command", required=True)
+    setup = sub.add_parser("setup", help="установка соединения со шлюзом")
+    setup.add_argument("--wss", required=True, help="URL шлюза")
+    setup.add_argument("-n", "--count", type=int, default=50, help="число соединений")
+    setup.add_argument("--cafile", default=None, help="свой CA (для тестового шлюза с самоподписанным сертификатом)")
+    datapath = sub.add_parser("datapath", help="передача данных на шлюзе: трубы против fastpath.py")
+    datapath.add_argument("--mb", type=int, default=64, help="МБ на замер в каждую сторону")
+    datapath.add_argument("--streams", default="1,32", help="число одновременных потоков, через запятую")
+    datapath.add_argument("--port", type=int, default=DATAPATH_PORT, help="порт шлюза замера; цель - следующий")
+    idle = sub.add_parser("idle", help="память молчащих соединений в client.py и server.py")
+    idle.add_argument("--streams", type=int, default=20000, help="число соединений")
+    idle.add_argument("--data-path", default="streams,buffered", help="значения data_path, через запятую")
+    idle.add_argument("--settle", type=float, default=3, help="пауза перед замером RSS, с")
+    idle.add_argument("--port", type=int, default=IDLE_PORT, help="порт шлюза; SOCKS и цель - следующие")
+    offload = sub.add_parser("crypto", help="задержка мелких потоков рядом с большими кадрами: crypto_pool.py")
+    offload.add_argument("--seconds", type=float, default=5, help="длительность замера")
+    offload.add_argument("--bulk", type=int, default=4, help="потоков с кадрами по 4 МБ")
+    offload.add_argument("--small", type=int, default=16, help="мелких потоков")
+    offload.add_argument("--offload", type=int, default=DEFAULT_OFFLOAD_BYTES, help="crypto_offload_bytes для замера с пулом")
+    offload.add_argument("--threads", type=int, default=0, help="crypto_threads")
+    offload.add_argument("--data-path", default="streams,buffered", help="значения data_path, через запятую")
+    offload.add_argument("--port", type=int, default=CRYPTO_PORT, help="порт шлюза; эхо-цель и приемник - следующие")
+    args = ap.parse_args()
+    asyncio.run({"setup": bench_setup, "datapath": bench_datapath, "idle": bench_idle,
+                 "crypto": bench_crypto}[args.command](args))
+
+
+if __name__ == "__main__":
+    main()
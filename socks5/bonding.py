@@ -0,0 +1,117 @@
+# bonding.py
+"""Объединение нескольких vk-tunnel одного шлюза: client.py --wss URL1 --wss URL2 ...
+
+Один vk-tunnel упирается в свой потолок скорости задолго до канала сервера. Клиент
+с несколькими адресами (по экземпляру vk-tunnel на каждый) распределяет трафик:
+    bond_mode "stream" - каждое новое соединение идет через наименее загруженный туннель
+                         (открытые потоки с учетом времени подключения);
+    bond_mode "chunk"  - одно соединение использует все исправные туннели сразу: поток
+                         открывается как возобновляемый (resume.py), к нему присоединяются
+                         WebSocket через остальные туннели (FLAG_JOIN), сегменты идут через
+                         наименее занятый, а шлюз и клиент собирают их по смещениям.
+Туннель, к которому подряд не удалось подключиться BOND_FAILURES_BEFORE_DOWN раз или
+который отвечает в BOND_RTT_DEGRADED_FACTOR раз медленнее лучшего, выводится из ротации;
+его проверяют каждые BOND_PROBE_SECONDS и возвращают, когда он снова отвечает.
+"""
+import asyncio
+import logging
+import time
+from typing import Iterable, List, Optional
+
+from endpoint import Endpoint
+
+log = logging.getLogger("bonding")
+
+BOND_MODES = ("stream", "chunk")
+BOND_FAILURES_BEFORE_DOWN = 2
+BOND_RTT_DEGRADED_FACTOR = 3.0
+BOND_RTT_STALE_SECONDS = 60     # Туннель без подключений дольше - замерить заново
+BOND_PROBE_SECONDS = 10
+BOND_STATS_SECONDS = 300
+
+
+class TunnelPool:
+    """Адреса шлюза для новых потоков; один адрес - обычная работа без объединения"""
+
+    def __init__(self):
+        self.endpoints: List[Endpoint] = []
+        self.degraded: set = set()
+        self.turn = 0
+
+    def configure(self, endpoints: List[Endpoint]):
+        self.endpoints = list(endpoints)
+        self.degraded = set()
+
+    @property
+    def bonded(self) -> bool:
+        return len(self.endpoints) > 1
+
+    def rebuild(self, settings=None):
+        for endpoint in self.endpoints:
+            endpoint.rebuild(settings)
+
+    def _healthy(self, endpoint: Endpoint, best_rtt: float) -> bool:
+        if endpoint.failures >= BOND_FAILURES_BEFORE_DOWN:
+            return False
+        return not (endpoint.rtt and best_rtt and endpoint.rtt > best_rtt * BOND_RTT_DEGRADED_FACTOR)
+
+    def healthy(self) -> List[Endpoint]:
+        """Туннели в ротации; если исправных нет - все (лучше попытаться, чем отказать)"""
+        measured = [e.rtt for e in self.endpoints if e.rtt and e.failures < BOND_FAILURES_BEFORE_DOWN]
+        best_rtt = min(measured) if measured else 0.0
+        healthy = [e for e in self.endpoints if self._healthy(e, best_rtt)]
+        self._note(healthy)
+        return healthy or list(self.endpoints)
+
+    def _note(self, healthy: List[Endpoint]):
+        degraded = {e.url for e in self.endpoints} - {e.url for e in healthy}
+        for url in degraded - self.degraded:
+            log.warning(f"туннель {url} выведен из ротации")
+        for url in self.degraded - degraded:
+            log.info(f"туннель {url} снова в ротации")
+        self.degraded = degraded
+
+    def pick(self, exclude: Iterable[Endpoint] = ()) -> Optional[Endpoint]:
+        """Наименее загруженный: (потоков + 1) * время подключения; неизмеренные - первыми"""
+        excluded = set(id(e) for e in exclude)
+        candidates = [e for e in self.healthy() if id(e) not in excluded]
+        if not candidates:
+            return None
+        # При равенстве (еще не измерены) - по кругу
+        self.turn = (self.turn + 1) % len(candidates)
+        ordered = candidates[self.turn:] + candidates[:self.turn]
+        return min(ordered, key=lambda e: ((e.active + 1) * e.rtt, e.active))
+
+    async def probe(self, endpoint: Endpoint):
+        try:
+            ws = await endpoint.open()
+        except Exception as e:
+            log.debug(f"туннель {endpoint.url}: {e!r}")
+            return
+        await ws.close()
+
+    def summary(self, interval: float = 0, previous: Optional[dict] = None) -> str:
+        parts = []
+        for e in self.endpoints:
+            rate = ""
+            if interval and previous is not None:
+                rate = f", {(e.transferred - previous.get(e.url, 0)) * 8 / interval / 1000:.0f} кбит/с"
+            state = "вне ротации" if e.url in self.degraded else "в ротации"
+            parts.append(f"{e.url}: {state}, потоков {e.active}, подключение {e.rtt * 1000:.0f} мс{rate}")
+        return "; ".join(parts)
+
+    async def watch(self):
+        """Проверка выведенных из ротации и давно не использованных туннелей, статистика в лог"""
+        last_stats = time.monotonic()
+        transferred = {e.url: e.transferred for e in self.endpoints}
+        while True:
+            await asyncio.sleep(BOND_PROBE_SECONDS)
+            now = time.monotonic()
+            stale = [e for e in self.endpoints if e.failures >= BOND_FAILURES_BEFORE_DOWN
+                     or now - e.rtt_measured > BOND_RTT_STALE_SECONDS]
+            if stale:
+                await asyncio.gather(*(self.probe(e) for e in stale))
+                self.healthy()
+            if now - last_stats >= BOND_STATS_SECONDS:
+                log.info(f"туннели: {self.summary(now - last_stats, transferred)}")
+                last_stats, transferred = now, {e.url: e.transferred for e in self.endpoints}
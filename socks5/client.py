@@ -1,40 +1,136 @@
 #!/usr/bin/env python3
-import asyncio, json, socket, ssl, argparse, logging, os
-from urllib.parse import urlparse
+import asyncio, json, socket, argparse, logging, os, time
+from typing import Callable
 import websockets
 
-from config_light import CONFIG
-from crypto_aead_light import aead_seal, aead_open
+from auth import TokenBucket, UserRegistry, negotiate
+from compression import CODEC_NAMES, CODEC_ZSTD, StreamCompressor, StreamDecompressor
+from crypto_aead_light import FrameCipher
+from crypto_pool import crypto
+from keepalive import keepalive
+from key_rotation import KeyringWatcher
+from limits import Activity
+from bonding import BOND_MODES, TunnelPool
+from discovery import Discovery
+from endpoint import Endpoint, create_client_context
+from fastpath import DATA_PATHS, TunnelConnection, supported, take_over
+from dns_tunnel import DnsCache, DnsTunnelClient, parse_endpoint
+from routing import ACTION_BLOCK, ACTION_DIRECT, RouteTable
+from scheduler import Flow, scheduler
+from protocol import (CLOSE_TRY_AGAIN_LATER, CMD_CONNECT, CMD_UDP_ASSOCIATE, FLAG_COMPRESS_ZLIB, FLAG_COMPRESS_ZSTD, FLAG_DNS,
+                      FLAG_JOIN, FLAG_RESUMABLE, FLAG_RESUME, FLAG_UDP, REP_ADDRESS_NOT_SUPPORTED, REP_COMMAND_NOT_SUPPORTED,
+                      REP_NOT_ALLOWED, REP_SUCCEEDED, ProtocolError, build_socks_udp, decode_datagram, decode_result,
+                      decode_resume_result, encode_datagram, encode_open, encode_resume, parse_socks_udp, rep_for_error,
+                      socks_reply)
+from resume import ResumeError, StreamSession, relay
+from settings import get_settings, store, install_reload_signal, apply_log_level
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [cli] %(message)s")
 log = logging.getLogger("cli")
 
-KEY = bytes.fromhex(CONFIG["aes_key_hex"])
+# Новые потоки шифруются текущим ключом; keyring.json перечитывается на лету
+keys = KeyringWatcher()
 
-async def forward_tcp_to_ws(reader: asyncio.StreamReader, ws: websockets.WebSocketClientProtocol):
+DECRYPT_FAILURES_BEFORE_CLOSE = 3
+decrypt_failures = 0
+
+RESUME_BACKOFF_SECONDS = 0.5   # Первая пауза между попытками продолжить поток; дальше удваивается
+RESUME_BACKOFF_MAX_SECONDS = 5
+
+# Пользователи SOCKS5 (client.users): пароль, лимит потоков, полоса
+users = UserRegistry()
+routes = RouteTable()
+# Несколько --wss: туннели, между которыми делятся потоки (bonding.py)
+tunnels = TunnelPool()
+
+async def forward_tcp_to_ws(reader: asyncio.StreamReader, ws: websockets.WebSocketClientProtocol, cipher: FrameCipher,
+                            compressor: StreamCompressor = None, bucket: TokenBucket = None, flow: Flow = None,
+                            meter: Endpoint = None, activity: Activity = None):
+    # Настройки берутся при открытии потока: после перечитывания их получат только новые соединения
+    read_size = get_settings().client.read_chunk_size
     try:
         while True:
-            data = await reader.read(65536)
+            data = await reader.read(read_size)
             if not data:
                 break
-            enc = aead_seal(KEY, data)
+            if activity:
+                activity.touch()
+            if bucket:
+                delay = bucket.take(len(data))
+                if delay:
+                    await asyncio.sleep(delay)
+            if compressor:
+                data = compressor.encode(data)
+            enc = await crypto.seal(cipher, data)
+            if flow:
+                await scheduler.acquire(flow, len(enc))
             await ws.send(enc)
+            if meter:
+                meter.transferred += len(enc)
     except Exception:
         pass
     finally:
+        if compressor and compressor.summary():
+            log.info(compressor.summary())
+        if flow and scheduler.rate:
+            log.debug(scheduler.summary())
         try:
             await ws.close()
         except Exception:
             pass
 
-async def forward_ws_to_tcp(ws: websockets.WebSocketClientProtocol, writer: asyncio.StreamWriter):
+def decrypt_failed(e: ValueError, cipher: FrameCipher, failures: int) -> bool:
+    """Учет нерасшифрованного кадра; failures - подряд в этом потоке. True - поток пора закрыть"""
+    global decrypt_failures
+    decrypt_failures += 1
+    if failures == 1:
+        log.warning(f"кадр не расшифрован ({e or 'неверный тег'}), ключ {cipher.key_id}; "
+                    f"всего ошибок: {decrypt_failures}")
+    if failures >= DECRYPT_FAILURES_BEFORE_CLOSE:
+        log.warning("поток закрыт: ключи клиента и шлюза не совпадают")
+        return True
+    return False
+
+async def forward_ws_to_tcp(ws: websockets.WebSocketClientProtocol, writer: asyncio.StreamWriter, cipher: FrameCipher,
+                            expect_result: bool = False, compressor: StreamCompressor = None,
+                            decompressor: StreamDecompressor = None, bucket: TokenBucket = None,
+                            meter: Endpoint = None, activity: Activity = None):
+    """expect_result: первый кадр шлюза - RESULT (режим fast, SOCKS успех уже отправлен)"""
+    failures = 0
     try:
         async for msg in ws:
+            if activity:
+                activity.touch()
             if isinstance(msg, (bytes, bytearray)):
+                if meter:
+                    meter.transferred += len(msg)
                 try:
-                    plain = aead_open(KEY, bytes(msg))
-                except Exception:
+                    plain = await crypto.open(cipher, msg)
+                    failures = 0
+                except ValueError as e:
+                    failures += 1
+                    if decrypt_failed(e, cipher, failures):
+                        break
                     continue
+                if expect_result:
+                    expect_result = False
+                    rep, codecs = decode_result(plain)
+                    if rep != REP_SUCCEEDED:
+                        log.info(f"connect failed on gateway, rep={rep}")
+                        break
+                    if compressor:
+                        compressor.allow(codecs)
+                    continue
+                if decompressor:
+                    try:
+                        plain = decompressor.decode(plain)
+                    except ValueError as e:
+                        log.warning(f"поток закрыт: {e}")
+                        break
+                if bucket:
+                    delay = bucket.take(len(plain))
+                    if delay:
+                        await asyncio.sleep(delay)
                 try:
                     writer.write(plain)
                     await writer.drain()
@@ -44,26 +140,297 @@ async def forward_ws_to_tcp(ws: websockets.WebSocketClientProtocol, writer: asyn
     except Exception:
         pass
     finally:
+        if expect_result and ws.close_code == CLOSE_TRY_AGAIN_LATER:
+            log.warning(f"шлюз перегружен и отклонил поток: {ws.close_reason}")
         try:
             writer.close()
             await writer.wait_closed()
         except Exception:
             pass
 
-async def handle_socks(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, remote_wss: str, origin: str):
-    cid = None
+UDP_QUEUE_SIZE = 256   # Датаграмм в очереди к шлюзу; сверх этого отбрасываются, как в UDP
+
+class _AppDatagrams(asyncio.DatagramProtocol):
+    def __init__(self, association: "UdpAssociation"):
+        self.association = association
+
+    def datagram_received(self, data: bytes, addr):
+        self.association.on_app_datagram(data, addr)
+
+class UdpAssociation:
+    """UDP ASSOCIATE: локальный UDP-релей, датаграммы идут через один WS-поток с адресом в каждом кадре.
+
+    Ассоциация живет, пока открыто управляющее TCP-соединение SOCKS (RFC 1928),
+    и закрывается после udp_idle_timeout без трафика.
+    """
+
+    def __init__(self, ws: websockets.WebSocketClientProtocol, cipher: FrameCipher,
+                 transport: asyncio.DatagramTransport, app_host: str):
+        self.ws = ws
+        self.cipher = cipher
+        self.transport = transport
+        self.app_host = app_host
+        self.app_addr = None
+        self.idle_timeout = get_settings().client.udp_idle_timeout
+        self.outgoing: asyncio.Queue = asyncio.Queue(UDP_QUEUE_SIZE)
+        self.last_activity = time.monotonic()
+        self.dropped = 0
+
+    def on_app_datagram(self, data: bytes, addr):
+        if addr[0] != self.app_host:
+            self.dropped += 1  # датаграммы принимаем только с адреса SOCKS-клиента
+            return
+        self.app_addr = addr
+        self.last_activity = time.monotonic()
+        try:
+            self.outgoing.put_nowait(encode_datagram(*parse_socks_udp(data)))
+        except (ProtocolError, asyncio.QueueFull):
+            self.dropped += 1
+
+    async def uplink(self):
+        while True:
+            plain = await self.outgoing.get()
+            await self.ws.send(self.cipher.seal(plain))
+
+    async def downlink(self):
+        global decrypt_failures
+        async for msg in self.ws:
+            if not isinstance(msg, (bytes, bytearray)) or self.app_addr is None:
+                continue
+            try:
+                addr, port, payload = decode_datagram(self.cipher.open(msg))
+            except ValueError as e:
+                decrypt_failures += 1
+                self.dropped += 1
+                log.debug(f"udp: датаграмма отброшена: {e}")
+                continue
+            self.last_activity = time.monotonic()
+            self.transport.sendto(build_socks_udp(addr, port, payload), self.app_addr)
+
+    async def expire(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 4, 30))
+            if time.monotonic() - self.last_activity > self.idle_timeout:
+                log.info("udp: ассоциация закрыта по простою")
+                return
+
+    async def run(self, control: asyncio.StreamReader):
+        tasks = [asyncio.create_task(self.uplink()), asyncio.create_task(self.downlink()),
+                 asyncio.create_task(self.expire()), asyncio.create_task(control.read())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.dropped:
+                log.info(f"udp: отброшено датаграмм: {self.dropped}")
+
+async def open_service_stream(endpoint: Endpoint, flags: int):
+    """Поток без цели (UDP, DNS): OPEN с флагом и ожидание RESULT; -> (ws, cipher, rep)"""
+    ws = await endpoint.open()
+    try:
+        cipher = keys.keyring.cipher()
+        await ws.send(cipher.seal(encode_open("0.0.0.0", 0, flags=flags)))
+        rep, _ = decode_result(cipher.open(await asyncio.wait_for(ws.recv(), get_settings().client.open_timeout)))
+    except BaseException:
+        await ws.close()
+        raise
+    return ws, cipher, rep
+
+async def udp_associate(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, endpoint: Endpoint):
+    cfg = get_settings().client
+    app_host = writer.get_extra_info("peername")[0]
+    transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(
+        asyncio.DatagramProtocol, local_addr=(cfg.socks_host, 0))
+    try:
+        ws, cipher, rep = await open_service_stream(endpoint, FLAG_UDP)
+        try:
+            writer.write(socks_reply(rep, transport.get_extra_info("sockname")[:2])); await writer.drain()
+            if rep != REP_SUCCEEDED:
+                return
+            association = UdpAssociation(ws, cipher, transport, app_host)
+            transport.set_protocol(_AppDatagrams(association))
+            await association.run(reader)
+        finally:
+            await ws.close()
+    finally:
+        transport.close()
+
+async def start_dns_listener(current_endpoint: Callable[[], Endpoint]) -> asyncio.Task:
+    cfg = get_settings().client
+    host, port = parse_endpoint(cfg.dns_listen, 53)
+
+    async def open_dns_stream():
+        ws, cipher, rep = await open_service_stream(current_endpoint(), FLAG_DNS)
+        if rep != REP_SUCCEEDED:
+            await ws.close()
+            raise ConnectionError(f"шлюз отклонил DNS-поток, rep={rep}")
+        return ws, cipher
+
+    dns_client = DnsTunnelClient(open_dns_stream, DnsCache(cfg.dns_cache_size))
+    await asyncio.get_running_loop().create_datagram_endpoint(lambda: dns_client, local_addr=(host, port))
+    log.info(f"DNS через туннель: udp://{host}:{port}")
+    return asyncio.create_task(dns_client.run())
+
+async def copy_stream(src: asyncio.StreamReader, dst: asyncio.StreamWriter, read_size: int, bucket: TokenBucket = None):
+    try:
+        while True:
+            data = await src.read(read_size)
+            if not data:
+                break
+            if bucket:
+                delay = bucket.take(len(data))
+                if delay:
+                    await asyncio.sleep(delay)
+            dst.write(data)
+            await dst.drain()
+        if dst.can_write_eof():
+            dst.write_eof()   # Полузакрытие: ответ с другой стороны еще может прийти
+    except Exception:
+        dst.close()
+
+async def connect_direct(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, addr: str, port: int, user):
+    """Соединение мимо туннеля (правило direct в client.routes)"""
+    cfg = get_settings().client
     try:
-        # SOCKS5 greeting
-        ver_nm = await reader.readexactly(2)
-        ver, nmethods = ver_nm[0], ver_nm[1]
-        _ = await reader.readexactly(nmethods)
-        writer.write(b"\x05\x00"); await writer.drain()
+        up_reader, up_writer = await asyncio.wait_for(asyncio.open_connection(addr, port), cfg.open_timeout)
+    except Exception as e:
+        log.info(f"direct connect to {addr}:{port} failed: {e!r}")
+        writer.write(socks_reply(rep_for_error(e))); await writer.drain()
+        return
+    writer.write(socks_reply(REP_SUCCEEDED)); await writer.drain()
+    try:
+        await asyncio.gather(copy_stream(reader, up_writer, cfg.read_chunk_size, user.upload if user else None),
+                             copy_stream(up_reader, writer, cfg.read_chunk_size, user.download if user else None))
+    finally:
+        up_writer.close()
+
+async def resumable_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, endpoint: Endpoint,
+                           current_endpoint: Callable[[], Endpoint], addr: str, port: int, flags: int,
+                           compressor: StreamCompressor, decompressor: StreamDecompressor, user):
+    """Поток с FLAG_RESUMABLE: после обрыва WebSocket клиент переподключается (к текущему адресу шлюза)
+    и продолжает поток с места обрыва; соединение приложения при этом не закрывается.
+    В режиме bond_mode "chunk" к потоку присоединяются WebSocket через остальные туннели."""
+    cfg = get_settings().client
+    cipher = keys.keyring.cipher()
+    with endpoint.lease():
+        ws = await endpoint.open()
+        try:
+            early_data = b""
+            if cfg.open_mode == "fast":
+                try:
+                    early_data = await asyncio.wait_for(reader.read(cfg.read_chunk_size), cfg.early_data_wait)
+                except asyncio.TimeoutError:
+                    pass
+                delay = user.upload.take(len(early_data)) if user else 0
+                if delay:
+                    await asyncio.sleep(delay)   # Первые байты тоже под лимитом пользователя
+            await ws.send(cipher.seal(encode_open(addr, port, flags=flags | FLAG_RESUMABLE, early_data=early_data)))
+            # RESULT ждем и в режиме fast: без ID сессии продолжить поток нельзя
+            rep, codecs, session_id, received = decode_resume_result(
+                cipher.open(await asyncio.wait_for(ws.recv(), cfg.open_timeout)))
+        except BaseException:
+            await ws.close()
+            raise
+    if cfg.open_mode != "fast":
+        writer.write(socks_reply(rep)); await writer.drain()
+    if rep != REP_SUCCEEDED:
+        log.info(f"connect to {addr}:{port} failed on gateway, rep={rep}")
+        await ws.close()
+        return
+    if compressor:
+        compressor.allow(codecs)
+
+    session = StreamSession(session_id, cipher, cfg.resume_buffer_bytes)
+    session.sent = session.acked = received   # Ранние данные шлюз уже получил вместе с OPEN
+    session.add_link(ws, endpoint)
+    joins = []
+
+    async def link(target: Endpoint, open_flags: int):
+        """Подключить к потоку WebSocket через target; None - шлюз потока уже не знает"""
+        new_ws = await target.open()
+        try:
+            await new_ws.send(cipher.seal(encode_open("0.0.0.0", 0, flags=open_flags,
+                                                      early_data=encode_resume(session_id, session.received))))
+            rep, _, _, peer_received = decode_resume_result(
+                cipher.open(await asyncio.wait_for(new_ws.recv(), cfg.open_timeout)))
+            if rep != REP_SUCCEEDED:
+                await new_ws.close()
+                return None
+            if open_flags & FLAG_JOIN and session.links:
+                session.add_link(new_ws, target)
+            else:
+                await session.attach(new_ws, peer_received, target)
+        except BaseException:
+            await new_ws.close()
+            raise
+        return new_ws
+
+    async def join(target: Endpoint):
+        with target.lease():
+            try:
+                new_ws = await link(target, FLAG_JOIN)
+                if new_ws is not None:
+                    await session.wait_detached(new_ws)   # Поток учитывается на туннеле, пока WebSocket в работе
+            except Exception as e:
+                log.debug(f"поток {session_id.hex()[:8]}: туннель {target.url} не присоединен: {e!r}")
+
+    def join_tunnels():
+        if not (tunnels.bonded and cfg.bond_mode == "chunk"):
+            return
+        used = set(id(meter) for meter in session.links.values())
+        joins.extend(asyncio.create_task(join(target)) for target in tunnels.healthy() if id(target) not in used)
+
+    async def reconnect() -> bool:
+        deadline = time.monotonic() + cfg.resume_grace
+        delay = RESUME_BACKOFF_SECONDS
+        while time.monotonic() < deadline:
+            target = current_endpoint()
+            try:
+                if await link(target, FLAG_RESUME) is None:
+                    return False   # Шлюз уже закрыл цель
+                join_tunnels()
+                return True
+            except (ProtocolError, ResumeError) as e:
+                log.warning(f"поток {session_id.hex()[:8]}: {e}")
+                return False
+            except Exception as e:
+                log.debug(f"поток {session_id.hex()[:8]}: попытка продолжить через {target.url} не удалась: {e!r}")
+                await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+                delay = min(delay * 2, RESUME_BACKOFF_MAX_SECONDS)
+        return False
+
+    join_tunnels()
+    try:
+        with endpoint.lease():
+            await relay(session, reader, writer, reconnect, cfg.read_chunk_size,
+                        compressor=compressor, decompressor=decompressor, flow=scheduler.flow(port),
+                        upload=user.upload if user else None, download=user.download if user else None)
+    finally:
+        for task in joins:
+            task.cancel()
+        await asyncio.gather(*joins, return_exceptions=True)
+    if compressor and compressor.summary():
+        log.info(compressor.summary())
+
+async def handle_socks(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, endpoint: Endpoint,
+                       current_endpoint: Callable[[], Endpoint] = None):
+    user = None
+    try:
+        # SOCKS5 greeting (+ логин/пароль, если заданы client.users)
+        try:
+            user = await negotiate(reader, writer, users)
+        except PermissionError as e:
+            log.warning(f"SOCKS auth: {e}")
+            return
 
         # request
         req = await reader.readexactly(4)
         ver, cmd, _, atyp = req
-        if ver != 0x05 or cmd != 0x01:
-            writer.write(b"\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00"); await writer.drain(); writer.close(); return
+        udp_supported = get_settings().client.open_mode != "json"
+        if ver != 0x05 or not (cmd == CMD_CONNECT or cmd == CMD_UDP_ASSOCIATE and udp_supported):
+            writer.write(socks_reply(REP_COMMAND_NOT_SUPPORTED)); await writer.drain(); writer.close(); return
 
         if atyp == 0x01:
             addr = socket.inet_ntop(socket.AF_INET, await reader.readexactly(4))
@@ -73,27 +440,98 @@ async def handle_socks(reader: asyncio.StreamReader, writer: asyncio.StreamWrite
         elif atyp == 0x04:
             addr = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
         else:
-            writer.write(b"\x05\x08\x00\x01\x00\x00\x00\x00\x00\x00"); await writer.drain(); writer.close(); return
+            writer.write(socks_reply(REP_ADDRESS_NOT_SUPPORTED)); await writer.drain(); writer.close(); return
         port = int.from_bytes(await reader.readexactly(2), 'big')
 
-        # WS connect
-        u = urlparse(remote_wss)
-        ws_kwargs = dict(max_size=2**22, ping_interval=20, ping_timeout=20, compression=None, origin=origin)
-        if u.scheme == "wss":
-            ws_kwargs["ssl"] = ssl.create_default_context()
-        else:
-            ws_kwargs["ssl"] = None
+        if user and not users.acquire(user):
+            log.info(f"{user.name}: достигнут лимит потоков ({user.policy.max_streams})")
+            user = None
+            writer.write(socks_reply(REP_NOT_ALLOWED)); await writer.drain(); return
 
-        async with websockets.connect(remote_wss, **ws_kwargs) as ws:
-            # OPEN (текстом)
-            open_obj = {"addr": addr, "port": port}
-            await ws.send(json.dumps(open_obj, separators=(",",":")))
+        cfg = get_settings().client
+        if cmd == CMD_UDP_ASSOCIATE:
+            await udp_associate(reader, writer, endpoint)
+            return
 
-            # ответ SOCKS OK
-            writer.write(b"\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00"); await writer.drain()
+        action, rule = routes.decide(addr, port)
+        if action == ACTION_BLOCK:
+            log.info(f"{addr}:{port} заблокирован правилом {rule.name if rule else 'по умолчанию'}")
+            writer.write(socks_reply(REP_NOT_ALLOWED)); await writer.drain()
+            return
+        if action == ACTION_DIRECT:
+            await connect_direct(reader, writer, addr, port, user)
+            return
 
-            t1 = asyncio.create_task(forward_tcp_to_ws(reader, ws))
-            t2 = asyncio.create_task(forward_ws_to_tcp(ws, writer))
+        mode = cfg.open_mode
+        flags, compressor, decompressor = 0, None, None
+        codec = CODEC_NAMES.get(cfg.compression)
+        if codec and mode != "json":
+            flags = FLAG_COMPRESS_ZSTD if codec == CODEC_ZSTD else FLAG_COMPRESS_ZLIB
+            compressor, decompressor = StreamCompressor(codec, cfg.compression_level), StreamDecompressor()
+        if mode == "fast":
+            # Успех сразу: пока устанавливается WS, приложение успеет прислать первые данные
+            writer.write(socks_reply(REP_SUCCEEDED)); await writer.drain()
+
+        if tunnels.bonded:
+            # Туннель выбирается перед самым подключением: учтены потоки, открытые за время рукопожатия SOCKS
+            endpoint = tunnels.pick()
+        if (cfg.resumable or tunnels.bonded and cfg.bond_mode == "chunk") and mode != "json":
+            await resumable_stream(reader, writer, endpoint, current_endpoint or (lambda: endpoint),
+                                   addr, port, flags, compressor, decompressor, user)
+            return
+
+        # Данные потока: пока они идут, keepalive не пингует его WebSocket
+        activity = Activity()
+        async with endpoint.stream(activity) as ws:
+            # kid - ID ключа, которым зашифрован весь поток
+            cipher = keys.keyring.cipher()
+            if mode == "json":
+                # OPEN (текстом) для шлюзов старых версий
+                open_obj = {"addr": addr, "port": port, "kid": cipher.key_id}
+                await ws.send(json.dumps(open_obj, separators=(",",":")))
+                writer.write(socks_reply(REP_SUCCEEDED)); await writer.drain()
+            else:
+                early_data = b""
+                if mode == "fast":
+                    try:
+                        early_data = await asyncio.wait_for(reader.read(cfg.read_chunk_size), cfg.early_data_wait)
+                    except asyncio.TimeoutError:
+                        pass  # Протокол, где первым говорит сервер
+                    delay = user.upload.take(len(early_data)) if user else 0
+                    if delay:
+                        await asyncio.sleep(delay)   # Первые байты тоже под лимитом пользователя
+                await ws.send(cipher.seal(encode_open(addr, port, flags=flags, early_data=early_data)))
+
+                if mode != "fast":
+                    rep, codecs = decode_result(cipher.open(await asyncio.wait_for(ws.recv(), cfg.open_timeout)))
+                    if compressor:
+                        compressor.allow(codecs)
+                    writer.write(socks_reply(rep)); await writer.drain()
+                    if rep != REP_SUCCEEDED:
+                        log.info(f"connect to {addr}:{port} failed on gateway, rep={rep}")
+                        return
+
+            if cfg.data_path == "buffered" and mode != "json" and not compressor and supported(ws):
+                # Соединение приложения переходит на протокол (fastpath.py): у потока нет своих задач
+                connection = TunnelConnection(ws, cipher, cfg.read_chunk_size, flow=scheduler.flow(port),
+                                              upload=user.upload if user else None,
+                                              download=user.download if user else None, meter=endpoint,
+                                              activity=activity)
+                connection.start(take_over(reader, writer, connection))
+                await connection.run(lambda e, failures: decrypt_failed(e, cipher, failures),
+                                     expect_result=(mode == "fast"))
+                if connection.expect_result and ws.close_code == CLOSE_TRY_AGAIN_LATER:
+                    log.warning(f"шлюз перегружен и отклонил поток: {ws.close_reason}")
+                return
+
+            t1 = asyncio.create_task(forward_tcp_to_ws(reader, ws, cipher, compressor,
+                                                       bucket=user.upload if user else None,
+                                                       flow=scheduler.flow(port), meter=endpoint,
+                                                       activity=activity))
+            t2 = asyncio.create_task(forward_ws_to_tcp(ws, writer, cipher, expect_result=(mode == "fast"),
+                                                       compressor=compressor, decompressor=decompressor,
+                                                       bucket=user.download if user else None, meter=endpoint,
+                                                       activity=activity))
             await asyncio.gather(t1, t2)
 
     except asyncio.IncompleteReadError:
@@ -101,6 +539,8 @@ async def handle_socks(reader: asyncio.StreamReader, writer: asyncio.StreamWrite
     except Exception as e:
         log.warning(f"SOCKS error: {e}")
     finally:
+        if user:
+            users.release(user)
         try:
             writer.close()
         except Exception:
@@ -108,20 +548,82 @@ async def handle_socks(reader: asyncio.StreamReader, writer: asyncio.StreamWrite
 
 async def main():
     ap = argparse.ArgumentParser()
-    ap.add_argument("--wss", required=True, help="WSS URL от vk-tunnel (например wss://<host>/)")
+    ap.add_argument("--wss", action="append", default=[],
+                    help="WSS URL от vk-tunnel (например wss://<host>/); несколько --wss - объединение туннелей")
+    ap.add_argument("--discovery", default=None,
+                    help="Файл или http(s)://<сервер>:<порт>/discovery, где менеджер публикует текущий WSS URL")
     ap.add_argument("--origin", default=None, help="Origin заголовок; по умолчанию https://<host>")
     args = ap.parse_args()
+    if not args.wss and not args.discovery:
+        ap.error("нужен --wss или --discovery")
+    if len(args.wss) > 1 and args.discovery:
+        ap.error("--discovery публикует один адрес; для объединения туннелей укажите все --wss")
 
-    remote_wss = args.wss
-    u = urlparse(remote_wss)
-    if not u.scheme.startswith("ws") or not u.hostname:
+    try:
+        # Один SSL-контекст на все туннели: TLS-сессии хранятся по хосту
+        context = create_client_context()
+        endpoints = [Endpoint(url, args.origin, context=context) for url in args.wss]
+    except ValueError:
         raise SystemExit("--wss должен быть ws:// или wss:// с хостом")
+    endpoint = endpoints[0] if endpoints else None
+
+    discovery = None
+    if args.discovery:
+        # Адрес из --wss работает, пока не прочитан документ менеджера
+        discovery = Discovery(args.discovery, lambda: keys.keyring, args.origin)
+        discovery.endpoint = endpoint
+        if endpoint is None:
+            await discovery.wait_ready()
+        current_endpoint = lambda: discovery.endpoint
+    elif len(endpoints) > 1:
+        tunnels.configure(endpoints)
+        current_endpoint = tunnels.pick
+    else:
+        current_endpoint = lambda: endpoint
+
+    cfg = get_settings().client
+    if cfg.bond_mode not in BOND_MODES:
+        raise SystemExit(f"client.bond_mode: ожидается {'/'.join(BOND_MODES)}")
+    if cfg.data_path not in DATA_PATHS:
+        raise SystemExit(f"client.data_path: ожидается {'/'.join(DATA_PATHS)}")
+    if tunnels.bonded:
+        store.subscribe(tunnels.rebuild)
+    else:
+        store.subscribe(lambda settings: current_endpoint().rebuild(settings))
+    apply_log_level(cfg.log_level)
+    store.subscribe(lambda settings: apply_log_level(settings.client.log_level))
+    # ping из одного колеса таймеров, а не задачей websockets на каждое соединение
+    keepalive.configure(cfg.ping_interval, cfg.ping_timeout)
+    store.subscribe(lambda settings: keepalive.configure(settings.client.ping_interval, settings.client.ping_timeout))
+    users.configure(cfg.users)
+    store.subscribe(lambda settings: users.configure(settings.client.users))
+    scheduler.configure(cfg.tunnel_rate_kbps, cfg.priority_ports)
+    store.subscribe(lambda settings: scheduler.configure(settings.client.tunnel_rate_kbps,
+                                                         settings.client.priority_ports))
+    crypto.configure(cfg.crypto_offload_bytes, cfg.crypto_threads)
+    store.subscribe(lambda settings: crypto.configure(settings.client.crypto_offload_bytes,
+                                                      settings.client.crypto_threads))
+    routes.configure(cfg.routes, cfg.route_default)
+    store.subscribe(lambda settings: routes.configure(settings.client.routes, settings.client.route_default))
+    if users.enabled:
+        log.info(f"SOCKS5 auth: пользователей {len(users.users)}")
+    install_reload_signal()
+    keys_watch_task = asyncio.create_task(keys.watch())
+    routes_watch_task = asyncio.create_task(routes.watch())
+    discovery_task = asyncio.create_task(discovery.watch()) if discovery else None
+    tunnels_task = asyncio.create_task(tunnels.watch()) if tunnels.bonded else None
+    dns_task = await start_dns_listener(current_endpoint) if cfg.dns_listen else None
 
-    origin = args.origin or f"https://{u.hostname}"
-    host, port = CONFIG["client"]["socks_host"], CONFIG["client"]["socks_port"]
-    log.info(f"SOCKS5 listening on socks5://{host}:{port} -> {remote_wss} (Origin={origin})")
+    host, port = cfg.socks_host, cfg.socks_port
+    if tunnels.bonded:
+        log.info(f"SOCKS5 listening on socks5://{host}:{port} -> объединение туннелей ({cfg.bond_mode}): "
+                 f"{', '.join(e.url for e in tunnels.endpoints)}")
+    else:
+        endpoint = current_endpoint()
+        log.info(f"SOCKS5 listening on socks5://{host}:{port} -> {endpoint.url} (Origin={endpoint.origin})")
 
-    srv = await asyncio.start_server(lambda r,w: handle_socks(r,w,remote_wss,origin), host, port)
+    # Адрес выбирается при подключении приложения: после смены URL новые соединения идут на новый
+    srv = await asyncio.start_server(lambda r,w: handle_socks(r,w,current_endpoint(),current_endpoint), host, port)
     async with srv:
         await srv.serve_forever()
 
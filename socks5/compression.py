@@ -0,0 +1,180 @@
+# compression.py
+"""Сжатие полезной нагрузки перед шифрованием (по желанию клиента).
+
+Включается полем client.compression ("zlib" или "zstd"; zstd - если установлен zstandard).
+Каждый DATA-кадр начинается с байта кодека: 0 - без сжатия, 1 - zlib, 2 - zstd.
+Контекст сжатия общий на весь поток (маленькие кадры вроде HTTP-заголовков сжимаются
+за счет предыдущих), а уже сжатые данные (TLS, медиа) определяются по пробам
+и дальше идут как есть, не тратя CPU; пробы повторяются раз в BYPASS_FRAMES кадров.
+"""
+import time
+import zlib
+from typing import Dict, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_NAMES = {"zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+
+MIN_COMPRESS_SIZE = 64        # Кадры меньше отправляем как есть
+BYPASS_RATIO = 0.9            # Сжатие хуже 10% - данные считаем несжимаемыми
+BYPASS_FRAMES = 64            # Сколько кадров после неудачной пробы не сжимаем
+MAX_FRAME_SIZE = 16 * 2 ** 20 # Защита от "бомб" при распаковке
+
+
+def available_codecs() -> int:
+    """Битовая маска кодеков, которые умеет этот процесс"""
+    mask = 1 << CODEC_ZLIB
+    if zstandard is not None:
+        mask |= 1 << CODEC_ZSTD
+    return mask
+
+
+def _looks_encrypted(data: bytes) -> bool:
+    """Начало TLS-записи: шифрованное не сожмется"""
+    return len(data) > 2 and 0x14 <= data[0] <= 0x17 and data[1] == 0x03
+
+
+class StreamCompressor:
+    """Сжатие одного направления потока с адаптивным обходом несжимаемых данных"""
+    __slots__ = ('codec', 'level', 'peer_codecs', '_zlib', '_zstd', 'bypass_left',
+                 'bytes_in', 'bytes_out', 'cpu_seconds', 'compressed_frames', 'raw_frames')
+
+    def __init__(self, codec: int, level: int, peer_codecs: int = 1 << CODEC_ZLIB):
+        self.codec = codec
+        self.level = level
+        self.peer_codecs = peer_codecs
+        self._zlib = None
+        self._zstd = None
+        self.bypass_left = 0
+        self.bytes_in = self.bytes_out = 0
+        self.cpu_seconds = 0.0
+        self.compressed_frames = self.raw_frames = 0
+
+    def allow(self, peer_codecs: int):
+        """Кодеки, которые умеет распаковать другая сторона (из RESULT)"""
+        self.peer_codecs = peer_codecs
+
+    def _pick_codec(self) -> int:
+        if self.codec == CODEC_ZSTD and zstandard is not None and self.peer_codecs & (1 << CODEC_ZSTD):
+            return CODEC_ZSTD
+        return CODEC_ZLIB
+
+    def encode(self, data: bytes) -> bytes:
+        self.bytes_in += len(data)
+        if self.level <= 0 or len(data) < MIN_COMPRESS_SIZE or self.bypass_left > 0:
+            self.bypass_left = max(self.bypass_left - 1, 0)
+            return self._raw(data)
+        if _looks_encrypted(data):
+            self.bypass_left = BYPASS_FRAMES
+            return self._raw(data)
+
+        started = time.thread_time()
+        codec = self._pick_codec()
+        if codec == CODEC_ZSTD:
+            if self._zstd is None:
+                self._zstd = zstandard.ZstdCompressor(level=self.level).compressobj()
+            packed = self._zstd.compress(data) + self._zstd.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        else:
+            if self._zlib is None:
+                self._zlib = zlib.compressobj(min(self.level, 9))
+            packed = self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_seconds += time.thread_time() - started
+
+        # Сжатый кадр отправляется в любом случае: контекст сжатия уже включает эти данные
+        if len(packed) > len(data) * BYPASS_RATIO:
+            self.bypass_left = BYPASS_FRAMES
+        self.compressed_frames += 1
+        self.bytes_out += len(packed) + 1
+        return bytes([codec]) + packed
+
+    def _raw(self, data: bytes) -> bytes:
+        self.raw_frames += 1
+        self.bytes_out += len(data) + 1
+        return b"\x00" + data
+
+    def summary(self) -> Optional[str]:
+        if not self.compressed_frames:
+            return None
+        ratio = self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+        return (f"сжатие: {self.bytes_in} -> {self.bytes_out} байт ({ratio:.0%}), "
+                f"CPU {self.cpu_seconds * 1000:.1f} мс, кадров сжато {self.compressed_frames}, "
+                f"как есть {self.raw_frames}")
+
+
+class _BoundedSink:
+    """Приемник zstd stream_writer: распакованное сверх MAX_FRAME_SIZE обрывает распаковку.
+
+    У decompressobj нет ограничения на размер результата, а stream_writer отдает
+    результат кусками по мере распаковки - "бомба" не успевает развернуться в памяти.
+    """
+    __slots__ = ('chunks', 'size')
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data) -> int:
+        self.size += len(data)
+        if self.size > MAX_FRAME_SIZE:
+            raise ValueError("распакованный кадр слишком большой")
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return data
+
+
+class StreamDecompressor:
+    """Распаковка кадров одного направления потока"""
+    __slots__ = ('_contexts',)
+
+    def __init__(self):
+        self._contexts: Dict[int, object] = {}
+
+    def decode(self, frame: bytes) -> bytes:
+        if not frame:
+            raise ValueError("пустой кадр")
+        codec, payload = frame[0], memoryview(frame)[1:]
+        if codec == CODEC_RAW:
+            return bytes(payload)
+        try:
+            return self._decompress(codec, payload)
+        except (zlib.error, MemoryError) as e:
+            raise ValueError(f"ошибка распаковки: {e}") from e
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise ValueError(f"ошибка распаковки: {e}") from e
+            raise
+
+    def _decompress(self, codec: int, payload) -> bytes:
+        context = self._contexts.get(codec)
+        if codec == CODEC_ZLIB:
+            if context is None:
+                context = self._contexts[codec] = zlib.decompressobj()
+            data = context.decompress(payload, MAX_FRAME_SIZE)
+            if context.unconsumed_tail:
+                raise ValueError("распакованный кадр слишком большой")
+            return data
+        if codec == CODEC_ZSTD and zstandard is not None:
+            if context is None:
+                # Окно не больше MAX_FRAME_SIZE: уровни до 19 в него укладываются, а память
+                # под окно задает отправитель
+                sink = _BoundedSink()
+                writer = zstandard.ZstdDecompressor(max_window_size=MAX_FRAME_SIZE).stream_writer(sink)
+                context = self._contexts[codec] = (writer, sink)
+            writer, sink = context
+            try:
+                writer.write(payload)
+            finally:
+                data = sink.take()
+            return data
+        raise ValueError(f"неизвестный кодек {codec}")
@@ -1,4 +1,7 @@
 # config_light.py
+# Файл читается как данные (без выполнения кода); изменения применяются по /reload или SIGHUP.
+# Любое поле можно переопределить в config.json или переменной окружения VKTUN_<РАЗДЕЛ>_<ПОЛЕ>,
+# например VKTUN_MANAGER_BOT_TOKEN. Полный список полей и значений по умолчанию - в settings.py.
 CONFIG = {
     "aes_key_hex": "",  # 32 hex, заменить! Ичпользуйте openssl rand -hex 16 и создайте свой ключ!
     "server": {
@@ -9,4 +12,19 @@ CONFIG = {
         "socks_host": "127.0.0.1",
         "socks_port": 1080
     },
+    "manager": {
+        "bot_token": "",
+        "chat_id": "",
+        "allowed_user_id": "",
+        "restart_interval_seconds": 0,  # 0 - перезапуск только при утечке, зацикливании или падении; 18000 - еще и раз в 5 часов
+        "health_check_interval_seconds": 60,   # Проверять каждую минуту
+        "tunnel_host": "127.0.0.1",
+        "tunnel_port": 8080,
+        "key_rotation_interval_seconds": 0,  # 0 - только вручную (/rotate-key); 604800 - раз в неделю
+        "key_grace_seconds": 86400,          # Старый ключ принимается еще сутки после ротации
+        "discovery_file": "discovery.txt",   # Текущий WSS URL (зашифрован ключом) для client.py --discovery
+        "discovery_listen": "",              # Раздавать его по HTTP, например "0.0.0.0:8765"
+        "fleet_listen": "",                  # Координатор флота: "0.0.0.0:8790"; узлы - "fleet_coordinator": "<IP>:8790"
+        "fleet_secret": ""                   # Общий секрет флота, одинаковый на координаторе и узлах
+    },
 }
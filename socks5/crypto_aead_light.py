@@ -1,19 +1,125 @@
 # crypto_aead_light.py
 import os
+from typing import Dict, Optional, Tuple
 from Crypto.Cipher import AES
 
-def aead_seal(key: bytes, plaintext: bytes) -> bytes:
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+def aead_seal(key: bytes, plaintext: bytes, aad: Optional[bytes] = None) -> bytes:
     assert len(key) == 16  # AES-128
-    nonce = os.urandom(12)
+    nonce = os.urandom(NONCE_SIZE)
     c = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    if aad:
+        c.update(aad)
     ct, tag = c.encrypt_and_digest(plaintext)
     return nonce + ct + tag  # 12 + len(ct) + 16
 
-def aead_open(key: bytes, blob: bytes) -> bytes:
+def aead_open(key: bytes, blob: bytes, aad: Optional[bytes] = None) -> bytes:
     assert len(key) == 16
-    if len(blob) < 12 + 16:
+    if len(blob) < NONCE_SIZE + TAG_SIZE:
         raise ValueError("aead blob too short")
-    nonce, rest = blob[:12], blob[12:]
-    ct, tag = rest[:-16], rest[-16:]
+    nonce, rest = blob[:NONCE_SIZE], blob[NONCE_SIZE:]
+    ct, tag = rest[:-TAG_SIZE], rest[-TAG_SIZE:]
     c = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    if aad:
+        c.update(aad)
     return c.decrypt_and_verify(ct, tag)
+
+
+class UnknownKeyError(ValueError):
+    pass
+
+
+class FrameCipher:
+    """Шифрование кадров одного потока.
+
+    Кадр: key_id (1 байт, входит в AAD) + nonce + ct + tag. Ключ фиксируется при открытии
+    потока, поэтому ротация ключей не затрагивает уже открытые соединения.
+    key_id=None - старый формат кадра без заголовка (клиенты до ротации ключей).
+    """
+    __slots__ = ('key_id', 'key', 'header')
+
+    def __init__(self, key_id: Optional[int], key: bytes):
+        self.key_id = key_id
+        self.key = key
+        self.header = bytes([key_id]) if key_id is not None else b""
+
+    def seal(self, plaintext: bytes) -> bytes:
+        if self.key_id is None:
+            return aead_seal(self.key, plaintext)
+        return self.header + aead_seal(self.key, plaintext, self.header)
+
+    def open(self, blob: bytes) -> bytes:
+        if self.key_id is None:
+            return aead_open(self.key, blob)
+        if not blob or blob[0] != self.key_id:
+            raise UnknownKeyError(f"кадр зашифрован ключом {blob[0] if blob else None}, ожидался {self.key_id}")
+        return aead_open(self.key, memoryview(blob)[1:], self.header)
+
+    @property
+    def prefix(self) -> int:
+        """Байт перед данными в кадре (заголовок и nonce); после данных - еще TAG_SIZE"""
+        return len(self.header) + NONCE_SIZE
+
+    def seal_into(self, buf: bytearray, length: int) -> memoryview:
+        """Кадр из данных buf[prefix:prefix + length] - шифрование на месте, без копий (fastpath.py)"""
+        view = memoryview(buf)
+        h = len(self.header)
+        nonce = os.urandom(NONCE_SIZE)
+        view[:h] = self.header
+        view[h:self.prefix] = nonce
+        c = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        if self.header:
+            c.update(self.header)
+        end = self.prefix + length
+        body = view[self.prefix:end]
+        c.encrypt(body, output=body)
+        view[end:end + TAG_SIZE] = c.digest()
+        return view[:end + TAG_SIZE]
+
+    def open_into(self, blob: bytes, buf: bytearray) -> memoryview:
+        """Расшифровать кадр в buf (не короче данных кадра); -> данные"""
+        if self.key_id is not None and (not blob or blob[0] != self.key_id):
+            raise UnknownKeyError(f"кадр зашифрован ключом {blob[0] if blob else None}, ожидался {self.key_id}")
+        if len(blob) < self.prefix + TAG_SIZE:
+            raise ValueError("aead blob too short")
+        frame = memoryview(blob)
+        c = AES.new(self.key, AES.MODE_GCM, nonce=frame[len(self.header):self.prefix])
+        if self.header:
+            c.update(self.header)
+        out = memoryview(buf)[:len(blob) - self.prefix - TAG_SIZE]
+        c.decrypt(frame[self.prefix:-TAG_SIZE], output=out)
+        c.verify(frame[-TAG_SIZE:])
+        return out
+
+
+class Keyring:
+    """Набор ключей по ID: шифруем текущим, расшифровываем по ID из заголовка кадра за O(1)"""
+
+    def __init__(self, keys: Dict[int, bytes], current_id: int):
+        if current_id not in keys:
+            raise ValueError(f"текущий ключ {current_id} отсутствует в наборе")
+        for key_id, key in keys.items():
+            if not 0 <= key_id <= 255 or len(key) != 16:
+                raise ValueError(f"ключ {key_id}: нужен ID 0..255 и AES-128 ключ (32 hex)")
+        self.keys = keys
+        self.current_id = current_id
+
+    def key(self, key_id: int) -> bytes:
+        try:
+            return self.keys[key_id]
+        except KeyError:
+            raise UnknownKeyError(f"неизвестный ключ {key_id}") from None
+
+    def cipher(self, key_id: Optional[int] = None) -> FrameCipher:
+        """Шифр для нового потока (по умолчанию - текущим ключом)"""
+        if key_id is None:
+            key_id = self.current_id
+        return FrameCipher(key_id, self.key(key_id))
+
+    def open(self, blob: bytes) -> Tuple[int, bytes]:
+        """Расшифровка кадра ключом из его заголовка"""
+        if not blob:
+            raise ValueError("пустой кадр")
+        return blob[0], self.cipher(blob[0]).open(blob)
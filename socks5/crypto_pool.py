@@ -0,0 +1,77 @@
+# crypto_pool.py
+"""Шифрование больших кадров в пуле потоков: crypto_offload_bytes и crypto_threads в client и server.
+
+aead_seal/aead_open выполняются прямо в цикле событий. Кадр в 4 МБ (max_size = 2**22)
+шифруется миллисекунды, и все это время стоят остальные потоки - в том числе SSH и DNS.
+PyCryptodome отпускает GIL на время AES-GCM, поэтому кадры от crypto_offload_bytes байт
+шифруются в ограниченном пуле потоков (crypto_threads), а цикл событий в это время
+обслуживает остальные соединения. Мелкие кадры по-прежнему шифруются на месте: передача
+в пул стоит дороже, чем их шифрование.
+
+Порядок кадров внутри потока сохраняется: pipe ждет каждый кадр, прежде чем читать
+следующий, так что у одного потока в пуле не больше одного кадра в каждую сторону.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from crypto_aead_light import FrameCipher
+
+DEFAULT_OFFLOAD_BYTES = 256 * 1024
+
+
+class CryptoPool:
+    def __init__(self):
+        self.threshold = DEFAULT_OFFLOAD_BYTES     # 0 - все кадры в цикле событий
+        self.workers = 0
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.offloaded = 0
+        self.offloaded_bytes = 0
+
+    def configure(self, threshold: int, workers: int):
+        """threshold - размер кадра для пула, байт; workers - потоков пула (0 - по числу CPU, до 4)"""
+        self.threshold = max(0, threshold)
+        workers = workers or min(4, os.cpu_count() or 1)
+        if workers != self.workers:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)   # Начатые кадры дошифруются, новые пойдут в новый пул
+                self.executor = None
+            self.workers = workers
+
+    def offload(self, size: int) -> bool:
+        return 0 < self.threshold <= size
+
+    def _run(self, size: int, func, *args) -> asyncio.Future:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers or 1, thread_name_prefix="crypto")
+        self.offloaded += 1
+        self.offloaded_bytes += size
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def seal(self, cipher: FrameCipher, plaintext: bytes) -> bytes:
+        if not self.offload(len(plaintext)):
+            return cipher.seal(plaintext)
+        return await self._run(len(plaintext), cipher.seal, plaintext)
+
+    async def open(self, cipher: FrameCipher, blob: bytes) -> bytes:
+        if not self.offload(len(blob)):
+            return cipher.open(blob)
+        return await self._run(len(blob), cipher.open, blob)
+
+    async def seal_into(self, cipher: FrameCipher, buf: bytearray, length: int) -> memoryview:
+        """FrameCipher.seal_into в пуле; вызывать, только если offload(length)"""
+        return await self._run(length, cipher.seal_into, buf, length)
+
+    async def open_into(self, cipher: FrameCipher, blob: bytes, buf: bytearray) -> memoryview:
+        """FrameCipher.open_into в пуле; вызывать, только если offload(len(blob))"""
+        return await self._run(len(blob), cipher.open_into, blob, buf)
+
+    def summary(self) -> str:
+        """Для лога; пусто, если пул не понадобился"""
+        if not self.offloaded:
+            return ""
+        return f"шифрование в пуле: {self.offloaded} кадров, {self.offloaded_bytes / 2 ** 20:.1f} МБ"
+
+
+crypto = CryptoPool()
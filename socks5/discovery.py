@@ -0,0 +1,136 @@
+# discovery.py
+"""Автоматический поиск адреса шлюза: клиент узнает новый wss:// URL после перезапуска vk-tunnel.
+
+Менеджер при каждом новом адресе публикует документ - URL и время выпуска, зашифрованные
+AES ключом (AEAD: подделать или изменить документ без ключа нельзя) - в файл
+manager.discovery_file и, если задан manager.discovery_listen, по HTTP (GET /discovery).
+
+Документ - копии, зашифрованные каждым действующим ключом, через точку: текущим и теми,
+что еще в периоде перекрытия key_grace_seconds. Клиент, который не успел получить новый
+ключ после ротации, открывает копию старым. После ротации и после истечения перекрытия
+менеджер публикует документ заново. Пока ключ один, документ - одна копия, как раньше.
+Клиент с --discovery <путь или http(s)://...> проверяет документ раз в client.discovery_interval
+секунд и переключает на новый адрес только новые соединения; открытые доживают на старом.
+"""
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import time
+import urllib.request
+from typing import Callable, Optional, Tuple
+
+from crypto_aead_light import Keyring
+from endpoint import Endpoint, ResumingContext
+from settings import BASE_DIR, get_settings
+
+log = logging.getLogger("discovery")
+
+DISCOVERY_VERSION = 1
+FETCH_TIMEOUT_SECONDS = 10
+
+
+def seal_document(keyring: Keyring, url: str, issued: Optional[float] = None) -> str:
+    plain = json.dumps({"v": DISCOVERY_VERSION, "url": url, "issued": issued or time.time()},
+                       separators=(",", ":")).encode("utf-8")
+    key_ids = [keyring.current_id] + sorted(set(keyring.keys) - {keyring.current_id})
+    return ".".join(base64.urlsafe_b64encode(keyring.cipher(key_id).seal(plain)).decode("ascii")
+                    for key_id in key_ids)
+
+
+def open_document(keyring: Keyring, text: str) -> Tuple[str, float]:
+    """(URL, время выпуска); ValueError, если документ поврежден или ни одна копия не открывается нашими ключами"""
+    blobs = []
+    for part in text.strip().split("."):
+        try:
+            blobs.append(base64.urlsafe_b64decode(part))
+        except (binascii.Error, ValueError) as e:
+            raise ValueError(f"документ не в base64: {e}") from e
+    ours = [blob for blob in blobs if blob and blob[0] in keyring.keys]
+    if not ours:
+        raise ValueError(f"документ зашифрован ключами {sorted(blob[0] for blob in blobs if blob)}, "
+                         f"а у клиента {sorted(keyring.keys)}")
+    _, plain = keyring.open(ours[0])
+    doc = json.loads(plain)
+    if doc.get("v") != DISCOVERY_VERSION or not isinstance(doc.get("url"), str):
+        raise ValueError("неизвестный формат документа")
+    return doc["url"], float(doc["issued"])
+
+
+def discovery_path(settings=None) -> str:
+    settings = settings or get_settings()
+    return os.path.join(BASE_DIR, settings.manager.discovery_file)
+
+
+def publish(path: str, document: str):
+    """Атомарная запись: клиент, читающий файл, не увидит половину документа"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(document + "\n")
+    os.replace(tmp, path)
+
+
+def fetch(source: str) -> str:
+    """Документ из файла или по HTTP(S); блокирующая - вызывать через to_thread"""
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source, timeout=FETCH_TIMEOUT_SECONDS) as response:
+            return response.read(64 * 1024).decode("ascii")
+    with open(source, "r") as f:
+        return f.read()
+
+
+class Discovery:
+    """Текущий адрес шлюза для новых соединений"""
+
+    def __init__(self, source: str, keyring: Callable[[], Keyring], origin: Optional[str] = None,
+                 context: Optional[ResumingContext] = None):
+        self.source = source
+        self.keyring = keyring
+        self.origin = origin
+        self.context = context
+        self.endpoint: Optional[Endpoint] = None
+        self.issued = 0.0
+        self.switches = 0
+
+    async def refresh(self) -> bool:
+        """True - адрес сменился"""
+        text = await asyncio.to_thread(fetch, self.source)
+        url, issued = open_document(self.keyring(), text)
+        if issued <= self.issued:
+            return False   # Тот же или более старый документ (в том числе повтор старого)
+        self.issued = issued
+        if self.endpoint is not None and self.endpoint.url == url:
+            return False
+        previous = self.endpoint
+        # Тот же SSL-контекст: сессии разных хостов хранятся раздельно
+        self.endpoint = Endpoint(url, self.origin, context=(previous.context if previous else None) or self.context)
+        self.context = self.endpoint.context or self.context
+        if previous is not None:
+            self.switches += 1
+            log.info(f"шлюз сменил адрес: {previous.url} -> {url}; открытые соединения остаются на старом")
+        else:
+            log.info(f"адрес шлюза: {url}")
+        return True
+
+    async def wait_ready(self):
+        """Первый документ; без него клиенту некуда подключаться"""
+        while self.endpoint is None:
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.warning(f"discovery {self.source}: {e}; повтор через {get_settings().client.discovery_interval:.0f} с")
+                await asyncio.sleep(get_settings().client.discovery_interval)
+
+    async def watch(self):
+        failures = 0
+        while True:
+            try:
+                await self.refresh()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                if failures == 1:   # Не засоряем лог, пока источник недоступен
+                    log.warning(f"discovery {self.source}: {e}")
+            await asyncio.sleep(get_settings().client.discovery_interval)
@@ -0,0 +1,319 @@
+# dns_tunnel.py
+"""DNS через туннель: локальный DNS-листенер клиента и резолвер на шлюзе.
+
+Клиент принимает запросы на client.dns_listen, отвечает из TTL-кэша или отправляет
+запрос по одному постоянному потоку (OPEN с FLAG_DNS). Запросы, накопившиеся, пока
+предыдущий кадр уходил в туннель, отправляются одним кадром - пакетирование без
+искусственной задержки. Шлюз пересылает запросы резолверу (server.dns_upstream
+или первый nameserver из /etc/resolv.conf) и так же пакетами возвращает ответы.
+"""
+import asyncio
+import logging
+import struct
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from protocol import ProtocolError, decode_batch, encode_batch
+
+log = logging.getLogger("dns")
+
+DNS_QUEUE_SIZE = 1024                # Запросов в очереди к туннелю
+DNS_QUERY_TIMEOUT_SECONDS = 5        # Потерянный запрос забываем (приложение повторит сам)
+DNS_STATS_INTERVAL_SECONDS = 300     # Как часто писать статистику кэша в лог
+DNS_RECONNECT_SECONDS = 2
+MAX_CACHE_TTL = 3600
+MAX_NEGATIVE_TTL = 300               # NXDOMAIN кэшируем не дольше
+
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+TYPE_OPT = 41
+
+CacheKey = Tuple[bytes, int, int]
+
+
+def _skip_name(msg: bytes, offset: int) -> int:
+    while True:
+        length = msg[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+
+
+def parse_question(msg: bytes) -> Tuple[CacheKey, int]:
+    """(имя, тип, класс) единственного вопроса и смещение за ним"""
+    try:
+        if len(msg) < 12 or struct.unpack_from("!H", msg, 4)[0] != 1:
+            raise ProtocolError("ожидается ровно один вопрос")
+        end = _skip_name(msg, 12)
+        qtype, qclass = struct.unpack_from("!HH", msg, end)
+    except (IndexError, struct.error) as e:
+        raise ProtocolError(f"некорректное DNS-сообщение: {e}") from e
+    return (bytes(msg[12:end]).lower(), qtype, qclass), end + 4
+
+
+def record_ttls(msg: bytes) -> List[Tuple[int, int]]:
+    """[(смещение поля TTL, TTL)] всех записей ответа, кроме OPT"""
+    _, offset = parse_question(msg)
+    counts = struct.unpack_from("!HHH", msg, 6)
+    ttls = []
+    try:
+        for _ in range(sum(counts)):
+            offset = _skip_name(msg, offset)
+            rtype, _, ttl, rdlength = struct.unpack_from("!HHIH", msg, offset)
+            if rtype != TYPE_OPT:
+                ttls.append((offset + 4, ttl))
+            offset += 10 + rdlength
+    except (IndexError, struct.error) as e:
+        raise ProtocolError(f"некорректный DNS-ответ: {e}") from e
+    return ttls
+
+
+class DnsCache:
+    """LRU-кэш ответов с учетом TTL; при выдаче TTL записей уменьшаются на прошедшее время"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[CacheKey, Tuple[float, float, bytes, List[Tuple[int, int]]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: CacheKey, query_id: bytes) -> Optional[bytes]:
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry is None or entry[1] <= now:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        stored_at, _, response, ttls = entry
+        self.entries.move_to_end(key)
+        self.hits += 1
+        elapsed = int(now - stored_at)
+        patched = bytearray(response)
+        patched[0:2] = query_id
+        for offset, ttl in ttls:
+            struct.pack_into("!I", patched, offset, max(ttl - elapsed, 0))
+        return bytes(patched)
+
+    def put(self, key: CacheKey, response: bytes):
+        if len(response) < 12 or response[2] & 0x02:   # TC: усеченный ответ не кэшируем
+            return
+        rcode = response[3] & 0x0F
+        if rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+            return
+        try:
+            ttls = record_ttls(response)
+        except ProtocolError:
+            return
+        if not ttls:
+            return
+        ttl = min(min(t for _, t in ttls), MAX_NEGATIVE_TTL if rcode == RCODE_NXDOMAIN else MAX_CACHE_TTL)
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        self.entries[key] = (now, now + ttl, response, ttls)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return f"кэш DNS: {len(self.entries)} записей, попаданий {self.hits}/{total} ({rate:.1f}%)"
+
+
+class DnsTunnelClient(asyncio.DatagramProtocol):
+    """Локальный DNS-листенер клиента"""
+
+    def __init__(self, open_stream: Callable[[], Awaitable[tuple]], cache: DnsCache):
+        self.open_stream = open_stream   # -> (ws, cipher) с уже принятым RESULT
+        self.cache = cache
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.queue: asyncio.Queue = asyncio.Queue(DNS_QUEUE_SIZE)
+        # ID в туннеле -> (исходный ID, адрес приложения, ключ кэша, время отправки)
+        self.pending: Dict[int, Tuple[bytes, tuple, CacheKey, float]] = {}
+        self.next_id = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            key, _ = parse_question(data)
+        except ProtocolError:
+            self.dropped += 1
+            return
+        cached = self.cache.get(key, data[:2])
+        if cached is not None:
+            self.transport.sendto(cached, addr)
+            return
+        if len(self.pending) >= DNS_QUEUE_SIZE:
+            self.dropped += 1
+            return
+        # Свой ID в туннеле: разные приложения могут прислать запросы с одинаковыми ID
+        while self.next_id in self.pending:
+            self.next_id = (self.next_id + 1) & 0xFFFF
+        tunnel_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFF
+        try:
+            self.queue.put_nowait(struct.pack("!H", tunnel_id) + data[2:])
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self.pending[tunnel_id] = (data[:2], addr, key, time.monotonic())
+
+    async def _responses(self, ws, cipher):
+        async for msg in ws:
+            if not isinstance(msg, (bytes, bytearray)):
+                continue
+            try:
+                responses = decode_batch(cipher.open(msg))
+            except ValueError as e:
+                log.warning(f"DNS: кадр отброшен: {e or 'неверный тег'}")
+                continue
+            for response in responses:
+                if len(response) < 12:
+                    continue
+                entry = self.pending.pop(struct.unpack_from("!H", response)[0], None)
+                if entry is None:
+                    continue
+                query_id, addr, key, _ = entry
+                response = query_id + response[2:]
+                self.cache.put(key, response)
+                self.transport.sendto(response, addr)
+
+    async def _send_batches(self, ws, cipher, responses: asyncio.Task):
+        while True:
+            get = asyncio.ensure_future(self.queue.get())
+            await asyncio.wait({get, responses}, return_when=asyncio.FIRST_COMPLETED)
+            if not get.done():
+                get.cancel()
+                return
+            batch = [get.result()]
+            while not self.queue.empty() and len(batch) < 256:
+                batch.append(self.queue.get_nowait())
+            await ws.send(cipher.seal(encode_batch(batch)))
+            if responses.done():
+                return
+
+    async def _expire(self):
+        last_stats = time.monotonic()
+        while True:
+            await asyncio.sleep(DNS_QUERY_TIMEOUT_SECONDS)
+            now = time.monotonic()
+            for tunnel_id in [i for i, entry in self.pending.items() if now - entry[3] > DNS_QUERY_TIMEOUT_SECONDS]:
+                del self.pending[tunnel_id]
+            if now - last_stats >= DNS_STATS_INTERVAL_SECONDS:
+                last_stats = now
+                if self.cache.hits + self.cache.misses:
+                    log.info(f"{self.cache.stats()}, отброшено запросов: {self.dropped}")
+
+    async def run(self):
+        """Держит постоянный DNS-поток, переподключаясь при обрыве"""
+        expire_task = asyncio.create_task(self._expire())
+        try:
+            while True:
+                try:
+                    ws, cipher = await self.open_stream()
+                except Exception as e:
+                    log.warning(f"DNS: не удалось открыть поток: {e!r}")
+                    await asyncio.sleep(DNS_RECONNECT_SECONDS)
+                    continue
+                responses = asyncio.create_task(self._responses(ws, cipher))
+                try:
+                    await self._send_batches(ws, cipher, responses)
+                except Exception as e:
+                    log.info(f"DNS: поток закрыт: {e!r}")
+                finally:
+                    responses.cancel()
+                    await asyncio.gather(responses, return_exceptions=True)
+                    await ws.close()
+                # Ответы на эти запросы уже не придут
+                self.pending.clear()
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+                await asyncio.sleep(DNS_RECONNECT_SECONDS)
+        finally:
+            expire_task.cancel()
+
+
+def system_resolver() -> str:
+    """Первый nameserver из /etc/resolv.conf"""
+    try:
+        with open("/etc/resolv.conf", "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == "nameserver":
+                    return parts[1]
+    except OSError:
+        pass
+    return "1.1.1.1"
+
+
+def parse_endpoint(value: str, default_port: int) -> Tuple[str, int]:
+    """'host', 'host:port', '[v6]:port' или голый IPv6"""
+    if value.startswith("["):
+        host, _, port = value[1:].partition("]:")
+        return host.rstrip("]"), int(port or default_port)
+    if value.count(":") == 1:
+        host, port = value.split(":")
+        return host, int(port)
+    return value, default_port
+
+
+class DnsRelay(asyncio.DatagramProtocol):
+    """Резолвер шлюза для одного DNS-потока клиента"""
+
+    def __init__(self, ws, cipher, upstream: Tuple[str, int]):
+        self.ws = ws
+        self.cipher = cipher
+        self.upstream = upstream
+        self.ready: List[bytes] = []
+        self.wakeup = asyncio.Event()
+        self.queries = self.answers = self.dropped = 0
+
+    def datagram_received(self, data: bytes, addr):
+        if len(self.ready) >= DNS_QUEUE_SIZE:
+            self.dropped += 1
+            return
+        self.ready.append(data)
+        self.wakeup.set()
+
+    async def _uplink(self, transport):
+        async for msg in self.ws:
+            if not isinstance(msg, (bytes, bytearray)):
+                continue
+            try:
+                queries = decode_batch(self.cipher.open(msg))
+            except ValueError as e:
+                log.debug(f"DNS: кадр отброшен: {e}")
+                continue
+            for query in queries:
+                transport.sendto(query)
+            self.queries += len(queries)
+
+    async def _downlink(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch, self.ready = self.ready, []
+            self.answers += len(batch)
+            await self.ws.send(self.cipher.seal(encode_batch(batch)))
+
+    async def run(self):
+        # "Подключенный" UDP-сокет: ядро само отбросит датаграммы не от резолвера
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: self, remote_addr=self.upstream)
+        tasks = [asyncio.create_task(self._uplink(transport)), asyncio.create_task(self._downlink())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            transport.close()
+            log.info(f"DNS: запросов {self.queries}, ответов {self.answers}, отброшено {self.dropped}")
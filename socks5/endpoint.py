@@ -0,0 +1,131 @@
+# endpoint.py
+"""Подключение клиента к шлюзу: параметры собираются один раз, TLS-сессии переиспользуются.
+
+Раньше каждое SOCKS-соединение заново разбирало URL, загружало системные сертификаты
+(ssl.create_default_context) и делало полное TLS-рукопожатие с хостом vk-tunnel.
+Теперь SSL-контекст один на процесс, а последняя TLS-сессия хоста подставляется
+в следующее рукопожатие (session resumption): без проверки цепочки сертификатов
+и с меньшим числом вычислений на обеих сторонах.
+"""
+import contextlib
+import logging
+import ssl
+import time
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urlparse
+
+import websockets
+
+from keepalive import keepalive
+from limits import Activity
+from settings import get_settings
+
+log = logging.getLogger("endpoint")
+
+RTT_SMOOTHING = 0.2   # Вес нового замера в сглаженном времени подключения
+
+
+class ResumingContext(ssl.SSLContext):
+    """SSL-контекст, подставляющий сохраненную сессию хоста в каждое клиентское рукопожатие.
+
+    asyncio не дает передать session в create_connection, но создает TLS-объект
+    через context.wrap_bio - туда сессия и подставляется.
+    """
+
+    def __init__(self, protocol: int = ssl.PROTOCOL_TLS_CLIENT):
+        self.sessions: Dict[str, ssl.SSLSession] = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side=server_side,
+                                server_hostname=server_hostname, session=session)
+
+
+def create_client_context(cafile: Optional[str] = None) -> ResumingContext:
+    """Аналог ssl.create_default_context() с кэшем сессий"""
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return context
+
+
+class Endpoint:
+    """URL шлюза и все, что нужно для подключения к нему; общий для всех потоков"""
+
+    def __init__(self, url: str, origin: Optional[str] = None, context: Optional[ResumingContext] = None):
+        parsed = urlparse(url)
+        if not parsed.scheme.startswith("ws") or not parsed.hostname:
+            raise ValueError(f"{url}: ожидается ws:// или wss:// с хостом")
+        self.url = url
+        self.host = parsed.hostname
+        self.origin = origin or f"https://{parsed.hostname}"
+        self.context = (context or create_client_context()) if parsed.scheme == "wss" else None
+        self.kwargs: dict = {}
+        self.handshakes = 0
+        self.resumed = 0
+        # Состояние для выбора туннеля (bonding.py)
+        self.active = 0               # Открытых потоков через этот адрес
+        self.rtt = 0.0                # Сглаженное время подключения, с; 0 - еще не измерено
+        self.rtt_measured = 0.0       # time.monotonic() последнего замера
+        self.failures = 0             # Неудачных подключений подряд
+        self.transferred = 0          # Байт в обе стороны
+        self.rebuild()
+
+    def rebuild(self, settings=None):
+        """Параметры из client.*; вызывается при перечитывании конфигурации (SIGHUP)"""
+        cfg = (settings or get_settings()).client
+        # ping - общий для всех WebSocket процесса (keepalive.py), а не задача на каждый
+        self.kwargs = dict(max_size=cfg.max_size, ping_interval=None, compression=None, origin=self.origin,
+                           ssl=self.context)
+
+    async def open(self, activity: Optional[Activity] = None):
+        """activity - данные потока: пока они идут, keepalive не пингует WebSocket"""
+        started = time.monotonic()
+        try:
+            ws = await websockets.connect(self.url, **self.kwargs)
+        except Exception:
+            self.failures += 1
+            raise
+        self.failures = 0
+        elapsed, self.rtt_measured = time.monotonic() - started, time.monotonic()
+        self.rtt = elapsed if not self.rtt else self.rtt * (1 - RTT_SMOOTHING) + elapsed * RTT_SMOOTHING
+        if self.context is not None:
+            self._remember_session(ws)
+        keepalive.watch(ws, activity)
+        return ws
+
+    @contextlib.contextmanager
+    def lease(self):
+        """Учет открытого потока для выбора наименее загруженного туннеля"""
+        self.active += 1
+        try:
+            yield self
+        finally:
+            self.active -= 1
+
+    @contextlib.asynccontextmanager
+    async def stream(self, activity: Optional[Activity] = None) -> AsyncIterator:
+        with self.lease():
+            ws = await self.open(activity)
+            try:
+                yield ws
+            finally:
+                await ws.close()
+
+    def _remember_session(self, ws):
+        transport = getattr(ws, "transport", None)
+        ssl_object = transport.get_extra_info("ssl_object") if transport else None
+        if ssl_object is None:
+            return
+        self.handshakes += 1
+        if ssl_object.session_reused:
+            self.resumed += 1
+        # В TLS 1.3 билет сессии приходит после рукопожатия - к ответу на Upgrade он уже получен
+        if ssl_object.session is not None:
+            self.context.sessions[self.host] = ssl_object.session
+
+    def summary(self) -> str:
+        return f"{self.url}: TLS-рукопожатий {self.handshakes}, из них возобновлено {self.resumed}"
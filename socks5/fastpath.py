@@ -0,0 +1,348 @@
+# fastpath.py
+"""Передача данных потока на протоколах asyncio: data_path = "buffered" в разделах client и server.
+
+Обычный поток - две задачи на StreamReader.read(): каждое чтение создает новый bytes,
+шифрование - еще один, и на каждый кадр приходятся переключения задач. Здесь сокет
+обслуживает asyncio.BufferedProtocol:
+    * данные читаются прямо в буфер кадра из общего пула (BufferPool) - после места под
+      заголовок и nonce, шифруются на месте и передаются в WebSocket без промежуточных копий;
+    * кадры из WebSocket расшифровываются в буфер пула и пишутся в сокет;
+    * своих задач у потока нет: чтение из сокета идет в колбэках протокола, прием из
+      WebSocket - в задаче, которая уже обслуживает соединение. Задача создается, только
+      когда надо подождать: WebSocket не успевает отправлять, действует лимит скорости
+      или кадр шифруется в пуле потоков (crypto_pool.py).
+Нужен websockets >= 13 (новая реализация asyncio); иначе, а также для сжатых и
+возобновляемых потоков используется обычный путь.
+"""
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+from websockets.protocol import State
+
+from auth import TokenBucket
+from crypto_aead_light import TAG_SIZE, FrameCipher
+from crypto_pool import crypto
+from endpoint import Endpoint
+from keepalive import Timer, wheel
+from limits import Activity
+from protocol import REP_SUCCEEDED, decode_result
+from scheduler import Flow, scheduler
+
+log = logging.getLogger("fastpath")
+
+DATA_PATHS = ("streams", "buffered")
+POOL_LIMIT = 256    # Свободных буферов одного размера, которые держим про запас
+
+
+class BufferPool:
+    """Буферы кадров одного размера; после отправки буфер сразу возвращается в пул"""
+    __slots__ = ('size', 'limit', 'free', 'created', 'reused')
+
+    def __init__(self, size: int, limit: int = POOL_LIMIT):
+        self.size = size
+        self.limit = limit
+        self.free: List[bytearray] = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self) -> bytearray:
+        if self.free:
+            self.reused += 1
+            return self.free.pop()
+        self.created += 1
+        return bytearray(self.size)
+
+    def release(self, buf: bytearray):
+        if len(self.free) < self.limit:
+            self.free.append(buf)
+
+
+_pools: Dict[int, BufferPool] = {}
+
+
+def buffer_pool(read_size: int, prefix: int) -> BufferPool:
+    """Общий пул для кадров с данными до read_size байт"""
+    size = prefix + read_size + TAG_SIZE
+    if size not in _pools:
+        _pools[size] = BufferPool(size)
+    return _pools[size]
+
+
+def supported(ws) -> bool:
+    """Можно ли писать кадры в WebSocket синхронно (websockets >= 13, asyncio)"""
+    return hasattr(ws, "send_data") and hasattr(getattr(ws, "protocol", None), "send_binary")
+
+
+def summary() -> str:
+    """Статистика пулов для лога; пусто, если data_path = "buffered" не использовался"""
+    if not _pools:
+        return ""
+    created = sum(pool.created for pool in _pools.values())
+    reused = sum(pool.reused for pool in _pools.values())
+    return f"буферы кадров: создано {created}, переиспользовано {reused}"
+
+
+class TunnelConnection(asyncio.BufferedProtocol):
+    """Сокет приложения или цели, связанный с WebSocket потока.
+
+    Сокет -> WebSocket: колбэки протокола. WebSocket -> сокет: run() в задаче соединения.
+    Чтение из сокета начинается после start(): до RESULT данные в туннель не идут.
+    """
+    __slots__ = ('ws', 'cipher', 'read_size', 'flow', 'upload', 'download', 'activity', 'meter', 'pool',
+                 'transport', 'buf', 'started', 'held', 'pending', 'write_paused', 'write_waiter', 'closing_ws', 'idle_timeout', 'idle_timer',
+                 'expired', 'expect_result')
+
+    def __init__(self, ws, cipher: FrameCipher, read_size: int, *, flow: Flow = None,
+                 upload: TokenBucket = None, download: TokenBucket = None,
+                 activity: Activity = None, meter: Endpoint = None):
+        self.ws = ws
+        self.cipher = cipher
+        self.read_size = read_size
+        self.flow = flow
+        self.upload = upload
+        self.download = download
+        self.activity = activity
+        self.meter = meter
+        self.pool = buffer_pool(read_size, cipher.prefix)
+        self.transport: Optional[asyncio.Transport] = None
+        self.buf: Optional[bytearray] = None
+        self.started = False
+        self.held = False              # Чтение остановлено до конца ожидания (лимит, буфер WebSocket, пул шифрования)
+        self.pending = b""             # Данные из start(), еще не отправленные из-за ожидания
+        self.write_paused = False
+        self.write_waiter: Optional[asyncio.Future] = None   # Создается, только когда сокет не успевает
+        self.closing_ws: Optional[asyncio.Future] = None
+        self.idle_timeout = 0.0
+        self.idle_timer: Optional[Timer] = None
+        self.expired = False
+        self.expect_result = False
+
+    # --- asyncio.BufferedProtocol ---
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.started:
+            transport.pause_reading()
+
+    def get_buffer(self, sizehint: int):
+        if self.buf is None:
+            self.buf = self.pool.acquire()
+        prefix = self.cipher.prefix
+        return memoryview(self.buf)[prefix:prefix + self.read_size]
+
+    def buffer_updated(self, nbytes: int):
+        buf, self.buf = self.buf, None
+        if self.activity:
+            self.activity.touch()
+        if crypto.offload(nbytes):
+            self._hold()
+            asyncio.ensure_future(self._seal_later(buf, nbytes))
+            return
+        frame = self.cipher.seal_into(buf, nbytes)
+        if self.flow and not scheduler.try_acquire(self.flow, len(frame)):
+            # Очередь общего лимита скорости: кадр ждет в задаче, сокет пока не читаем
+            self._hold()
+            asyncio.ensure_future(self._send_later(frame, buf, nbytes))
+            return
+        self._send(frame, buf, nbytes)
+
+    def eof_received(self):
+        self._close_ws()
+        return False
+
+    def connection_lost(self, exc):
+        if self.buf is not None:
+            self.pool.release(self.buf)
+            self.buf = None
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.resume_writing()
+        self._close_ws()
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        if self.write_waiter is not None and not self.write_waiter.done():
+            self.write_waiter.set_result(None)
+
+    # --- сокет -> WebSocket ---
+
+    def start(self, pending: bytes = b""):
+        """Начать передачу; pending - данные сокета, принятые до перехода на протокол"""
+        self.started = True
+        self.pending = pending
+        self._release()
+
+    def _hold(self):
+        self.held = True
+        self.transport.pause_reading()
+
+    def _release(self):
+        self.held = False
+        # Кадры из pending - по одному: следующий ждет, пока отправлен предыдущий
+        while self.pending and not self.held:
+            chunk, self.pending = self.pending[:self.read_size], self.pending[self.read_size:]
+            self.get_buffer(len(chunk))[:len(chunk)] = chunk
+            self.buffer_updated(len(chunk))
+        if self.held:
+            return
+        if self.started and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def _send(self, frame: memoryview, buf: bytearray, nbytes: int):
+        ws = self.ws
+        size = len(frame)
+        try:
+            if ws.protocol.state is not State.OPEN:
+                raise ConnectionError("WebSocket закрыт")
+            ws.protocol.send_binary(frame)   # Кадр сериализуется в буфер websockets (копия)
+            ws.send_data()
+        except Exception:
+            self.transport.close()
+            return
+        finally:
+            self.pool.release(buf)
+        if self.meter:
+            self.meter.transferred += size
+        delay = self.upload.take(nbytes) if self.upload else 0
+        if delay:
+            self._hold()
+            asyncio.get_running_loop().call_later(delay, self._release)
+        elif ws.paused:
+            # WebSocket не успевает отправлять: сокет не читаем, пока его буфер не освободится
+            self._hold()
+            asyncio.ensure_future(self._release_after(ws.drain()))
+
+    async def _send_later(self, frame: memoryview, buf: bytearray, nbytes: int):
+        try:
+            await scheduler.wait(self.flow, len(frame))
+        except asyncio.CancelledError:
+            self.pool.release(buf)
+            raise
+        self.held = False
+        self._send(frame, buf, nbytes)
+        if not self.held:
+            self._release()
+
+    async def _seal_later(self, buf: bytearray, nbytes: int):
+        """Большой кадр шифруется в пуле; сокет до отправки не читаем - порядок кадров сохраняется"""
+        try:
+            frame = await crypto.seal_into(self.cipher, buf, nbytes)
+            if self.flow:
+                await scheduler.acquire(self.flow, len(frame))
+        except Exception:
+            self.transport.close()   # Буфер в пул не возвращаем: поток пула мог еще не закончить с ним
+            return
+        self.held = False
+        self._send(frame, buf, nbytes)
+        if not self.held:
+            self._release()
+
+    async def _release_after(self, waiter):
+        try:
+            await waiter
+        except Exception:
+            self.transport.close()
+            return
+        self._release()
+
+    def _close_ws(self):
+        if self.closing_ws is None:
+            self.closing_ws = asyncio.ensure_future(self.ws.close())
+
+    def watch_idle(self, timeout: float):
+        """Закрыть поток после timeout секунд без кадров (общее колесо таймеров вместо задачи)"""
+        self.idle_timeout = timeout
+        self.idle_timer = wheel.call_later(timeout, self._check_idle)
+
+    def _check_idle(self, _=None):
+        left = self.activity.last + self.idle_timeout - time.monotonic()
+        if left <= 0:
+            self.expired = True
+            self.transport.close()
+            return
+        self.idle_timer = wheel.call_later(left, self._check_idle)
+
+    # --- WebSocket -> сокет ---
+
+    async def run(self, on_failure: Callable[[ValueError, int], bool], expect_result: bool = False):
+        """Прием кадров до закрытия любой из сторон.
+
+        on_failure(ошибка, подряд) - кадр не расшифрован; True - закрыть поток.
+        expect_result: первый кадр шлюза - RESULT (режим fast на клиенте).
+        """
+        pool, transport = self.pool, self.transport
+        self.expect_result = expect_result
+        failures = 0
+        try:
+            async for msg in self.ws:
+                if not isinstance(msg, (bytes, bytearray)):
+                    continue   # текстовые кадры после OPEN игнорируем
+                if self.activity:
+                    self.activity.touch()
+                if self.meter:
+                    self.meter.transferred += len(msg)
+                pooled = len(msg) <= pool.size
+                buf = pool.acquire() if pooled else bytearray(len(msg))
+                try:
+                    if crypto.offload(len(msg)):
+                        plain = await crypto.open_into(self.cipher, msg, buf)
+                    else:
+                        plain = self.cipher.open_into(msg, buf)
+                    failures = 0
+                except ValueError as e:
+                    failures += 1
+                    if pooled:
+                        pool.release(buf)
+                    if on_failure(e, failures):
+                        break
+                    continue
+                if self.expect_result:
+                    self.expect_result = False
+                    rep, _ = decode_result(plain)
+                    if pooled:
+                        pool.release(buf)
+                    if rep != REP_SUCCEEDED:
+                        log.info(f"connect failed on gateway, rep={rep}")
+                        break
+                    continue
+                if transport.is_closing():
+                    break
+                size = len(plain)
+                transport.write(plain)
+                # Что сокет не принял сразу, транспорт держит у себя - возможно, ссылкой на буфер
+                if pooled and not transport.get_write_buffer_size():
+                    pool.release(buf)
+                if self.download:
+                    delay = self.download.take(size)
+                    if delay:
+                        await asyncio.sleep(delay)
+                if self.write_paused:
+                    self.write_waiter = asyncio.get_running_loop().create_future()
+                    await self.write_waiter
+        except Exception:
+            pass
+        finally:
+            transport.close()
+            self._close_ws()
+            await asyncio.gather(self.closing_ws, return_exceptions=True)
+
+
+def take_over(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, connection: TunnelConnection) -> bytes:
+    """Перевести принятое соединение со StreamReader на TunnelConnection.
+
+    Возвращает данные, которые StreamReader уже принял, но никто не прочитал: их надо
+    передать в start(), иначе они потеряются вместе с буфером StreamReader.
+    """
+    transport = writer.transport
+    pending = bytes(reader._buffer)
+    reader._buffer.clear()
+    transport.set_protocol(connection)
+    connection.connection_made(transport)
+    if reader.at_eof():
+        connection.eof_received()
+    return pending
@@ -0,0 +1,175 @@
+# keepalive.py
+"""Общие таймеры потоков: ping WebSocket и закрытие простаивающих потоков.
+
+websockets с ping_interval держит на каждое соединение свою задачу keepalive, а простой
+потока отслеживала еще одна задача (Activity.expired). При десятках тысяч молчащих
+соединений это основная часть памяти потока. Здесь все таймеры процесса - в одном
+колесе (TimerWheel): один таймер цикла событий раз в WHEEL_TICK_SECONDS, запись
+таймера - объект с пятью слотами, вставка и отмена за O(1).
+
+Keepalive пингует WebSocket, по которому interval секунд не было данных: поток с
+трафиком и так проверяет связь. Задача создается только на время ожидания ответа;
+без ответа за timeout соединение обрывается, как у websockets.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from typing import Callable, List, Optional, Set
+
+from websockets.protocol import State
+
+from limits import Activity
+
+log = logging.getLogger("keepalive")
+
+WHEEL_TICK_SECONDS = 1.0
+WHEEL_SLOTS = 64                 # Таймеры дальше WHEEL_SLOTS тиков ждут в слоте нужное число оборотов
+CLOSED_STATES = (State.CLOSING, State.CLOSED)
+
+
+class Timer:
+    __slots__ = ('callback', 'arg', 'rounds', 'slot', 'wheel')
+
+    def __init__(self, callback: Callable, arg, rounds: int, slot: Set["Timer"], wheel: "TimerWheel"):
+        self.callback = callback
+        self.arg = arg
+        self.rounds = rounds
+        self.slot = slot
+        self.wheel = wheel
+
+    def cancel(self):
+        if self.slot is not None and self in self.slot:
+            self.slot.discard(self)
+            self.wheel.pending -= 1
+        self.slot = None
+
+
+class TimerWheel:
+    """Таймеры с точностью WHEEL_TICK_SECONDS; срабатывают не раньше срока"""
+
+    def __init__(self, tick: float = WHEEL_TICK_SECONDS, size: int = WHEEL_SLOTS):
+        self.tick = tick
+        self.slots: List[Set[Timer]] = [set() for _ in range(size)]
+        self.position = 0
+        self.pending = 0
+        self.handle: Optional[asyncio.TimerHandle] = None
+
+    def call_later(self, delay: float, callback: Callable, arg=None) -> Timer:
+        ticks = max(1, -int(-delay // self.tick))   # Округление вверх: не раньше срока
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        slot = self.slots[(self.position + 1 + offset) % len(self.slots)]
+        timer = Timer(callback, arg, rounds, slot, self)
+        slot.add(timer)
+        self.pending += 1
+        if self.handle is None:
+            self.handle = asyncio.get_running_loop().call_later(self.tick, self._advance)
+        return timer
+
+    def _advance(self):
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+        due = []
+        for timer in slot:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                due.append(timer)
+        slot.difference_update(due)
+        self.pending -= len(due)
+        self.handle = asyncio.get_running_loop().call_later(self.tick, self._advance) if self.pending else None
+        for timer in due:
+            timer.slot = None
+            try:
+                timer.callback(timer.arg)
+            except Exception:
+                log.exception("ошибка в таймере")
+
+
+wheel = TimerWheel()
+
+
+def expiry(activity: Activity, timeout: float) -> asyncio.Future:
+    """Future, который завершается после timeout секунд без активности (вместо задачи Activity.expired)"""
+    future = asyncio.get_running_loop().create_future()
+    timer = None
+
+    def check(_):
+        nonlocal timer
+        left = activity.last + timeout - time.monotonic()
+        if left <= 0:
+            future.set_result(None)
+        else:
+            timer = wheel.call_later(left, check)
+
+    timer = wheel.call_later(timeout, check)
+    # Поток закрылся раньше: таймер не должен держать его до срока
+    future.add_done_callback(lambda _: timer.cancel())
+    return future
+
+
+class Watched:
+    """WebSocket под наблюдением Keepalive; слабая ссылка - закрытый WebSocket не ждет проверки в памяти"""
+    __slots__ = ('ws', 'activity', 'pinged')
+
+    def __init__(self, ws, activity: Optional[Activity]):
+        self.ws = weakref.ref(ws)
+        self.activity = activity
+        self.pinged = time.monotonic()
+
+
+class Keepalive:
+    """ping простаивающих WebSocket вместо ping_interval в websockets"""
+
+    def __init__(self):
+        self.interval = 20.0
+        self.timeout = 20.0
+        self.watched = 0
+        self.timeouts = 0
+        self.pings: Set[asyncio.Task] = set()   # Ждущие pong; ссылка, чтобы задачу не собрал GC
+
+    def configure(self, interval: Optional[float], timeout: Optional[float]):
+        self.interval = interval or 0.0
+        self.timeout = timeout or 0.0
+
+    def watch(self, ws, activity: Optional[Activity] = None):
+        """Наблюдать ws до закрытия; activity - данные потока (без нее ping раз в interval)"""
+        if self.interval <= 0:
+            return
+        self.watched += 1
+        wheel.call_later(self.interval, self._check, Watched(ws, activity))
+
+    def _check(self, watched: Watched):
+        ws = watched.ws()
+        # interval меняется на лету: после выключения (0) наблюдение снимается, а не пингует каждый тик
+        if (ws is None or self.interval <= 0
+                or getattr(ws, "state", None) in CLOSED_STATES or ws.close_code is not None):
+            self.watched -= 1
+            return
+        last = max(watched.pinged, watched.activity.last if watched.activity else 0.0)
+        left = last + self.interval - time.monotonic()
+        if left > 0:
+            wheel.call_later(left, self._check, watched)
+            return
+        watched.pinged = time.monotonic()
+        task = asyncio.ensure_future(self._ping(ws))
+        self.pings.add(task)
+        task.add_done_callback(self.pings.discard)
+        wheel.call_later(self.interval, self._check, watched)
+
+    async def _ping(self, ws):
+        try:
+            pong = await ws.ping()
+            if self.timeout > 0:
+                await asyncio.wait_for(pong, self.timeout)
+            else:
+                await pong
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            log.debug(f"{getattr(ws, 'remote_address', None)}: нет ответа на ping за {self.timeout:.0f} с")
+            ws.transport.abort()   # Другая сторона не отвечает: ждать закрывающего рукопожатия бессмысленно
+        except Exception:
+            pass   # Соединение уже закрыто
+
+
+keepalive = Keepalive()
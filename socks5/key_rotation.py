@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# key_rotation.py
+"""Набор ключей (keyring.json) и ротация без обрыва соединений.
+
+Каждый кадр несет ID ключа, поэтому шлюз принимает и текущий, и предыдущие ключи.
+Менеджер по расписанию добавляет новый ключ и делает его текущим; старый принимается
+еще key_grace_seconds, чтобы клиенты успели получить новый. Шлюз и клиент
+перечитывают файл на лету: новые потоки берут новый ключ, открытые живут на старом.
+Ключ с истекшим периодом перекрытия перестает приниматься сразу, не дожидаясь
+следующей ротации (из файла он удаляется при ней).
+
+Формат файла:
+    {"current": 1, "keys": [{"id": 0, "key": "<32 hex>", "created": 1700000000, "retired": 1700003600},
+                            {"id": 1, "key": "<32 hex>", "created": 1700003600, "retired": null}]}
+
+На клиенте новый ключ из Telegram добавляется командой:
+    python key_rotation.py add <id>:<hex>
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from crypto_aead_light import Keyring
+from settings import BASE_DIR, get_settings
+
+log = logging.getLogger("keys")
+
+KEYRING_POLL_SECONDS = 5   # Как часто проверять, не изменился ли keyring.json
+
+
+def parse_key_spec(spec: str) -> Tuple[int, bytes]:
+    """'<id>:<hex>' или просто '<hex>' (ID 0)"""
+    key_id, sep, key_hex = spec.strip().rpartition(":")
+    key_id = int(key_id) if sep else 0
+    key = bytes.fromhex(key_hex)
+    if not 0 <= key_id <= 255 or len(key) != 16:
+        raise ValueError("ключ должен быть вида <id 0..255>:<32 hex>")
+    return key_id, key
+
+
+def format_key_spec(key_id: int, key: bytes) -> str:
+    """Обратная операция к parse_key_spec; ключ 0 - без префикса, как в старых конфигурациях"""
+    return key.hex() if key_id == 0 else f"{key_id}:{key.hex()}"
+
+
+def keyring_path(settings=None) -> str:
+    settings = settings or get_settings()
+    return os.path.join(BASE_DIR, settings.keyring_file)
+
+
+def read_entries(path: str, fallback_spec: str) -> Tuple[int, List[Dict[str, Any]]]:
+    """Записи файла; без файла - единственный ключ aes_key_hex из конфигурации"""
+    if not os.path.exists(path):
+        key_id, key = parse_key_spec(fallback_spec)
+        return key_id, [{'id': key_id, 'key': key.hex(), 'created': None, 'retired': None}]
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return int(data['current']), list(data['keys'])
+
+
+def build_keyring(current: int, entries: List[Dict[str, Any]]) -> Keyring:
+    return Keyring({int(e['id']): bytes.fromhex(e['key']) for e in entries}, current)
+
+
+def key_expired(entry: Dict[str, Any], current: int, grace_seconds: float, now: float) -> bool:
+    """Выведенный из употребления ключ, период перекрытия которого истек; текущий не истекает"""
+    retired = entry.get('retired')
+    return int(entry['id']) != current and retired is not None and now - retired > grace_seconds
+
+
+def active_entries(current: int, entries: List[Dict[str, Any]], grace_seconds: Optional[float] = None,
+                   now: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Записи, ключи которых еще принимаются"""
+    grace_seconds = get_settings().manager.key_grace_seconds if grace_seconds is None else grace_seconds
+    now = time.time() if now is None else now
+    return [e for e in entries if not key_expired(e, current, grace_seconds, now)]
+
+
+def load_keyring(path: Optional[str] = None, fallback_spec: Optional[str] = None) -> Keyring:
+    path = path or keyring_path()
+    fallback_spec = get_settings().aes_key_hex if fallback_spec is None else fallback_spec
+    current, entries = read_entries(path, fallback_spec)
+    return build_keyring(current, active_entries(current, entries))
+
+
+def write_entries(path: str, current: int, entries: List[Dict[str, Any]]):
+    """Атомарная запись: временный файл + rename, читатели не увидят половину файла"""
+    build_keyring(current, entries)  # не записываем заведомо битый набор
+    fd, tmp_path = tempfile.mkstemp(prefix=".keyring-", suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'current': current, 'keys': entries}, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _retire_and_prune(current: int, entries: List[Dict[str, Any]], grace_seconds: float,
+                      now: float) -> List[Dict[str, Any]]:
+    kept = []
+    for entry in entries:
+        if entry['id'] != current:
+            entry['retired'] = entry.get('retired') or now
+            if key_expired(entry, current, grace_seconds, now):
+                log.info(f"Ключ {entry['id']} удален из набора (истек период перекрытия)")
+                continue
+        kept.append(entry)
+    return kept
+
+
+def add_key(path: str, fallback_spec: str, key_id: int, key: bytes, grace_seconds: float,
+            now: Optional[float] = None) -> Keyring:
+    """Добавить ключ и сделать его текущим; предыдущие остаются на период перекрытия"""
+    now = time.time() if now is None else now
+    _, entries = read_entries(path, fallback_spec)
+    entries = [e for e in entries if int(e['id']) != key_id]
+    entries.append({'id': key_id, 'key': key.hex(), 'created': now, 'retired': None})
+    entries = _retire_and_prune(key_id, entries, grace_seconds, now)
+    write_entries(path, key_id, entries)
+    return build_keyring(key_id, entries)
+
+
+def rotate_keyring(path: str, fallback_spec: str, grace_seconds: float) -> Tuple[int, bytes]:
+    """Сгенерировать новый ключ со следующим свободным ID"""
+    current, entries = read_entries(path, fallback_spec)
+    used = {int(e['id']) for e in entries}
+    key_id = next(i % 256 for i in range(current + 1, current + 257) if i % 256 not in used)
+    key = os.urandom(16)
+    add_key(path, fallback_spec, key_id, key, grace_seconds)
+    log.info(f"Ротация ключей: текущий ключ {current} -> {key_id}")
+    return key_id, key
+
+
+def newest_key_created(path: str, fallback_spec: str) -> Optional[float]:
+    """Когда создан самый новый ключ набора.
+
+    Ключ из конфигурации (файла еще нет) записывается в набор с текущим временем: срок
+    плановой ротации отсчитывается от него и не сдвигается при перезапуске менеджера.
+    """
+    if not os.path.exists(path):
+        current, entries = read_entries(path, fallback_spec)
+        entries[0]['created'] = time.time()
+        write_entries(path, current, entries)
+    _, entries = read_entries(path, fallback_spec)
+    return max((e['created'] for e in entries if e.get('created') is not None), default=None)
+
+
+class KeyringWatcher:
+    """Кэшированный набор ключей, перечитываемый при изменении файла"""
+
+    def __init__(self, path: Optional[str] = None, fallback_spec: Optional[str] = None):
+        self.path = path or keyring_path()
+        self.fallback_spec = get_settings().aes_key_hex if fallback_spec is None else fallback_spec
+        self._mtime = self._file_mtime()
+        self.expires_at: Optional[float] = None   # Когда истечет период перекрытия ближайшего старого ключа
+        self.keyring = self._load()
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def _load(self) -> Keyring:
+        """Набор без ключей с истекшим периодом перекрытия (key_grace_seconds читается заново)"""
+        current, entries = read_entries(self.path, self.fallback_spec)
+        grace = get_settings().manager.key_grace_seconds
+        active = active_entries(current, entries, grace)
+        self.expires_at = min((e['retired'] + grace for e in active
+                               if int(e['id']) != current and e.get('retired') is not None), default=None)
+        return build_keyring(current, active)
+
+    def check(self) -> bool:
+        """Перечитать файл, если он изменился или истек период перекрытия; True - набор ключей обновлен"""
+        mtime = self._file_mtime()
+        expired = self.expires_at is not None and time.time() > self.expires_at
+        if mtime == self._mtime and not expired:
+            return False
+        self._mtime = mtime
+        try:
+            keyring = self._load()
+        except Exception as e:
+            log.error(f"Не удалось перечитать {self.path}, остается текущий набор ключей: {e}")
+            return False
+        if keyring.current_id != self.keyring.current_id:
+            log.info(f"Текущий ключ: {self.keyring.current_id} -> {keyring.current_id}")
+        dropped = set(self.keyring.keys) - set(keyring.keys)
+        if dropped:
+            log.info(f"Ключи {sorted(dropped)} больше не принимаются (истек период перекрытия или удалены)")
+        self.keyring = keyring
+        log.info(f"Набор ключей перечитан: {sorted(keyring.keys)}")
+        return True
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(KEYRING_POLL_SECONDS)
+            self.check()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Управление набором ключей keyring.json")
+    sub = ap.add_subparsers(dest="command", required=True)
+    add = sub.add_parser("add", help="добавить ключ <id>:<hex> и сделать его текущим")
+    add.add_argument("spec")
+    sub.add_parser("rotate", help="сгенерировать новый текущий ключ")
+    sub.add_parser("show", help="показать ID ключей и текущий ключ")
+    args = ap.parse_args()
+
+    settings = get_settings()
+    path = keyring_path(settings)
+    grace = settings.manager.key_grace_seconds
+    if args.command == "add":
+        key_id, key = parse_key_spec(args.spec)
+        add_key(path, settings.aes_key_hex, key_id, key, grace)
+    elif args.command == "rotate":
+        rotate_keyring(path, settings.aes_key_hex, grace)
+    keyring = load_keyring(path, settings.aes_key_hex)
+    print(f"Ключи: {sorted(keyring.keys)}; текущий: "
+          f"{format_key_spec(keyring.current_id, keyring.key(keyring.current_id))}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except (ValueError, KeyError, OSError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        sys.exit(1)
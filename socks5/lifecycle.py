@@ -0,0 +1,119 @@
+# lifecycle.py
+"""Жизненный цикл шлюза: PID-файл и плавная остановка (drain) по SIGTERM.
+
+Перезапуск без разрыва соединений (/restart-server):
+  1. новый server.py слушает тот же порт (SO_REUSEPORT) и записывает свой PID в PID-файл;
+  2. старый получает SIGTERM, перестает принимать соединения и ждет, пока открытые
+     потоки закончатся сами, но не дольше server.drain_timeout;
+  3. оставшиеся потоки закрываются с кодом 1001 (going away), PID-файл остается за новым.
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+from typing import Awaitable, Callable, Optional, Set
+
+from settings import BASE_DIR, get_settings
+
+log = logging.getLogger("lifecycle")
+
+DRAIN_REPORT_SECONDS = 5    # Как часто писать в лог, сколько потоков еще открыто
+BIND_RETRY_SECONDS = 30     # Сколько ждать порт, если старый экземпляр запущен без SO_REUSEPORT
+
+
+def pid_file_path(settings=None) -> str:
+    settings = settings or get_settings()
+    return os.path.join(BASE_DIR, settings.server.pid_file)
+
+
+def read_pid(path: str) -> Optional[int]:
+    try:
+        with open(path, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def write_pid(path: str, pid: int):
+    """Атомарная запись: читатель не увидит пустой файл"""
+    tmp = f"{path}.{pid}.tmp"
+    with open(tmp, "w") as f:
+        f.write(f"{pid}\n")
+    os.replace(tmp, path)
+
+
+def release_pid(path: str, pid: int):
+    """Удалить PID-файл, только если он все еще наш (новый экземпляр мог его перезаписать)"""
+    if read_pid(path) == pid:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Drain:
+    """Учет открытых потоков и плавная остановка сервера websockets"""
+
+    def __init__(self):
+        self.streams: Set[asyncio.Task] = set()
+        self.stopping = asyncio.Event()
+
+    def track(self, handler: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+        async def tracked(ws, *args):
+            task = asyncio.current_task()
+            self.streams.add(task)
+            try:
+                await handler(ws, *args)
+            finally:
+                self.streams.discard(task)
+        return tracked
+
+    def install_signal(self):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stopping.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async def run(self, server, timeout: float):
+        """Дождаться SIGTERM и остановить server, дав потокам до timeout секунд"""
+        await self.stopping.wait()
+        # Только слушающий сокет: открытые соединения продолжают работать
+        server.server.close()
+        log.info(f"SIGTERM: новые соединения не принимаются, открытых потоков: {len(self.streams)}, "
+                 f"ждем до {timeout:.0f} с")
+        deadline = time.monotonic() + timeout
+        while self.streams:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            await asyncio.wait(set(self.streams), timeout=min(left, DRAIN_REPORT_SECONDS))
+            if self.streams:
+                log.info(f"drain: открытых потоков {len(self.streams)}, осталось {max(deadline - time.monotonic(), 0):.0f} с")
+        if self.streams:
+            log.warning(f"drain: время вышло, закрываем {len(self.streams)} потоков")
+        server.close()
+        await server.wait_closed()
+
+
+async def serve_with_retry(serve: Callable[[], Awaitable]):
+    """Запуск сервера; порт может быть еще занят старым экземпляром без SO_REUSEPORT"""
+    deadline = time.monotonic() + BIND_RETRY_SECONDS
+    while True:
+        try:
+            return await serve()
+        except OSError as e:
+            if time.monotonic() >= deadline:
+                raise
+            log.warning(f"порт занят ({e}), повтор через 1 с")
+            await asyncio.sleep(1)
@@ -0,0 +1,265 @@
+# limits.py
+"""Ограничения ресурсов шлюза: допуск соединений, число потоков (всего и на источник) и простой.
+
+При перегрузке шлюз не замедляется для всех: поток сверх лимита сразу закрывается
+с кодом 1013 (try again later), а уже открытые работают как раньше. Лимит по умолчанию
+считается от лимита файловых дескрипторов процесса (каждый поток - это WebSocket
+и сокет к цели) и от свободной памяти.
+
+Бюджет памяти потока - STREAM_MEMORY_BYTES. Замер bench.py idle (Python 3.11, websockets 17,
+RSS на молчащее соединение): шлюз 19 КБ с data_path = "buffered" и 25 КБ с трубами,
+клиент 22 и 24 КБ. Основное - объекты websockets (соединение, протокол, заголовки
+рукопожатия) и задачи asyncio; у потока нет своих задач keepalive и таймеров простоя
+(keepalive.py). Буферы сокетов ядра в RSS не входят.
+
+Допуск (Admission) срабатывает еще до перехода на WebSocket, в process_request: источник,
+открывающий соединения быстрее server.conn_rate_per_ip, и переполненная очередь ожидающих
+OPEN получают HTTP 429/503 без шифрования и подключений к цели. Срок на OPEN сокращается
+по мере заполнения очереди, поэтому пачка "молчащих" соединений долго ее не держит.
+
+Источник берется из X-Forwarded-For, только если соединение пришло от доверенного прокси
+(loopback или server.trusted_proxies): прокси дописывает адрес справа, а все левее написал
+сам клиент. Поэтому адрес - самый правый в цепочке, не принадлежащий доверенному прокси.
+"""
+import ipaddress
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+FDS_PER_STREAM = 2
+FDS_RESERVED = 64          # Логи, keyring, UDP- и DNS-сокеты
+RATE_TABLE_SIZE = 4096     # Источников в LRU ограничителя темпа
+RATE_BURST_SECONDS = 2.0   # Всплеск, который ограничитель прощает
+RATE_IPV6_PREFIX = 64      # IPv6-адреса одной сети /64 делят ведро: у хоста их миллионы
+MIN_OPEN_DEADLINE = 0.5    # Срок на OPEN при почти полной очереди
+STREAM_MEMORY_BYTES = 32 * 1024   # Бюджет молчащего потока с запасом (см. замер выше)
+STREAM_MEMORY_SHARE = 0.5         # Доля свободной при старте памяти, которую могут занять потоки
+
+
+def available_memory() -> Optional[int]:
+    """MemAvailable из /proc/meminfo; None вне Linux"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def default_max_streams() -> int:
+    if resource is None:
+        by_fds = 4096
+    else:
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        by_fds = 65536 if soft == resource.RLIM_INFINITY else (soft - FDS_RESERVED) // FDS_PER_STREAM
+    memory = available_memory()
+    by_memory = int(memory * STREAM_MEMORY_SHARE) // STREAM_MEMORY_BYTES if memory else by_fds
+    return max(min(by_fds, by_memory), 16)
+
+
+class TrustedProxies:
+    """Прокси, чьим заголовкам X-Forwarded-For / X-Real-IP можно верить; loopback доверен всегда"""
+
+    def __init__(self):
+        self.networks: List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]] = []
+
+    def configure(self, entries: List[str]):
+        networks = []
+        for entry in entries:
+            try:
+                networks.append(ipaddress.ip_network(str(entry).strip(), strict=False))
+            except ValueError as e:
+                raise ValueError(f"server.trusted_proxies: {e}") from e
+        self.networks = networks
+
+    def trusted(self, address: str) -> bool:
+        try:
+            ip = ipaddress.ip_address(address.strip().strip("[]"))
+        except ValueError:
+            return False
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        return ip.is_loopback or any(ip in network for network in self.networks)
+
+    def source(self, headers, remote_address) -> str:
+        remote = str(remote_address[0]) if remote_address else "?"
+        if headers is None or not self.trusted(remote):
+            return remote
+        forwarded = headers.get("X-Forwarded-For")
+        if forwarded:
+            hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+            # Справа налево до первого адреса, который дописал не наш прокси
+            for hop in reversed(hops):
+                if not self.trusted(hop):
+                    return hop
+            return hops[0] if hops else remote
+        return (headers.get("X-Real-IP") or "").strip() or remote
+
+
+proxies = TrustedProxies()
+
+
+def source_address(headers, remote_address) -> str:
+    """Источник соединения: за vk-tunnel все соединения локальные, поэтому адрес из X-Forwarded-For"""
+    return proxies.source(headers, remote_address)
+
+
+def rate_key(source: str) -> str:
+    """Ключ ограничителя темпа: IPv4-адрес как есть, IPv6 - его сеть /RATE_IPV6_PREFIX"""
+    try:
+        ip = ipaddress.ip_address(source)
+    except ValueError:
+        return source
+    if ip.version == 4:
+        return str(ip)
+    if ip.ipv4_mapped:
+        return str(ip.ipv4_mapped)
+    return str(ipaddress.ip_network(f"{ip}/{RATE_IPV6_PREFIX}", strict=False))
+
+
+def peer_key(ws) -> str:
+    headers = getattr(getattr(ws, "request", None), "headers", None) or getattr(ws, "request_headers", None)
+    return source_address(headers, getattr(ws, "remote_address", None))
+
+
+class StreamLimits:
+    def __init__(self):
+        self.max_streams = default_max_streams()
+        self.max_per_peer = 0
+        self.active = 0
+        self.by_peer: Dict[str, int] = {}
+        self.rejected = 0
+        self.reaped = 0
+
+    def configure(self, max_streams: int, max_per_peer: int):
+        self.max_streams = max_streams or default_max_streams()
+        self.max_per_peer = max_per_peer
+
+    def acquire(self, peer: str) -> Optional[str]:
+        """None - поток принят, иначе причина отказа"""
+        if self.active >= self.max_streams:
+            self.rejected += 1
+            return "server busy"
+        if self.max_per_peer and self.by_peer.get(peer, 0) >= self.max_per_peer:
+            self.rejected += 1
+            return "too many streams"
+        self.active += 1
+        self.by_peer[peer] = self.by_peer.get(peer, 0) + 1
+        return None
+
+    def release(self, peer: str):
+        self.active -= 1
+        left = self.by_peer[peer] - 1
+        if left:
+            self.by_peer[peer] = left
+        else:
+            del self.by_peer[peer]
+
+    def summary(self) -> str:
+        return (f"потоков {self.active}/{self.max_streams}, источников {len(self.by_peer)}, "
+                f"отклонено {self.rejected}, закрыто по простою {self.reaped}")
+
+
+class RateLimiter:
+    """Темп новых соединений с одного адреса: ведро токенов на адрес, адреса в LRU"""
+
+    def __init__(self, max_sources: int = RATE_TABLE_SIZE):
+        self.max_sources = max_sources
+        self.rate = 0.0
+        self.buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()   # адрес -> (токены, время)
+        self.offenders: "OrderedDict[str, int]" = OrderedDict()                 # адрес -> отказов
+
+    def allow(self, source: str) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        burst = self.rate * RATE_BURST_SECONDS
+        tokens, updated = self.buckets.pop(source, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        self.buckets[source] = (tokens - 1 if allowed else tokens, now)
+        if len(self.buckets) > self.max_sources:
+            self.buckets.popitem(last=False)   # давно не появлявшийся адрес начнет с полного ведра
+        if not allowed:
+            self.offenders[source] = self.offenders.pop(source, 0) + 1
+            if len(self.offenders) > self.max_sources:
+                self.offenders.popitem(last=False)
+        return allowed
+
+    def top_offenders(self, count: int = 3) -> str:
+        worst = sorted(self.offenders.items(), key=lambda item: item[1], reverse=True)[:count]
+        return ", ".join(f"{source} ({rejected})" for source, rejected in worst)
+
+
+class Admission:
+    """Допуск соединений до WebSocket-рукопожатия и срок на OPEN"""
+
+    def __init__(self):
+        self.max_pending = 256
+        self.open_deadline = 5.0
+        self.rate = RateLimiter()
+        self.pending = 0
+        self.rejected_rate = 0
+        self.rejected_pending = 0
+        self.open_timeouts = 0
+
+    def configure(self, max_pending: int, open_deadline: float, conn_rate_per_ip: float):
+        self.max_pending = max_pending
+        self.open_deadline = open_deadline
+        self.rate.rate = conn_rate_per_ip
+
+    def check(self, source: Optional[str]) -> Optional[Tuple[HTTPStatus, str]]:
+        """None - пускаем, иначе HTTP-ответ отказа; без известного источника темп не ограничивается"""
+        if self.max_pending and self.pending >= self.max_pending:
+            self.rejected_pending += 1
+            return HTTPStatus.SERVICE_UNAVAILABLE, "Server busy\n"
+        if source is not None and not self.rate.allow(rate_key(source)):
+            self.rejected_rate += 1
+            return HTTPStatus.TOO_MANY_REQUESTS, "Too many connections\n"
+        return None
+
+    def process_request(self, connection, request):
+        """Хук websockets.serve: отказ обходится в один HTTP-ответ, без шифрования и подключений.
+
+        Новый API websockets вызывает его с (connection, request), старый - с (path, headers).
+        Темп считается по тому же источнику, что и лимит потоков (source_address): заголовкам
+        клиента без доверенного прокси не верим. Старый API адреса соединения не передает,
+        поэтому там работает только очередь ожидающих.
+        """
+        if hasattr(request, "headers"):
+            refused = self.check(source_address(request.headers, connection.remote_address))
+            return connection.respond(*refused) if refused else None
+        refused = self.check(None)
+        return (refused[0], [], refused[1].encode()) if refused else None
+
+    def deadline(self) -> float:
+        """Срок на OPEN: чем полнее очередь ожидающих, тем короче"""
+        if not self.max_pending:
+            return self.open_deadline
+        free = 1 - self.pending / self.max_pending
+        return max(self.open_deadline * free, min(MIN_OPEN_DEADLINE, self.open_deadline))
+
+    def summary(self) -> str:
+        text = (f"ждут OPEN {self.pending}/{self.max_pending}, отказов: темп {self.rejected_rate}, "
+                f"очередь {self.rejected_pending}, без OPEN {self.open_timeouts}")
+        offenders = self.rate.top_offenders()
+        return f"{text}; чаще всех: {offenders}" if offenders else text
+
+
+class Activity:
+    """Время последнего кадра в любую сторону; обе трубы потока обновляют один объект"""
+    __slots__ = ('last',)
+
+    def __init__(self):
+        self.last = time.monotonic()
+
+    def touch(self):
+        self.last = time.monotonic()
@@ -0,0 +1,210 @@
+# protocol.py
+"""Бинарный протокол потока между client.py и server.py.
+
+Все кадры передаются зашифрованными (FrameCipher), первый байт кадра - ID ключа.
+
+    OPEN   (клиент -> шлюз, первый кадр потока):
+           version(1) | flags(1) | atyp(1) | адрес | port(2) | ранние данные...
+    RESULT (шлюз -> клиент, первый кадр ответа): rep(1) [| codecs(1)] - код ответа SOCKS5
+           и маска кодеков сжатия, которые шлюз умеет распаковать (если клиент просил сжатие);
+           для возобновляемого потока еще session_id(16) | received(8) (см. resume.py)
+    DATA   все остальные кадры - полезная нагрузка как есть
+    DGRAM  в UDP-ассоциации (флаг FLAG_UDP в OPEN) вместо DATA: atyp | адрес | port | датаграмма
+    BATCH  в DNS-потоке (флаг FLAG_DNS в OPEN) вместо DATA: (len(2) | DNS-сообщение)...
+
+Адрес кодируется как в SOCKS5 (atyp 1 - IPv4, 3 - домен с байтом длины, 4 - IPv6),
+поэтому клиенту не нужно разбирать и заново собирать адрес из запроса.
+Ранние данные (например, TLS ClientHello) уходят вместе с OPEN и экономят кадр на поток.
+"""
+import asyncio
+import errno
+import socket
+import struct
+from typing import List, NamedTuple, Optional, Tuple
+
+OPEN_VERSION = 1
+
+# Флаги OPEN
+FLAG_UDP = 0x01     # UDP ASSOCIATE: поток несет датаграммы с адресом, а не байтовый поток
+FLAG_DNS = 0x02     # Постоянный поток DNS-запросов к резолверу шлюза
+FLAG_COMPRESS_ZLIB = 0x04   # DATA-кадры с байтом кодека (compression.py); клиент предпочитает zlib
+FLAG_COMPRESS_ZSTD = 0x08   # ... или zstd
+FLAG_COMPRESS = FLAG_COMPRESS_ZLIB | FLAG_COMPRESS_ZSTD
+FLAG_RESUMABLE = 0x10      # Поток переживает обрыв WebSocket (resume.py)
+FLAG_RESUME = 0x20         # Продолжение потока: ранние данные - session_id(16) | received(8)
+FLAG_JOIN = 0x40           # Еще один WebSocket для потока (bonding.py): ранние данные как у FLAG_RESUME
+
+# Команды SOCKS5
+CMD_CONNECT = 0x01
+CMD_UDP_ASSOCIATE = 0x03
+
+ATYP_IPV4 = 0x01
+ATYP_DOMAIN = 0x03
+ATYP_IPV6 = 0x04
+
+# Коды ответа SOCKS5 (RFC 1928)
+REP_SUCCEEDED = 0x00
+REP_GENERAL_FAILURE = 0x01
+REP_NOT_ALLOWED = 0x02
+REP_NETWORK_UNREACHABLE = 0x03
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_TTL_EXPIRED = 0x06
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRESS_NOT_SUPPORTED = 0x08
+
+# Код закрытия WebSocket: шлюз перегружен, поток отклонен до OPEN (limits.py)
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class OpenRequest(NamedTuple):
+    addr: str
+    port: int
+    flags: int
+    early_data: bytes
+
+
+def encode_address(addr: str, port: int) -> bytes:
+    """atyp | адрес | port"""
+    for family, atyp in ((socket.AF_INET, ATYP_IPV4), (socket.AF_INET6, ATYP_IPV6)):
+        try:
+            return bytes([atyp]) + socket.inet_pton(family, addr) + struct.pack("!H", port)
+        except OSError:
+            pass
+    name = addr.encode("idna")
+    if not 0 < len(name) <= 255:
+        raise ProtocolError(f"недопустимая длина имени: {addr!r}")
+    return bytes([ATYP_DOMAIN, len(name)]) + name + struct.pack("!H", port)
+
+
+def decode_address(buf: bytes, offset: int = 0) -> Tuple[str, int, int]:
+    """(адрес, порт, смещение за адресом)"""
+    try:
+        atyp = buf[offset]
+        if atyp == ATYP_IPV4:
+            end = offset + 5
+            addr = socket.inet_ntop(socket.AF_INET, bytes(buf[offset + 1:end]))
+        elif atyp == ATYP_IPV6:
+            end = offset + 17
+            addr = socket.inet_ntop(socket.AF_INET6, bytes(buf[offset + 1:end]))
+        elif atyp == ATYP_DOMAIN:
+            end = offset + 2 + buf[offset + 1]
+            addr = bytes(buf[offset + 2:end]).decode("utf-8", "ignore")
+        else:
+            raise ProtocolError(f"неизвестный тип адреса {atyp}")
+        (port,) = struct.unpack_from("!H", buf, end)
+    except (IndexError, ValueError, struct.error) as e:
+        raise ProtocolError(f"обрезанный адрес: {e}") from e
+    return addr, port, end + 2
+
+
+def encode_open(addr: str, port: int, flags: int = 0, early_data: bytes = b"") -> bytes:
+    return bytes([OPEN_VERSION, flags]) + encode_address(addr, port) + early_data
+
+
+def decode_open(plain: bytes) -> OpenRequest:
+    if len(plain) < 2 or plain[0] != OPEN_VERSION:
+        raise ProtocolError("неизвестная версия OPEN")
+    addr, port, offset = decode_address(plain, 2)
+    return OpenRequest(addr, port, plain[1], bytes(plain[offset:]))
+
+
+def encode_result(rep: int, codecs: int = 0) -> bytes:
+    return bytes([rep, codecs]) if codecs else bytes([rep])
+
+
+def decode_result(plain: bytes) -> Tuple[int, int]:
+    """(код ответа SOCKS5, маска кодеков шлюза)"""
+    if len(plain) not in (1, 2):
+        raise ProtocolError("некорректный RESULT")
+    return plain[0], plain[1] if len(plain) == 2 else 0
+
+
+def encode_resume_result(rep: int, codecs: int, session_id: bytes, received: int) -> bytes:
+    return bytes([rep, codecs]) + session_id + struct.pack("!Q", received)
+
+
+def decode_resume_result(plain: bytes) -> Tuple[int, int, bytes, int]:
+    """(код ответа, маска кодеков, ID сессии, сколько байт потока получил шлюз)"""
+    if len(plain) == 26:
+        return plain[0], plain[1], bytes(plain[2:18]), struct.unpack_from("!Q", plain, 18)[0]
+    rep, codecs = decode_result(plain)
+    if rep == REP_SUCCEEDED:
+        raise ProtocolError("шлюз не поддерживает возобновляемые потоки")
+    return rep, codecs, b"", 0
+
+
+def encode_resume(session_id: bytes, received: int) -> bytes:
+    return session_id + struct.pack("!Q", received)
+
+
+def decode_resume(early_data: bytes) -> Tuple[bytes, int]:
+    if len(early_data) != 24:
+        raise ProtocolError("некорректный запрос продолжения потока")
+    return bytes(early_data[:16]), struct.unpack_from("!Q", early_data, 16)[0]
+
+
+def encode_datagram(addr: str, port: int, payload: bytes) -> bytes:
+    return encode_address(addr, port) + payload
+
+
+def decode_datagram(plain: bytes) -> Tuple[str, int, bytes]:
+    addr, port, offset = decode_address(plain)
+    return addr, port, bytes(plain[offset:])
+
+
+def encode_batch(messages: List[bytes]) -> bytes:
+    return b"".join(struct.pack("!H", len(m)) + m for m in messages)
+
+
+def decode_batch(plain: bytes) -> List[bytes]:
+    messages, offset = [], 0
+    while offset < len(plain):
+        if offset + 2 > len(plain):
+            raise ProtocolError("обрезанный пакет сообщений")
+        (length,) = struct.unpack_from("!H", plain, offset)
+        offset += 2
+        if offset + length > len(plain):
+            raise ProtocolError("обрезанный пакет сообщений")
+        messages.append(bytes(plain[offset:offset + length]))
+        offset += length
+    return messages
+
+
+def parse_socks_udp(packet: bytes) -> Tuple[str, int, bytes]:
+    """Заголовок UDP-запроса SOCKS5: RSV(2) | FRAG(1) | atyp | адрес | port | данные"""
+    if len(packet) < 4 or packet[2] != 0:
+        raise ProtocolError("фрагментированные датаграммы SOCKS5 не поддерживаются")
+    addr, port, offset = decode_address(packet, 3)
+    return addr, port, packet[offset:]
+
+
+def build_socks_udp(addr: str, port: int, payload: bytes) -> bytes:
+    return b"\x00\x00\x00" + encode_address(addr, port) + payload
+
+
+def socks_reply(rep: int, bind: Optional[Tuple[str, int]] = None) -> bytes:
+    """Ответ на запрос SOCKS5; адрес привязки сообщаем только для UDP ASSOCIATE"""
+    if bind is None:
+        return b"\x05" + bytes([rep]) + b"\x00\x01\x00\x00\x00\x00\x00\x00"
+    return b"\x05" + bytes([rep]) + b"\x00" + encode_address(bind[0], bind[1])
+
+
+def rep_for_error(exc: BaseException) -> int:
+    """Код ответа SOCKS5 для ошибки подключения к цели"""
+    if isinstance(exc, socket.gaierror):
+        return REP_HOST_UNREACHABLE
+    if isinstance(exc, ConnectionRefusedError):
+        return REP_CONNECTION_REFUSED
+    if isinstance(exc, (TimeoutError, asyncio.TimeoutError, socket.timeout)):
+        return REP_TTL_EXPIRED
+    if isinstance(exc, OSError):
+        if exc.errno == errno.ENETUNREACH:
+            return REP_NETWORK_UNREACHABLE
+        if exc.errno in (errno.EHOSTUNREACH, errno.EHOSTDOWN):
+            return REP_HOST_UNREACHABLE
+    return REP_GENERAL_FAILURE
@@ -0,0 +1,378 @@
+# resume.py
+"""Возобновляемые потоки: соединение приложения переживает обрыв WebSocket.
+
+Поток с флагом FLAG_RESUMABLE вместо DATA-кадров обменивается сегментами:
+    DATA  kind(1)=0 | offset(8) | данные
+    ACK   kind(1)=1 | received(8)       - сколько байт потока получено подряд
+    FIN   kind(1)=2 | offset(8)         - конец потока, занимает 1 байт в нумерации
+Отправленные, но не подтвержденные сегменты хранятся в буфере (не больше resume_buffer
+байт - дальше чтение из TCP приостанавливается). При обрыве шлюз держит сокет к цели
+resume_grace секунд, а клиент переподключается (в том числе на новый адрес из discovery)
+и присылает OPEN с FLAG_RESUME: ID сессии и сколько байт он получил. Обе стороны
+повторяют сегменты начиная с того, что получила другая, - поток продолжается байт в байт.
+
+К сессии можно присоединить несколько WebSocket (FLAG_JOIN, bonding.py): сегменты
+расходятся по ним, получатель собирает их по смещениям; при потере одного из них
+неподтвержденное повторяется через оставшиеся.
+"""
+import asyncio
+import logging
+import os
+import struct
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Tuple
+
+from compression import StreamCompressor, StreamDecompressor
+from crypto_aead_light import FrameCipher
+from crypto_pool import crypto
+from protocol import ProtocolError
+from scheduler import Flow, scheduler
+
+log = logging.getLogger("resume")
+
+KIND_DATA = 0
+KIND_ACK = 1
+KIND_FIN = 2
+
+SESSION_ID_SIZE = 16
+
+# Чем закончилась работа с одним WebSocket
+OUTCOME_FINISHED = "finished"   # Поток завершен (FIN получен или подтвержден)
+OUTCOME_DROPPED = "dropped"     # Обрыв - можно продолжить на новом WebSocket
+
+_HEADER = struct.Struct("!BQ")
+REORDER_LIMIT_FACTOR = 4   # Сегментов не по порядку держим не больше 4 * resume_buffer_bytes
+
+
+class ResumeError(Exception):
+    pass
+
+
+def new_session_id() -> bytes:
+    return os.urandom(SESSION_ID_SIZE)
+
+
+class StreamSession:
+    """Состояние одной стороны возобновляемого потока"""
+    __slots__ = ('session_id', 'cipher', 'buffer_limit', 'links', 'link_closed', 'inflight', 'changed', 'next_link',
+                 'sent', 'acked', 'received', 'ack_sent', 'buffer', 'buffered', 'space', 'reorder', 'reordered',
+                 'fin_sent', 'fin_received', 'resumed', 'resumes')
+
+    def __init__(self, session_id: bytes, cipher: FrameCipher, buffer_limit: int):
+        self.session_id = session_id
+        self.cipher = cipher
+        self.buffer_limit = buffer_limit
+        self.links: Dict[Any, Any] = {}   # WebSocket -> Endpoint для учета трафика (на шлюзе None)
+        self.link_closed: Dict[Any, asyncio.Event] = {}
+        self.inflight: Dict[Any, int] = {}   # Неподтвержденных байт, ушедших через WebSocket
+        self.changed = asyncio.Event()    # Присоединен новый WebSocket
+        self.next_link = 0
+        self.sent = 0                 # Байт потока отправлено (включая FIN)
+        self.acked = 0                # Подтверждено другой стороной
+        self.received = 0             # Получено подряд
+        self.ack_sent = 0
+        self.buffer: Deque[list] = deque()   # [offset, kind, данные, WebSocket последней отправки]
+        self.buffered = 0
+        self.space = asyncio.Event()
+        self.space.set()
+        self.reorder: Dict[int, Tuple[int, bytes]] = {}   # offset -> (kind, данные), пришедшие раньше времени
+        self.reordered = 0
+        self.fin_sent = False
+        self.fin_received = False
+        self.resumed = asyncio.Event()
+        self.resumes = 0
+
+    @property
+    def ws(self):
+        return next(iter(self.links), None)
+
+    # --- отправка ---
+
+    def _pick_link(self):
+        """WebSocket с наименьшим объемом неподтвержденных данных: медленный туннель
+        дольше держит свои сегменты и получает меньше новых; при равенстве - по кругу"""
+        links = list(self.links)
+        if len(links) == 1:
+            return links[0]
+        self.next_link = (self.next_link + 1) % len(links)
+        ordered = links[self.next_link:] + links[:self.next_link]
+        return min(ordered, key=lambda ws: self.inflight.get(ws, 0))
+
+    async def _transmit(self, kind: int, offset: int, payload: bytes = b"", entry: list = None):
+        if not self.links:
+            return
+        ws = self._pick_link()
+        if entry is not None:
+            self._account(entry, ws)
+        try:
+            await ws.send(await crypto.seal(self.cipher, _HEADER.pack(kind, offset) + payload))
+        except Exception:
+            self.detach(ws)   # Сегмент остался в буфере и уйдет после возобновления
+            return
+        meter = self.links.get(ws)
+        if meter is not None:
+            meter.transferred += len(payload)
+
+    def _account(self, entry: list, ws):
+        previous = entry[3]
+        if previous is not None and previous in self.inflight:
+            self.inflight[previous] -= len(entry[2])
+        entry[3] = ws
+        if ws in self.inflight:
+            self.inflight[ws] += len(entry[2])
+
+    async def send_data(self, payload: bytes):
+        while self.buffered >= self.buffer_limit:
+            self.space.clear()
+            await self.space.wait()   # Ждем ACK: другая сторона отстает или связи нет
+        offset = self.sent
+        self.sent += len(payload)
+        entry = [offset, KIND_DATA, payload, None]
+        self.buffer.append(entry)
+        self.buffered += len(payload)
+        await self._transmit(KIND_DATA, offset, payload, entry)
+
+    async def send_fin(self):
+        if self.fin_sent:
+            return
+        self.fin_sent = True
+        offset = self.sent
+        self.sent += 1
+        self.buffer.append([offset, KIND_FIN, b"", None])
+        await self._transmit(KIND_FIN, offset)
+
+    async def send_ack(self):
+        self.ack_sent = self.received
+        await self._transmit(KIND_ACK, self.received)
+
+    async def retransmit(self):
+        """Повторить неподтвержденное через оставшиеся WebSocket (часть могла уйти в потерянный)"""
+        for entry in list(self.buffer):
+            if entry[0] >= self.acked:
+                await self._transmit(entry[1], entry[0], entry[2], entry)
+
+    def _on_ack(self, received: int):
+        if not self.acked <= received <= self.sent:
+            if received < self.acked:
+                return   # Старый ACK, пришедший другим WebSocket
+            raise ProtocolError(f"ACK {received} вне отправленного ({self.acked}..{self.sent})")
+        self.acked = received
+        while self.buffer and self.buffer[0][0] < received:
+            entry = self.buffer.popleft()
+            self.buffered -= len(entry[2])
+            if entry[3] in self.inflight:
+                self.inflight[entry[3]] -= len(entry[2])
+        self.space.set()
+
+    # --- прием ---
+
+    def on_segment(self, plain: bytes) -> List[bytes]:
+        """Сегменты для приложения по порядку (пусто - нечего отдавать); FIN отмечается в fin_received.
+
+        Сегменты не склеиваются: при сжатии каждый - отдельный кадр со своим байтом кодека.
+        """
+        if len(plain) < _HEADER.size:
+            raise ProtocolError("обрезанный сегмент")
+        kind, offset = _HEADER.unpack_from(plain)
+        if kind == KIND_ACK:
+            self._on_ack(offset)
+            return []
+        if kind not in (KIND_DATA, KIND_FIN):
+            raise ProtocolError(f"неизвестный сегмент {kind}")
+        payload = plain[_HEADER.size:]
+        if offset < self.received:
+            return []   # Повтор уже полученного
+        if offset != self.received:
+            # Обогнал предыдущие, пришедшие другим WebSocket
+            if offset not in self.reorder:
+                self.reorder[offset] = (kind, payload)
+                self.reordered += len(payload)
+                if self.reordered > REORDER_LIMIT_FACTOR * self.buffer_limit:
+                    raise ProtocolError(f"пропуск в потоке: ждали {self.received}, пришло {offset}")
+            return []
+        segments = [self._deliver(kind, payload)]
+        while self.received in self.reorder and not self.fin_received:
+            kind, payload = self.reorder.pop(self.received)
+            self.reordered -= len(payload)
+            segments.append(self._deliver(kind, payload))
+        return [segment for segment in segments if segment]
+
+    def _deliver(self, kind: int, payload: bytes) -> bytes:
+        if kind == KIND_FIN:
+            self.received += 1
+            self.fin_received = True
+            return b""
+        self.received += len(payload)
+        return payload
+
+    def ack_due(self) -> bool:
+        return self.received - self.ack_sent >= self.buffer_limit // 4
+
+    # --- смена WebSocket ---
+
+    def add_link(self, ws, meter=None):
+        self.links[ws] = meter
+        self.inflight[ws] = 0
+        self.link_closed[ws] = asyncio.Event()
+        self.changed.set()
+
+    def detach(self, ws=None):
+        """Отвязать WebSocket (None - все)"""
+        for link in ([ws] if ws is not None else list(self.links)):
+            self.links.pop(link, None)
+            self.inflight.pop(link, None)
+            closed = self.link_closed.pop(link, None)
+            if closed:
+                closed.set()
+
+    async def wait_detached(self, ws):
+        closed = self.link_closed.get(ws)
+        if closed:
+            await closed.wait()
+
+    async def wait_resumed(self, timeout: float) -> bool:
+        """Для стороны, которая ждет переподключения другой (шлюз)"""
+        if self.links:
+            return True   # Клиент переподключился раньше, чем мы заметили обрыв
+        self.resumed.clear()
+        try:
+            await asyncio.wait_for(self.resumed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def attach(self, ws, peer_received: int, meter=None):
+        """Продолжить поток на новом WebSocket с места, где остановилась другая сторона"""
+        if not self.acked <= peer_received <= self.sent:
+            raise ResumeError(f"другая сторона получила {peer_received}, а в буфере {self.acked}..{self.sent}")
+        self._on_ack(peer_received)
+        # Сегменты, добавленные во время повтора, тоже уходят, пока ws не стал текущим
+        position = peer_received
+        while position < self.sent:
+            for offset, kind, payload, _ in list(self.buffer):
+                if offset >= position:
+                    await ws.send(await crypto.seal(self.cipher, _HEADER.pack(kind, offset) + payload))
+                    position = offset + (len(payload) if kind == KIND_DATA else 1)
+        self.add_link(ws, meter)
+        for entry in self.buffer:
+            entry[3] = ws
+        self.inflight[ws] = self.buffered
+        self.resumes += 1
+        self.resumed.set()
+
+
+async def pump_tcp(session: StreamSession, reader: asyncio.StreamReader, read_size: int,
+                   compressor: StreamCompressor = None, flow: Flow = None, bucket=None, activity=None):
+    """TCP -> поток; конец данных приложения или цели - FIN"""
+    try:
+        while True:
+            data = await reader.read(read_size)
+            if not data:
+                break
+            if activity:
+                activity.touch()
+            if bucket:
+                delay = bucket.take(len(data))
+                if delay:
+                    await asyncio.sleep(delay)
+            if compressor:
+                data = compressor.encode(data)
+            if flow:
+                await scheduler.acquire(flow, len(data))
+            await session.send_data(data)
+    except (ConnectionError, OSError):
+        pass
+    await session.send_fin()
+
+
+async def pump_ws(session: StreamSession, ws, writer: asyncio.StreamWriter,
+                  decompressor: StreamDecompressor = None, bucket=None, activity=None) -> str:
+    """Поток -> TCP из одного WebSocket; возвращает OUTCOME_*"""
+    try:
+        async for msg in ws:
+            if activity:
+                activity.touch()
+            if not isinstance(msg, (bytes, bytearray)):
+                continue
+            plain = await crypto.open(session.cipher, msg)
+            # Разбор и запись в сокет без await между ними: порядок сохраняется и при нескольких WebSocket
+            segments = session.on_segment(plain)
+            if segments:
+                meter = session.links.get(ws)
+                if meter is not None:
+                    meter.transferred += sum(len(segment) for segment in segments)
+                if decompressor:
+                    segments = [decompressor.decode(segment) for segment in segments]
+                data = b"".join(segments)
+                writer.write(data)
+                await writer.drain()
+                if bucket:
+                    delay = bucket.take(len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+            if session.fin_received:
+                await session.send_ack()
+                return OUTCOME_FINISHED
+            if session.ack_due():
+                await session.send_ack()
+            if session.fin_sent and session.acked == session.sent:
+                return OUTCOME_FINISHED
+    except (ValueError, ConnectionError, OSError) as e:
+        # Ошибка расшифровки или протокола и отказ сокета приложения не лечатся переподключением
+        log.info(f"поток {session.session_id.hex()[:8]}: {e or type(e).__name__}")
+        return OUTCOME_FINISHED
+    except Exception:
+        pass
+    finally:
+        session.detach(ws)
+    # Нормальное закрытие после нашего FIN - другая сторона его получила
+    if session.fin_sent and getattr(ws, "close_code", None) == 1000:
+        return OUTCOME_FINISHED
+    return OUTCOME_DROPPED
+
+
+async def relay(session: StreamSession, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                reconnect: Callable[[], Awaitable[bool]], read_size: int, *,
+                compressor: StreamCompressor = None, decompressor: StreamDecompressor = None,
+                flow: Flow = None, upload=None, download=None, activity=None):
+    """Связать TCP-сокет с потоком; reconnect() возвращает True, когда поток продолжен на новом WebSocket"""
+    tcp_task = asyncio.create_task(pump_tcp(session, reader, read_size, compressor, flow, upload, activity))
+    pumps: Dict[Any, asyncio.Task] = {}
+    seen = []
+    try:
+        while True:
+            for ws in list(session.links):
+                if ws not in pumps:
+                    seen.append(ws)
+                    pumps[ws] = asyncio.create_task(pump_ws(session, ws, writer, decompressor, download, activity))
+            if not pumps:
+                log.info(f"поток {session.session_id.hex()[:8]}: WebSocket оборвался, "
+                         f"отправлено {session.sent}, подтверждено {session.acked}, получено {session.received}")
+                if not await reconnect():
+                    log.info(f"поток {session.session_id.hex()[:8]}: продолжить не удалось")
+                    break
+                log.info(f"поток {session.session_id.hex()[:8]}: продолжен (возобновлений {session.resumes})")
+                continue
+            session.changed.clear()
+            changed = asyncio.create_task(session.changed.wait())
+            done, _ = await asyncio.wait([changed, *pumps.values()], return_when=asyncio.FIRST_COMPLETED)
+            changed.cancel()
+            outcomes = [pumps.pop(ws).result() for ws, task in list(pumps.items()) if task in done]
+            if OUTCOME_FINISHED in outcomes:
+                break
+            if outcomes and session.links:
+                await session.retransmit()
+    finally:
+        tcp_task.cancel()
+        for task in pumps.values():
+            task.cancel()
+        await asyncio.gather(tcp_task, *pumps.values(), return_exceptions=True)
+        try:
+            writer.close()
+        except Exception:
+            pass
+        for ws in seen:
+            try:
+                await ws.close()
+            except Exception:
+                pass
@@ -0,0 +1,289 @@
+# routing.py
+"""Маршрутизация соединений клиента: через туннель, напрямую или блокировать.
+
+Правила задаются в client.routes (порядок важен - при совпадении нескольких правил
+побеждает первое) и перечитываются на лету (SIGHUP клиенту, изменение файлов списков):
+    "routes": {
+        "local":   {"action": "direct", "match": ["10.0.0.0/8", "192.168.0.0/16", "localhost"]},
+        "ru":      {"action": "direct", "file": "lists/ru.txt"},
+        "ads":     {"action": "block",  "match": ["doubleclick.net"]},
+        "ssh":     {"action": "tunnel", "match": [":22"]},
+    },
+    "route_default": "tunnel"
+Элемент списка: домен (совпадает с ним и всеми поддоменами), IP или CIDR, порт ":22"
+или диапазон ":8000-8999". Домены не резолвятся на клиенте, поэтому CIDR-правила
+срабатывают, только когда приложение само передает IP-адрес.
+
+Правила компилируются в суффиксное дерево доменов и отсортированные непересекающиеся
+интервалы адресов и портов: поиск - O(длина имени) и O(log n) даже на списках в 100 тыс. записей.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import re
+import socket
+import time
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from settings import BASE_DIR, get_settings
+
+log = logging.getLogger("routing")
+
+ACTION_TUNNEL = "tunnel"
+ACTION_DIRECT = "direct"
+ACTION_BLOCK = "block"
+ACTIONS = (ACTION_TUNNEL, ACTION_DIRECT, ACTION_BLOCK)
+
+ROUTES_POLL_SECONDS = 5       # Как часто проверять файлы списков
+ROUTES_STATS_SECONDS = 300    # Как часто писать в лог счетчики правил
+_RULE = None                  # Ключ узла дерева с номером правила (метки доменов - строки)
+PORT_ENTRY = re.compile(r":\d+(-\d+)?")   # ":22" или ":8000-8999"; "::1" и "::/0" - адреса IPv6
+
+
+class Rule:
+    __slots__ = ('name', 'action', 'entries', 'hits')
+
+    def __init__(self, name: str, action: str):
+        self.name = name
+        self.action = action
+        self.entries = 0
+        self.hits = 0
+
+
+class DomainTrie:
+    """Суффиксное дерево: метки имени от зоны верхнего уровня к хосту"""
+
+    def __init__(self):
+        self.root: dict = {}
+
+    def add(self, domain: str, rule: int):
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        if node.get(_RULE, rule) >= rule:
+            node[_RULE] = rule
+
+    def match(self, host: str) -> Optional[int]:
+        best = None
+        node = self.root
+        for label in reversed(host.rstrip(".").lower().split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            rule = node.get(_RULE)
+            if rule is not None and (best is None or rule < best):
+                best = rule
+        return best
+
+
+class IntervalTable:
+    """Непересекающиеся отсортированные интервалы [start, end] -> номер правила"""
+    __slots__ = ('starts', 'ends', 'rules')
+
+    def __init__(self, ranges: List[Tuple[int, int, int]]):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.rules: List[int] = []
+        # Заметание: на каждом отрезке между границами действует правило с наименьшим номером
+        ranges.sort()
+        points = sorted({start for start, _, _ in ranges} | {end + 1 for _, end, _ in ranges})
+        active: List[Tuple[int, int]] = []   # куча (правило, конец)
+        i = 0
+        for n, point in enumerate(points):
+            while i < len(ranges) and ranges[i][0] <= point:
+                heapq.heappush(active, (ranges[i][2], ranges[i][1]))
+                i += 1
+            while active and active[0][1] < point:
+                heapq.heappop(active)
+            if not active or n + 1 == len(points):
+                continue
+            rule, end = active[0][0], points[n + 1] - 1
+            if self.rules and self.rules[-1] == rule and self.ends[-1] + 1 == point:
+                self.ends[-1] = end
+            else:
+                self.starts.append(point)
+                self.ends.append(end)
+                self.rules.append(rule)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def match(self, value: int) -> Optional[int]:
+        i = bisect_right(self.starts, value) - 1
+        if i >= 0 and value <= self.ends[i]:
+            return self.rules[i]
+        return None
+
+
+class CompiledRoutes:
+    __slots__ = ('rules', 'default', 'domains', 'ipv4', 'ipv6', 'ports')
+
+    def __init__(self, rules: List[Rule], default: str, domains: DomainTrie,
+                 ipv4: IntervalTable, ipv6: IntervalTable, ports: IntervalTable):
+        self.rules = rules
+        self.default = default
+        self.domains = domains
+        self.ipv4 = ipv4
+        self.ipv6 = ipv6
+        self.ports = ports
+
+
+def _parse_port(entry: str) -> Tuple[int, int]:
+    low, _, high = entry[1:].partition("-")
+    low, high = int(low), int(high or low)
+    if not 0 <= low <= high <= 65535:
+        raise ValueError(f"недопустимый диапазон портов {entry!r}")
+    return low, high
+
+
+def _maybe_ip(value: str) -> bool:
+    """Дешевая проверка перед разбором адреса: у доменов последняя метка - буквы"""
+    return ":" in value or "/" in value or value[-1:].isdigit()
+
+
+def _ip_int(value: str) -> Optional[Tuple[int, int]]:
+    """(версия, адрес числом); inet_pton в разы быстрее ipaddress на больших списках"""
+    for family, version in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+        try:
+            return version, int.from_bytes(socket.inet_pton(family, value), "big")
+        except OSError:
+            pass
+    return None
+
+
+def _ip_range(entry: str) -> Optional[Tuple[int, int, int]]:
+    """(версия, первый, последний адрес) для IP или CIDR"""
+    address, _, prefix = entry.partition("/")
+    parsed = _ip_int(address)
+    if parsed is None:
+        return None
+    version, value = parsed
+    bits = 32 if version == 4 else 128
+    length = int(prefix) if prefix else bits
+    if not 0 <= length <= bits:
+        raise ValueError(f"недопустимая длина префикса {entry!r}")
+    host_mask = (1 << (bits - length)) - 1
+    return version, value & ~host_mask, value | host_mask
+
+
+def _read_list(path: str) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.split("#", 1)[0].strip() for line in f]
+
+
+def list_path(name: str) -> str:
+    return os.path.join(BASE_DIR, name)
+
+
+def compile_routes(raw: Dict[str, dict], default: str) -> CompiledRoutes:
+    if default not in ACTIONS:
+        raise ValueError(f"client.route_default: ожидается {'/'.join(ACTIONS)}")
+    rules: List[Rule] = []
+    domains = DomainTrie()
+    ranges: Dict[int, List[Tuple[int, int, int]]] = {4: [], 6: [], 0: []}   # 0 - порты
+    for index, (name, options) in enumerate(raw.items()):
+        action = options.get("action")
+        if action not in ACTIONS:
+            raise ValueError(f"client.routes.{name}.action: ожидается {'/'.join(ACTIONS)}")
+        rule = Rule(name, action)
+        entries = list(options.get("match", []))
+        if options.get("file"):
+            try:
+                entries += _read_list(list_path(options["file"]))
+            except OSError as e:
+                raise ValueError(f"client.routes.{name}.file: {e}") from e
+        for entry in entries:
+            if not entry:
+                continue
+            try:
+                if _maybe_ip(entry) and (network := _ip_range(entry)) is not None:
+                    version, first, last = network
+                    ranges[version].append((first, last, index))
+                elif PORT_ENTRY.fullmatch(entry):
+                    low, high = _parse_port(entry)
+                    ranges[0].append((low, high, index))
+                elif entry.startswith(":"):
+                    raise ValueError(f"не порт и не адрес {entry!r}")
+                else:
+                    domain = entry.lower().lstrip("*.").rstrip(".")
+                    if not domain:
+                        raise ValueError(f"пустой домен {entry!r}")
+                    domains.add(domain, index)
+            except ValueError as e:
+                raise ValueError(f"client.routes.{name}: {e}") from e
+            rule.entries += 1
+        rules.append(rule)
+    return CompiledRoutes(rules, default, domains,
+                          IntervalTable(ranges[4]), IntervalTable(ranges[6]), IntervalTable(ranges[0]))
+
+
+class RouteTable:
+    """Текущие правила; перекомпиляция подменяет их целиком, счетчики одноименных правил сохраняются"""
+
+    def __init__(self):
+        self.routes = compile_routes({}, ACTION_TUNNEL)
+        self.files: Dict[str, float] = {}
+
+    def configure(self, raw: Dict[str, dict], default: str):
+        started = time.monotonic()
+        routes = compile_routes(raw, default)
+        previous = {rule.name: rule.hits for rule in self.routes.rules}
+        for rule in routes.rules:
+            rule.hits = previous.get(rule.name, 0)
+        self.routes = routes
+        self.files = {path: self._mtime(path) for path in
+                      (list_path(options["file"]) for options in raw.values() if options.get("file"))}
+        if routes.rules:
+            log.info(f"маршруты: {len(routes.rules)} правил, {sum(r.entries for r in routes.rules)} записей, "
+                     f"по умолчанию {default}, компиляция {(time.monotonic() - started) * 1000:.0f} мс")
+
+    @staticmethod
+    def _mtime(path: str) -> float:
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return 0.0
+
+    def decide(self, host: str, port: int) -> Tuple[str, Optional[Rule]]:
+        """(действие, сработавшее правило или None для действия по умолчанию)"""
+        routes = self.routes
+        if not routes.rules:
+            return routes.default, None
+        ip = _ip_int(host) if _maybe_ip(host) else None
+        if ip is None:
+            best = routes.domains.match(host)
+        else:
+            best = (routes.ipv4 if ip[0] == 4 else routes.ipv6).match(ip[1])
+        if len(routes.ports):
+            by_port = routes.ports.match(port)
+            if by_port is not None and (best is None or by_port < best):
+                best = by_port
+        if best is None:
+            return routes.default, None
+        rule = routes.rules[best]
+        rule.hits += 1
+        return rule.action, rule
+
+    def summary(self) -> str:
+        return ", ".join(f"{rule.name} ({rule.action}): {rule.hits}" for rule in self.routes.rules)
+
+    async def watch(self):
+        """Перекомпиляция при изменении файлов списков и счетчики правил в лог"""
+        last_stats, last_hits = time.monotonic(), None
+        while True:
+            await asyncio.sleep(ROUTES_POLL_SECONDS)
+            if any(self._mtime(path) != mtime for path, mtime in self.files.items()):
+                cfg = get_settings().client
+                try:
+                    await asyncio.to_thread(self.configure, cfg.routes, cfg.route_default)
+                except ValueError as e:
+                    log.error(f"маршруты не обновлены: {e}")
+                    self.files = {path: self._mtime(path) for path in self.files}
+            if time.monotonic() - last_stats >= ROUTES_STATS_SECONDS:
+                last_stats = time.monotonic()
+                hits = [rule.hits for rule in self.routes.rules]
+                if hits != last_hits and any(hits):
+                    log.info(f"маршруты: {self.summary()}")
+                last_hits = hits
@@ -0,0 +1,146 @@
+# scheduler.py
+"""Планировщик отправки в туннель: общий лимит скорости и справедливость между потоками.
+
+Все потоки идут через один VK-туннель. Без ограничения одна закачка забивает буферы
+WebSocket, и задержка растет у всех (bufferbloat). Планировщик держит общий темп чуть ниже
+пропускной способности туннеля (tunnel_rate_kbps), а очередь ожидающих кадров разбирает так:
+  * классы приоритета: interactive (SSH, DNS, RDP...) -> default -> bulk, строго по порядку;
+  * внутри класса - deficit round-robin: каждый поток получает равную долю байтов,
+    независимо от размера кадров.
+Пока tunnel_rate_kbps = 0, планировщик только считает байты и не задерживает кадры.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = {"interactive": PRIORITY_INTERACTIVE, "default": PRIORITY_DEFAULT, "bulk": PRIORITY_BULK}
+
+QUANTUM_BYTES = 16384   # Доля потока за один обход очереди
+
+
+class Flow:
+    """Поток с точки зрения планировщика: не больше одного ожидающего кадра"""
+    __slots__ = ('priority', 'deficit', 'size', 'waiter', 'sent')
+
+    def __init__(self, priority: int):
+        self.priority = priority
+        self.deficit = 0
+        self.size = 0
+        self.waiter: Optional[asyncio.Future] = None
+        self.sent = 0
+
+
+class Scheduler:
+    def __init__(self):
+        self.rate = 0.0                       # байт/с; 0 - без ограничения
+        self.priority_ports: Dict[int, int] = {}
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.queues: List[Deque[Flow]] = [deque(), deque(), deque()]
+        self.backlog = 0
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.sent_by_class = [0, 0, 0]
+        self.delayed = 0
+
+    def configure(self, rate_kbps: float, priority_ports: Dict[str, str]):
+        ports = {}
+        for port, name in priority_ports.items():
+            if name not in PRIORITY_NAMES:
+                raise ValueError(f"priority_ports.{port}: ожидается {'/'.join(PRIORITY_NAMES)}")
+            ports[int(port)] = PRIORITY_NAMES[name]
+        self.priority_ports = ports
+        self.rate = rate_kbps * 1024
+        self.wakeup.set()
+
+    def flow(self, port: int) -> Flow:
+        return Flow(self.priority_ports.get(port, PRIORITY_DEFAULT))
+
+    def _refill(self):
+        now = time.monotonic()
+        # Запас не больше 50 мс трафика: иначе после паузы уйдет пачка и снова раздует очередь
+        self.tokens = min(self.rate * 0.05, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, flow: Flow, size: int):
+        """Дождаться очереди на отправку кадра размером size"""
+        if not self.try_acquire(flow, size):
+            await self.wait(flow, size)
+
+    def try_acquire(self, flow: Flow, size: int) -> bool:
+        """Учет кадра и быстрый путь без ожидания; False - кадр должен дождаться очереди (wait)"""
+        flow.sent += size
+        self.sent_by_class[flow.priority] += size
+        if self.rate <= 0:
+            return True
+        if not self.backlog:
+            self._refill()
+            if self.tokens > 0:
+                self.tokens -= size   # быстрый путь: очереди нет, бюджет есть
+                return True
+        return False
+
+    async def wait(self, flow: Flow, size: int):
+        flow.size = size
+        flow.waiter = asyncio.get_running_loop().create_future()
+        self.queues[flow.priority].append(flow)
+        self.backlog += 1
+        self.delayed += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+        try:
+            await flow.waiter
+        finally:
+            flow.waiter = None
+
+    def _next_flow(self) -> Optional[Flow]:
+        for queue in self.queues:
+            while queue:
+                flow = queue[0]
+                if flow.waiter is None or flow.waiter.done():
+                    queue.popleft()       # поток закрылся, пока ждал
+                    self.backlog -= 1
+                    flow.deficit = 0
+                    continue
+                flow.deficit += QUANTUM_BYTES
+                if flow.deficit >= flow.size:
+                    queue.popleft()
+                    self.backlog -= 1
+                    flow.deficit = 0      # очередь потока опустела - дефицит не копим
+                    return flow
+                queue.rotate(-1)
+        return None
+
+    async def _run(self):
+        while True:
+            if not self.backlog:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            if self.rate <= 0:
+                # Лимит сняли через /reload - отпускаем всех
+                while (flow := self._next_flow()) is not None:
+                    flow.waiter.set_result(None)
+                continue
+            self._refill()
+            if self.tokens <= 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+                continue
+            flow = self._next_flow()
+            if flow is not None:
+                self.tokens -= flow.size
+                flow.waiter.set_result(None)
+
+    def summary(self) -> str:
+        names = {v: k for k, v in PRIORITY_NAMES.items()}
+        sent = ", ".join(f"{names[i]} {b // 1024} КБ" for i, b in enumerate(self.sent_by_class))
+        limit = f"{self.rate / 1024:.0f} КБ/с" if self.rate else "без лимита"
+        return f"планировщик ({limit}): {sent}; кадров ждали очереди: {self.delayed}"
+
+
+scheduler = Scheduler()
@@ -1,40 +1,105 @@
 #!/usr/bin/env python3
 # ws_gateway_light.py !
-import asyncio, json, socket, logging, os
+import asyncio, ipaddress, json, socket, logging, os, time
+from typing import Dict, Tuple
 import websockets
 
-from config_light import CONFIG
-from crypto_aead_light import aead_seal, aead_open
+from compression import CODEC_ZLIB, CODEC_ZSTD, StreamCompressor, StreamDecompressor, available_codecs
+from crypto_aead_light import FrameCipher, UnknownKeyError
+from crypto_pool import crypto
+from keepalive import expiry, keepalive
+from key_rotation import KeyringWatcher, parse_key_spec
+from limits import Activity, Admission, StreamLimits, peer_key, proxies
+from lifecycle import Drain, pid_file_path, release_pid, serve_with_retry, write_pid
+from dns_tunnel import DnsRelay, parse_endpoint, system_resolver
+from fastpath import DATA_PATHS, TunnelConnection, supported, summary as buffers_summary
+from scheduler import Flow, scheduler
+from protocol import (CLOSE_TRY_AGAIN_LATER, FLAG_COMPRESS, FLAG_COMPRESS_ZSTD, FLAG_DNS, FLAG_JOIN, FLAG_RESUMABLE, FLAG_RESUME, FLAG_UDP,
+                      REP_GENERAL_FAILURE, REP_SUCCEEDED, ProtocolError, decode_datagram, decode_open, decode_resume,
+                      encode_datagram, encode_resume_result, encode_result, rep_for_error)
+from resume import ResumeError, StreamSession, new_session_id, relay
+from settings import get_settings, store, install_reload_signal, apply_log_level
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [gw] %(message)s")
 log = logging.getLogger("gw")
 
-KEY = bytes.fromhex(CONFIG["aes_key_hex"])
+# Текущий и предыдущие ключи; keyring.json перечитывается на лету
+keys = KeyringWatcher()
+limits = StreamLimits()
+admission = Admission()
+sessions: Dict[bytes, StreamSession] = {}   # Возобновляемые потоки (resume.py) по ID сессии
+STATS_INTERVAL_SECONDS = 300
 
-async def pipe_tcp_to_ws(reader: asyncio.StreamReader, ws: websockets.WebSocketServerProtocol):
+DECRYPT_FAILURES_BEFORE_CLOSE = 3   # Подряд: ключи клиента и шлюза явно не совпадают
+decrypt_failures = 0                # Всего за время работы
+
+def legacy_cipher() -> FrameCipher:
+    """Клиенты без ID ключа в кадрах: ключ aes_key_hex из конфигурации"""
+    return FrameCipher(None, parse_key_spec(get_settings().aes_key_hex)[1])
+
+async def pipe_tcp_to_ws(reader: asyncio.StreamReader, ws: websockets.WebSocketServerProtocol, cipher: FrameCipher,
+                         compressor: StreamCompressor = None, flow: Flow = None, activity: Activity = None):
+    # Настройки берутся при открытии потока: после /reload их получат только новые соединения
+    read_size = get_settings().server.read_chunk_size
     try:
         while True:
-            data = await reader.read(65536)
+            data = await reader.read(read_size)
             if not data:
                 break
-            enc = aead_seal(KEY, data)
+            if activity:
+                activity.touch()
+            if compressor:
+                data = compressor.encode(data)
+            enc = await crypto.seal(cipher, data)
+            if flow:
+                await scheduler.acquire(flow, len(enc))
             await ws.send(enc)
     except Exception:
         pass
     finally:
+        if compressor and compressor.summary():
+            log.info(compressor.summary())
+        if flow and scheduler.rate:
+            log.debug(scheduler.summary())
         try:
             await ws.close()
         except Exception:
             pass
 
-async def pipe_ws_to_tcp(ws: websockets.WebSocketServerProtocol, writer: asyncio.StreamWriter):
+def decrypt_failed(e: ValueError, cipher: FrameCipher, failures: int) -> bool:
+    """Учет нерасшифрованного кадра; failures - подряд в этом потоке. True - поток пора закрыть"""
+    global decrypt_failures
+    decrypt_failures += 1
+    if failures == 1:
+        log.warning(f"кадр не расшифрован ({e or 'неверный тег'}), ключ {cipher.key_id}; "
+                    f"всего ошибок: {decrypt_failures}")
+    if failures >= DECRYPT_FAILURES_BEFORE_CLOSE:
+        log.warning("поток закрыт: ключи клиента и шлюза не совпадают")
+        return True
+    return False
+
+async def pipe_ws_to_tcp(ws: websockets.WebSocketServerProtocol, writer: asyncio.StreamWriter, cipher: FrameCipher,
+                         decompressor: StreamDecompressor = None, activity: Activity = None):
+    failures = 0
     try:
         async for msg in ws:
+            if activity:
+                activity.touch()
             if isinstance(msg, (bytes, bytearray)):
                 try:
-                    plain = aead_open(KEY, bytes(msg))
-                except Exception:
+                    plain = await crypto.open(cipher, msg)
+                    failures = 0
+                except ValueError as e:
+                    failures += 1
+                    if decrypt_failed(e, cipher, failures):
+                        break
                     continue
+                if decompressor:
+                    try:
+                        plain = decompressor.decode(plain)
+                    except ValueError as e:
+                        log.warning(f"поток закрыт: {e}")
+                        break
                 writer.write(plain)
                 await writer.drain()
             # текстовые кадры после OPEN игнорируем
@@ -47,49 +112,388 @@ async def pipe_ws_to_tcp(ws: websockets.WebSocketServerProtocol, writer: asyncio
         except Exception:
             pass
 
-async def handle_ws(ws: websockets.WebSocketServerProtocol):
+UDP_QUEUE_SIZE = 256   # Датаграмм в очереди к клиенту; сверх этого отбрасываются, как в UDP
+
+class _UdpReplies(asyncio.DatagramProtocol):
+    def __init__(self, association: "UdpAssociation"):
+        self.association = association
+
+    def datagram_received(self, data: bytes, addr):
+        self.association.on_reply(data, addr)
+
+class UdpAssociation:
+    """UDP ASSOCIATE на шлюзе: сокет на каждое семейство адресов и NAT-таблица адресатов.
+
+    Ответы принимаются только от адресатов, которым клиент сам отправлял датаграммы;
+    записи таблицы и вся ассоциация истекают после udp_idle_timeout без трафика.
+    """
+
+    def __init__(self, ws: websockets.WebSocketServerProtocol, cipher: FrameCipher, peer):
+        cfg = get_settings().server
+        self.ws = ws
+        self.cipher = cipher
+        self.peer = peer
+        self.idle_timeout = cfg.udp_idle_timeout
+        self.max_peers = cfg.udp_max_peers
+        self.transports: Dict[int, asyncio.DatagramTransport] = {}
+        self.peers: Dict[Tuple[str, int], float] = {}       # адресат -> время последней датаграммы
+        self.resolved: Dict[str, Tuple[int, str]] = {}      # имя -> (семейство, IP)
+        self.replies: asyncio.Queue = asyncio.Queue(UDP_QUEUE_SIZE)
+        self.last_activity = time.monotonic()
+        self.sent = self.received = self.dropped = 0
+
+    async def _resolve(self, addr: str, port: int) -> Tuple[int, str]:
+        if addr in self.resolved:
+            return self.resolved[addr]
+        try:
+            ip = ipaddress.ip_address(addr)
+            result = (socket.AF_INET6 if ip.version == 6 else socket.AF_INET, addr)
+        except ValueError:
+            infos = await asyncio.get_running_loop().getaddrinfo(addr, port, type=socket.SOCK_DGRAM)
+            family, _, _, _, sockaddr = infos[0]
+            result = (family, sockaddr[0])
+        if len(self.resolved) < self.max_peers:
+            self.resolved[addr] = result
+        return result
+
+    async def _transport(self, family: int) -> asyncio.DatagramTransport:
+        if family not in self.transports:
+            local = ("::", 0) if family == socket.AF_INET6 else ("0.0.0.0", 0)
+            self.transports[family], _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: _UdpReplies(self), local_addr=local, family=family)
+        return self.transports[family]
+
+    async def send(self, addr: str, port: int, payload: bytes):
+        family, ip = await self._resolve(addr, port)
+        transport = await self._transport(family)
+        target = (ip, port)
+        self.peers.pop(target, None)
+        self.peers[target] = self.last_activity = time.monotonic()
+        while len(self.peers) > self.max_peers:
+            del self.peers[next(iter(self.peers))]  # самый давний адресат
+        transport.sendto(payload, target)
+        self.sent += 1
+
+    def on_reply(self, data: bytes, addr):
+        source = (addr[0], addr[1])
+        if source not in self.peers:
+            self.dropped += 1
+            return
+        self.peers[source] = self.last_activity = time.monotonic()
+        try:
+            self.replies.put_nowait(encode_datagram(source[0], source[1], data))
+            self.received += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def uplink(self):
+        global decrypt_failures
+        async for msg in self.ws:
+            if not isinstance(msg, (bytes, bytearray)):
+                continue
+            try:
+                addr, port, payload = decode_datagram(self.cipher.open(msg))
+            except ValueError as e:
+                decrypt_failures += 1
+                self.dropped += 1
+                log.debug(f"udp {self.peer}: датаграмма отброшена: {e}")
+                continue
+            try:
+                await self.send(addr, port, payload)
+            except OSError as e:
+                self.dropped += 1
+                log.debug(f"udp {self.peer}: отправка на {addr}:{port} не удалась: {e}")
+
+    async def downlink(self):
+        while True:
+            plain = await self.replies.get()
+            await self.ws.send(self.cipher.seal(plain))
+
+    async def expire(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout / 4, 30))
+            now = time.monotonic()
+            if now - self.last_activity > self.idle_timeout:
+                log.info(f"udp {self.peer}: ассоциация закрыта по простою")
+                await self.ws.close()
+                return
+            for target in [t for t, seen in self.peers.items() if now - seen > self.idle_timeout]:
+                del self.peers[target]
+
+    async def run(self):
+        tasks = [asyncio.create_task(self.uplink()), asyncio.create_task(self.downlink()),
+                 asyncio.create_task(self.expire())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for transport in self.transports.values():
+                transport.close()
+            log.info(f"udp {self.peer}: отправлено {self.sent}, получено {self.received}, отброшено {self.dropped}")
+
+async def serve_stream(ws: websockets.WebSocketServerProtocol, activity: Activity):
     peer = getattr(ws, "remote_address", None)
     log.info(f"client connected: {peer}")
-    # 1) ждём OPEN (текстом)
+    # 1) ждём OPEN: бинарный (зашифрованный, с ранними данными) или старый текстовый JSON
+    admission.pending += 1
     try:
-        first = await asyncio.wait_for(ws.recv(), timeout=10)
-    except Exception:
+        first = await asyncio.wait_for(ws.recv(), timeout=admission.deadline())
+    except Exception as e:
+        if isinstance(e, asyncio.TimeoutError):
+            admission.open_timeouts += 1
         await ws.close()
         return
+    finally:
+        admission.pending -= 1
 
-    if not isinstance(first, str):
+    binary = not isinstance(first, str)
+    early_data = b""
+    try:
+        if binary:
+            # ID ключа в заголовке кадра: ключ находится сразу, без перебора
+            key_id, plain = keys.keyring.open(first)
+            request = decode_open(plain)
+            cipher = keys.keyring.cipher(key_id)
+            addr, port, early_data = request.addr, request.port, request.early_data
+        else:
+            obj = json.loads(first)
+            addr, port = obj["addr"], int(obj["port"])
+            # Ключ выбирается по ID из OPEN и не меняется до конца потока
+            cipher = keys.keyring.cipher(int(obj["kid"])) if "kid" in obj else legacy_cipher()
+    except UnknownKeyError as e:
+        log.warning(f"{peer}: {e}; клиенту нужен актуальный ключ (/key)")
+        await ws.close(1008, "unknown key")
+        return
+    except Exception as e:
+        log.warning(f"{peer}: некорректный OPEN: {e or 'неверный тег'}")
         await ws.close()
         return
 
-    try:
-        obj = json.loads(first)
-        addr, port = obj["addr"], int(obj["port"])
-    except Exception:
-        await ws.close()
+    if binary and request.flags & FLAG_DNS:
+        try:
+            upstream = parse_endpoint(get_settings().server.dns_upstream or system_resolver(), 53)
+            await ws.send(cipher.seal(encode_result(REP_SUCCEEDED)))
+            await DnsRelay(ws, cipher, upstream).run()
+        except Exception as e:
+            log.info(f"dns {peer}: {e!r}")
+        finally:
+            await ws.close()
+            log.info(f"client disconnected: {peer}")
+        return
+
+    if binary and request.flags & (FLAG_RESUME | FLAG_JOIN):
+        await resume_stream(ws, cipher, early_data, peer, join=bool(request.flags & FLAG_JOIN))
+        return
+
+    if binary and request.flags & FLAG_UDP:
+        try:
+            await ws.send(cipher.seal(encode_result(REP_SUCCEEDED)))
+            await UdpAssociation(ws, cipher, peer).run()
+        except Exception as e:
+            log.info(f"udp {peer}: {e!r}")
+        finally:
+            await ws.close()
+            log.info(f"client disconnected: {peer}")
         return
 
-    # 2) TCP подключение
+    # 2) TCP подключение; несжатый и невозобновляемый поток можно вести на протоколе (fastpath.py)
+    cfg = get_settings().server
+    connection = None
+    buffered = (cfg.data_path == "buffered" and binary and supported(ws)
+                and not request.flags & (FLAG_COMPRESS | FLAG_RESUMABLE))
     try:
-        reader, writer = await asyncio.open_connection(addr, port, family=socket.AF_UNSPEC)
+        if buffered:
+            _, connection = await asyncio.wait_for(asyncio.get_running_loop().create_connection(
+                lambda: TunnelConnection(ws, cipher, cfg.read_chunk_size, flow=scheduler.flow(port), activity=activity),
+                addr, port, family=socket.AF_UNSPEC), timeout=cfg.connect_timeout)
+        else:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(addr, port, family=socket.AF_UNSPEC), timeout=cfg.connect_timeout)
     except Exception as e:
-        log.info(f"connect to {addr}:{port} failed: {e}")
+        log.info(f"connect to {addr}:{port} failed: {e!r}")
+        if binary:
+            # Клиент вернет приложению настоящий код ошибки SOCKS
+            try:
+                await ws.send(cipher.seal(encode_result(rep_for_error(e))))
+            except Exception:
+                pass
         await ws.close()
         return
 
-    # 3) Трубы
-    t1 = asyncio.create_task(pipe_tcp_to_ws(reader, ws))
-    t2 = asyncio.create_task(pipe_ws_to_tcp(ws, writer))
+    # Сжатие: клиент сам выбрал кодек; в ответ сообщаем, какие кодеки умеет шлюз
+    compressor = decompressor = None
+    codecs = 0
+    if binary and request.flags & FLAG_COMPRESS:
+        codec = CODEC_ZSTD if request.flags & FLAG_COMPRESS_ZSTD else CODEC_ZLIB
+        compressor = StreamCompressor(codec, get_settings().server.compression_level,
+                                      peer_codecs=(1 << codec) | (1 << CODEC_ZLIB))
+        decompressor = StreamDecompressor()
+        codecs = available_codecs()
+
+    session = None
+    if binary and request.flags & FLAG_RESUMABLE:
+        # Ранние данные - начало потока клиента: нумерация сегментов продолжается после них
+        session = StreamSession(new_session_id(), cipher, cfg.resume_buffer_bytes)
+        session.received = session.ack_sent = len(early_data)
+        result = encode_resume_result(REP_SUCCEEDED, codecs, session.session_id, session.received)
+    else:
+        result = encode_result(REP_SUCCEEDED, codecs)
+    if binary:
+        try:
+            await ws.send(cipher.seal(result))
+        except Exception:
+            (connection.transport if connection else writer).close()
+            return
+    if early_data:
+        (connection.transport if connection else writer).write(early_data)
+
+    idle_timeout = cfg.stream_idle_timeout
+    if connection:
+        # Своих задач у потока нет: цель читают колбэки протокола, WebSocket - эта задача
+        connection.start()
+        if idle_timeout > 0:
+            connection.watch_idle(idle_timeout)
+        await connection.run(lambda e, failures: decrypt_failed(e, cipher, failures))
+        if connection.expired:
+            limits.reaped += 1
+            log.info(f"{peer}: поток {addr}:{port} простоял {idle_timeout:.0f} с, закрываем")
+        log.info(f"client disconnected: {peer}")
+        return
+
+    # 3) Трубы: закрытие любой стороны (или простой) завершает обе
+    if session:
+        # Обрыв WebSocket не закрывает цель: клиент может продолжить поток в течение resume_grace
+        session.add_link(ws)
+        sessions[session.session_id] = session
+        tasks = [asyncio.create_task(relay(
+            session, reader, writer, lambda: session.wait_resumed(cfg.resume_grace), cfg.read_chunk_size,
+            compressor=compressor, decompressor=decompressor, flow=scheduler.flow(port), activity=activity))]
+    else:
+        tasks = [asyncio.create_task(pipe_tcp_to_ws(reader, ws, cipher, compressor, scheduler.flow(port), activity)),
+                 asyncio.create_task(pipe_ws_to_tcp(ws, writer, cipher, decompressor, activity))]
+    if idle_timeout > 0:
+        tasks.append(expiry(activity, idle_timeout))
     try:
-        await asyncio.gather(t1, t2)
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if idle_timeout > 0 and tasks[-1] in done:
+            limits.reaped += 1
+            log.info(f"{peer}: поток {addr}:{port} простоял {idle_timeout:.0f} с, закрываем")
     finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if session:
+            sessions.pop(session.session_id, None)
+            session.detach()   # Отпустить resume_stream, если поток закрылся по простою
+            if session.resumes:
+                log.info(f"{peer}: поток {addr}:{port} возобновлялся {session.resumes} раз")
         log.info(f"client disconnected: {peer}")
 
+async def resume_stream(ws: websockets.WebSocketServerProtocol, cipher: FrameCipher, early_data: bytes, peer,
+                        join: bool = False):
+    """OPEN с FLAG_RESUME (продолжить поток на новом WebSocket) или FLAG_JOIN (добавить WebSocket
+    к потоку, bonding.py); держим WebSocket, пока поток не закончится или не оборвется снова"""
+    try:
+        session_id, peer_received = decode_resume(early_data)
+        session = sessions.get(session_id)
+        if session is None:
+            # Срок resume_grace истек или шлюз перезапускался - клиент закроет соединение приложения
+            log.info(f"{peer}: поток {session_id.hex()[:8]} не найден, продолжить нельзя")
+            await ws.send(cipher.seal(encode_result(REP_GENERAL_FAILURE)))
+            return
+        if not join:
+            # Клиент заметил обрыв раньше нас: старые WebSocket уже не нужны
+            for old in list(session.links):
+                session.detach(old)
+                await old.close()
+        await ws.send(session.cipher.seal(
+            encode_resume_result(REP_SUCCEEDED, 0, session_id, session.received)))
+        if join and session.links:
+            session.add_link(ws)
+        else:
+            await session.attach(ws, peer_received)
+        await session.wait_detached(ws)
+    except (ProtocolError, ResumeError) as e:
+        log.warning(f"{peer}: продолжение потока отклонено: {e}")
+    except Exception as e:
+        log.info(f"{peer}: продолжение потока: {e!r}")
+    finally:
+        await ws.close()
+        log.info(f"client disconnected: {peer}")
+
+async def handle_ws(ws: websockets.WebSocketServerProtocol):
+    source = peer_key(ws)
+    refused = limits.acquire(source)
+    if refused:
+        # Отказ сразу: клиент повторит позже или через другой шлюз, а открытые потоки не тормозят
+        log.warning(f"{source}: поток отклонен ({refused}); {limits.summary()}")
+        await ws.close(CLOSE_TRY_AGAIN_LATER, refused)
+        return
+    activity = Activity()
+    keepalive.watch(ws, activity)
+    try:
+        await serve_stream(ws, activity)
+    finally:
+        limits.release(source)
+
+async def log_stats():
+    """Отклоненная нагрузка и занятость шлюза - раз в STATS_INTERVAL_SECONDS, если было что считать"""
+    last = None
+    while True:
+        await asyncio.sleep(STATS_INTERVAL_SECONDS)
+        current = (limits.active, limits.rejected, limits.reaped,
+                   admission.rejected_rate, admission.rejected_pending, admission.open_timeouts)
+        if current != last and any(current):
+            log.info("; ".join(part for part in (limits.summary(), admission.summary(), buffers_summary(), crypto.summary()) if part))
+        last = current
+
 async def main():
-    host = CONFIG["server"]["host"]
-    port = CONFIG["server"]["port"]
-    log.info(f"listening ws://{host}:{port}")
-    async with websockets.serve(handle_ws, host, port, max_size=2**22, ping_interval=20, ping_timeout=20, compression=None):
-        await asyncio.Future()
+    cfg = get_settings().server
+    if cfg.data_path not in DATA_PATHS:
+        raise SystemExit(f"server.data_path: ожидается {'/'.join(DATA_PATHS)}")
+    apply_log_level(cfg.log_level)
+    store.subscribe(lambda settings: apply_log_level(settings.server.log_level))
+    scheduler.configure(cfg.tunnel_rate_kbps, cfg.priority_ports)
+    store.subscribe(lambda settings: scheduler.configure(settings.server.tunnel_rate_kbps,
+                                                         settings.server.priority_ports))
+    proxies.configure(cfg.trusted_proxies)
+    store.subscribe(lambda settings: proxies.configure(settings.server.trusted_proxies))
+    limits.configure(cfg.max_streams, cfg.max_streams_per_peer)
+    store.subscribe(lambda settings: limits.configure(settings.server.max_streams,
+                                                      settings.server.max_streams_per_peer))
+    admission.configure(cfg.max_pending_opens, cfg.open_deadline, cfg.conn_rate_per_ip)
+    crypto.configure(cfg.crypto_offload_bytes, cfg.crypto_threads)
+    store.subscribe(lambda settings: crypto.configure(settings.server.crypto_offload_bytes,
+                                                      settings.server.crypto_threads))
+    # ping из одного колеса таймеров, а не задачей websockets на каждое соединение
+    keepalive.configure(cfg.ping_interval, cfg.ping_timeout)
+    store.subscribe(lambda settings: admission.configure(settings.server.max_pending_opens,
+                                                         settings.server.open_deadline,
+                                                         settings.server.conn_rate_per_ip))
+    install_reload_signal()
+    keys_watch_task = asyncio.create_task(keys.watch())
+    stats_task = asyncio.create_task(log_stats())
+
+    log.info(f"keys: {sorted(keys.keyring.keys)}, current {keys.keyring.current_id}")
+    drain = Drain()
+    drain.install_signal()
+    # reuse_port: новый экземпляр слушает тот же порт, пока старый доживает (см. lifecycle.py)
+    server = await serve_with_retry(lambda: websockets.serve(
+        drain.track(handle_ws), cfg.host, cfg.port, max_size=cfg.max_size, reuse_port=True,
+        process_request=admission.process_request, open_timeout=cfg.open_deadline,
+        ping_interval=None, compression=None))
+    pid_path = pid_file_path()
+    write_pid(pid_path, os.getpid())
+    log.info(f"listening ws://{cfg.host}:{cfg.port}, pid {os.getpid()}, max streams {limits.max_streams}")
+    try:
+        await drain.run(server, get_settings().server.drain_timeout)
+    finally:
+        keys_watch_task.cancel()
+        stats_task.cancel()
+        release_pid(pid_path, os.getpid())
+    log.info("server stopped")
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,320 @@
+# settings.py
+"""Типизированная конфигурация: config_light.py -> config.json -> переменные окружения VKTUN_*.
+
+Разобранная конфигурация кэшируется. reload() перечитывает источники, сравнивает с текущей
+и применяет только безопасные ("live") поля; остальные вступят в силу после перезапуска.
+"""
+import ast
+import asyncio
+import json
+import logging
+import os
+import signal
+from dataclasses import MISSING, dataclass, field, fields, is_dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+log = logging.getLogger("settings")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(BASE_DIR, "config_light.py")
+JSON_FILE = os.getenv("VKTUN_CONFIG", os.path.join(BASE_DIR, "config.json"))
+ENV_PREFIX = "VKTUN_"
+
+
+# Порты, трафик которых планировщик (scheduler.py) пропускает первым
+INTERACTIVE_PORTS = {"22": "interactive", "53": "interactive", "3389": "interactive", "5900": "interactive"}
+
+
+def live(default=MISSING, *, default_factory=MISSING):
+    """Поле, которое можно менять без перезапуска (новые соединения возьмут новое значение)"""
+    return field(default=default, default_factory=default_factory, metadata={'live': True})
+
+
+@dataclass(frozen=True)
+class ServerSettings:
+    host: str = "127.0.0.1"
+    port: int = 8080
+    max_size: int = 2 ** 22
+    ping_interval: float = 20
+    ping_timeout: float = 20
+    read_chunk_size: int = live(65536)
+    connect_timeout: float = live(10)       # Подключение шлюза к цели
+    udp_idle_timeout: float = live(120)     # UDP-ассоциация без трафика закрывается
+    udp_max_peers: int = live(256)          # Размер NAT-таблицы одной UDP-ассоциации
+    dns_upstream: str = live("")            # Резолвер для DNS через туннель; "" - из /etc/resolv.conf
+    compression_level: int = live(3)        # Сжатие ответов, если клиент его запросил; 0 - не сжимать
+    tunnel_rate_kbps: float = live(0)       # Общий темп отправки в туннель (scheduler.py); 0 - без лимита
+    priority_ports: dict = live(default_factory=lambda: dict(INTERACTIVE_PORTS))  # порт -> interactive/default/bulk
+    stream_idle_timeout: float = live(300)  # Поток без данных в обе стороны закрывается; 0 - никогда
+    max_streams: int = live(0)              # Всего потоков; 0 - от лимита файловых дескрипторов
+    max_streams_per_peer: int = live(0)     # С одного адреса (X-Forwarded-For); 0 - без лимита
+    trusted_proxies: list = live(default_factory=list)  # Адреса и сети прокси, которым верим X-Forwarded-For; loopback - всегда
+    max_pending_opens: int = live(256)      # Соединений, еще не приславших OPEN; 0 - без лимита
+    open_deadline: float = live(5)          # Срок на OPEN (сокращается при заполнении очереди)
+    conn_rate_per_ip: float = live(50)      # Новых соединений в секунду с одного адреса; 0 - без лимита
+    pid_file: str = "server.pid"            # Относительно каталога socks5 (см. lifecycle.py)
+    drain_timeout: float = live(30)         # SIGTERM: сколько ждать завершения открытых потоков
+    resume_grace: float = live(60)          # Сколько держать цель возобновляемого потока после обрыва (resume.py)
+    resume_buffer_bytes: int = live(4 * 2 ** 20)  # Неподтвержденных данных на поток; дальше чтение из цели ждет
+    data_path: str = live("streams")        # "buffered" - передача на протоколах asyncio с пулом буферов (fastpath.py)
+    crypto_offload_bytes: int = live(256 * 1024)  # Кадры от этого размера шифруются в пуле потоков (crypto_pool.py); 0 - все в цикле
+    crypto_threads: int = live(0)           # Потоков пула шифрования; 0 - по числу CPU, но не больше 4
+    log_level: str = live("INFO")
+
+
+@dataclass(frozen=True)
+class ClientSettings:
+    socks_host: str = "127.0.0.1"
+    socks_port: int = 1080
+    max_size: int = live(2 ** 22)
+    ping_interval: float = live(20)
+    ping_timeout: float = live(20)
+    read_chunk_size: int = live(65536)
+    # fast - SOCKS успех сразу, первые данные уходят вместе с OPEN;
+    # strict - ждать результата подключения шлюза и вернуть настоящий код SOCKS;
+    # json - старый текстовый OPEN (для шлюзов старых версий)
+    open_mode: str = live("fast")
+    early_data_wait: float = live(0.02)     # Сколько ждать первые данные приложения для OPEN
+    open_timeout: float = live(15)          # strict: ожидание RESULT от шлюза
+    udp_idle_timeout: float = live(120)     # UDP ASSOCIATE без трафика закрывается
+    dns_listen: str = ""                    # Локальный DNS через туннель, например "127.0.0.1:5353"
+    dns_cache_size: int = 4096
+    compression: str = live("off")          # "off", "zlib" или "zstd" (нужен pip install zstandard)
+    compression_level: int = live(3)
+    users: dict = live(default_factory=dict)  # Логины SOCKS5 и лимиты (см. auth.py); пусто - без пароля
+    tunnel_rate_kbps: float = live(0)       # Общий темп отправки в туннель (scheduler.py); 0 - без лимита
+    priority_ports: dict = live(default_factory=lambda: dict(INTERACTIVE_PORTS))
+    routes: dict = live(default_factory=dict)   # Правила tunnel/direct/block (см. routing.py)
+    route_default: str = live("tunnel")
+    discovery_interval: float = live(5)     # Как часто проверять адрес шлюза (client.py --discovery)
+    resumable: bool = live(False)           # Потоки переживают обрыв WebSocket (resume.py); нужен новый шлюз
+    resume_grace: float = live(30)          # Сколько пытаться продолжить поток после обрыва
+    resume_buffer_bytes: int = live(4 * 2 ** 20)
+    bond_mode: str = live("stream")         # Несколько --wss: "stream" - по соединениям, "chunk" - частями (bonding.py)
+    data_path: str = live("streams")        # "buffered" - см. fastpath.py
+    crypto_offload_bytes: int = live(256 * 1024)  # См. crypto_pool.py
+    crypto_threads: int = live(0)
+    log_level: str = live("INFO")
+
+
+@dataclass(frozen=True)
+class ManagerSettings:
+    bot_token: str = ""
+    chat_id: str = ""
+    allowed_user_id: str = ""
+    restart_interval_seconds: float = live(0)            # Плановый перезапуск; 0 - только по телеметрии, падению и health check
+    health_check_interval_seconds: float = live(60)
+    telemetry_interval_seconds: float = live(30)         # Замер ресурсов vk-tunnel (tunnel_core/telemetry.py); 0 - выключено
+    leak_window_seconds: float = live(3600)              # Окно, за которое рост RSS/FD считается утечкой
+    leak_rss_mb_per_hour: float = live(50)               # 0 - не следить
+    leak_fds_per_hour: float = live(200)
+    spin_cpu_percent: float = live(95)                   # CPU не ниже этого spin_seconds подряд - зацикливание; 0 - не следить
+    spin_seconds: float = live(600)
+    tunnel_host: str = "127.0.0.1"
+    tunnel_port: int = 8080
+    log_filename: str = "manager.log"
+    log_level: str = live("INFO")
+    key_rotation_interval_seconds: float = live(0)       # 0 - ротация только вручную (/rotate-key)
+    key_grace_seconds: float = live(24 * 3600)           # Сколько старый ключ еще принимается
+    discovery_file: str = "discovery.txt"                # Подписанный текущий WSS URL для client.py --discovery
+    discovery_listen: str = ""                           # Раздавать его по HTTP, например "0.0.0.0:8765"; "" - нет
+    state_file: str = "manager_state.json"               # PID и адрес vk-tunnel: перезапуск менеджера не трогает туннель
+    tunnel_output_file: str = "vk-tunnel.out"            # Вывод vk-tunnel (менеджер читает его из файла)
+    fleet_listen: str = ""                               # Стать координатором флота, например "0.0.0.0:8790"; "" - нет
+    fleet_coordinator: str = ""                          # Подключиться к координатору узлом ("host:8790"); бот не опрашивается
+    fleet_secret: str = ""                               # Общий секрет флота (HMAC), одинаковый на всех узлах
+    fleet_node_name: str = ""                            # Имя узла в /status all; "" - имя хоста
+    fleet_timeout_seconds: float = live(10)              # Сколько ждать ответа узла на /status
+    fleet_restart_timeout_seconds: float = live(180)     # Сколько ждать, пока перезапущенный туннель получит адрес
+    fleet_max_down: int = live(1)                        # Туннелей флота, перезапускаемых одновременно
+
+
+@dataclass(frozen=True)
+class Settings:
+    aes_key_hex: str = ""                  # "<hex>" или "<id>:<hex>"; используется, пока нет keyring_file
+    keyring_file: str = "keyring.json"
+    server: ServerSettings = field(default_factory=ServerSettings)
+    client: ClientSettings = field(default_factory=ClientSettings)
+    manager: ManagerSettings = field(default_factory=ManagerSettings)
+
+
+def _coerce(value: Any, typ: type, path: str) -> Any:
+    try:
+        if typ is bool and isinstance(value, str):
+            return value.strip().lower() in ("1", "true", "yes", "on")
+        if typ is int and isinstance(value, str):
+            return int(value, 0)
+        if typ is dict and isinstance(value, str):
+            return json.loads(value)
+        if typ is list and isinstance(value, str):
+            return [item.strip() for item in value.split(",") if item.strip()]
+        return typ(value)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{path}: ожидается {typ.__name__}, получено {value!r}") from e
+
+
+def _build(cls, data: Dict[str, Any], prefix: str = ""):
+    """Сборка dataclass из словаря с приведением типов"""
+    if not isinstance(data, dict):
+        raise ValueError(f"{prefix or 'config'}: ожидается объект")
+    kwargs = {}
+    for f in fields(cls):
+        path = f"{prefix}{f.name}"
+        if f.name not in data:
+            continue
+        if is_dataclass(f.type):
+            kwargs[f.name] = _build(f.type, data[f.name], f"{path}.")
+        else:
+            kwargs[f.name] = _coerce(data[f.name], f.type, path)
+    return cls(**kwargs)
+
+
+def _flatten(obj, prefix: str = "") -> Dict[str, Tuple[Any, bool]]:
+    """{'server.port': (значение, live)}"""
+    flat = {}
+    for f in fields(obj):
+        value = getattr(obj, f.name)
+        if is_dataclass(value):
+            flat.update(_flatten(value, f"{prefix}{f.name}."))
+        else:
+            flat[f"{prefix}{f.name}"] = (value, f.metadata.get('live', False))
+    return flat
+
+
+def _unflatten(flat: Dict[str, Any]) -> Dict[str, Any]:
+    data: Dict[str, Any] = {}
+    for path, value in flat.items():
+        node = data
+        *parents, name = path.split(".")
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[name] = value
+    return data
+
+
+def _merge(base: Dict[str, Any], override: Dict[str, Any]):
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+
+
+def read_config_light(path: str = CONFIG_FILE) -> Dict[str, Any]:
+    """Словарь CONFIG из config_light.py без выполнения кода файла"""
+    with open(path, 'r', encoding='utf-8') as f:
+        tree = ast.parse(f.read(), filename=path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "CONFIG" for t in node.targets):
+            return ast.literal_eval(node.value)
+    raise ValueError(f"{path}: не найден словарь CONFIG")
+
+
+def _env_overrides() -> Dict[str, Any]:
+    flat = {}
+    for path in _flatten(Settings()):
+        env_name = ENV_PREFIX + path.replace(".", "_").upper()
+        if env_name in os.environ:
+            flat[path] = os.environ[env_name]
+    return _unflatten(flat)
+
+
+def load_settings() -> Settings:
+    """Загрузка и разбор конфигурации из всех источников"""
+    data: Dict[str, Any] = {}
+    if os.path.exists(CONFIG_FILE):
+        _merge(data, read_config_light())
+    if os.path.exists(JSON_FILE):
+        with open(JSON_FILE, 'r', encoding='utf-8') as f:
+            _merge(data, json.load(f))
+    _merge(data, _env_overrides())
+    return _build(Settings, data)
+
+
+class SettingsStore:
+    def __init__(self):
+        self._current: Settings = None
+        self._callbacks: List[Callable[[Settings], None]] = []
+
+    def current(self) -> Settings:
+        """Кэшированная разобранная конфигурация"""
+        if self._current is None:
+            self._current = load_settings()
+        return self._current
+
+    def subscribe(self, callback: Callable[[Settings], None]):
+        """Callback вызывается после каждого применения новой конфигурации"""
+        self._callbacks.append(callback)
+
+    def reload(self, settings: Optional[Settings] = None) -> Tuple[Dict[str, tuple], Dict[str, tuple]]:
+        """Перечитать конфигурацию; возвращает (примененные, требующие перезапуска) изменения.
+
+        settings - уже прочитанная load_settings(): читать файлы можно в потоке, а применять
+        (и вызывать callback'и) нужно в цикле событий.
+        """
+        old = _flatten(self.current())
+        new = _flatten(settings or load_settings())
+
+        applied, pending = {}, {}
+        merged = {}
+        for path, (value, is_live) in new.items():
+            old_value = old[path][0]
+            if value != old_value:
+                if is_live:
+                    applied[path] = (old_value, value)
+                else:
+                    pending[path] = (old_value, value)
+                    value = old_value
+            merged[path] = value
+
+        if applied:
+            self._current = _build(Settings, _unflatten(merged))
+            for callback in self._callbacks:
+                try:
+                    callback(self._current)
+                except Exception as e:
+                    log.error(f"Ошибка при применении конфигурации: {e}")
+
+        for path, (old_value, value) in applied.items():
+            log.info(f"Конфигурация: {path} {old_value!r} -> {value!r}")
+        for path in pending:
+            log.warning(f"Конфигурация: {path} изменится только после перезапуска")
+        return applied, pending
+
+    def reload_safely(self) -> Tuple[Dict[str, tuple], Dict[str, tuple]]:
+        """reload() с логированием ошибок (для обработчика сигнала)"""
+        try:
+            return self.reload()
+        except Exception as e:
+            log.error(f"Не удалось перечитать конфигурацию, остается текущая: {e}")
+            return {}, {}
+
+
+def format_changes(applied: Dict[str, tuple], pending: Dict[str, tuple]) -> str:
+    """Человекочитаемое описание изменений для /reload"""
+    if not applied and not pending:
+        return "Изменений нет"
+    lines = [f"✅ `{path}`: `{old}` → `{new}`" for path, (old, new) in applied.items()]
+    lines += [f"⏸️ `{path}`: требуется перезапуск" for path in pending]
+    return "\n".join(lines)
+
+
+def install_reload_signal():
+    """SIGHUP перечитывает конфигурацию (где сигнал поддерживается)"""
+    if not hasattr(signal, "SIGHUP"):
+        return
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, store.reload_safely)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+
+def apply_log_level(level: str):
+    logging.getLogger().setLevel(getattr(logging, level.upper(), logging.INFO))
+
+
+store = SettingsStore()
+
+
+def get_settings() -> Settings:
+    return store.current()
@@ -1,180 +1,180 @@
 import asyncio
 import logging
 import os
-import re
 import signal
 import subprocess
-from typing import Optional, Dict, Any
+import sys
+from typing import Optional
 
-import aiohttp
-from admin import AdminManager  # Добавляем импорт
+from tunnel_core import BaseTelegramHandler
+from key_rotation import format_key_spec, keyring_path, load_keyring, rotate_keyring
+from lifecycle import pid_alive, pid_file_path, read_pid
+from settings import BASE_DIR, format_changes, get_settings, load_settings, store
 
 log = logging.getLogger("telegram")
 
-class TelegramCommandHandler:
-    def __init__(self, bot_token: str, allowed_user_id: int, state: Dict[str, Any]):
-        self.bot_token = bot_token
-        self.owner_id = allowed_user_id  # Главный администратор (владелец)
-        self.state = state
-        self.manual_restart_event = asyncio.Event()
-        self.admin_manager = AdminManager()  # Создаем менеджер администраторов
-        
-        # Добавляем владельца в администраторы при первом запуске
-        if allowed_user_id not in self.admin_manager.admins:
-            self.admin_manager.add_admin(allowed_user_id)
-    
-    def is_admin(self, user_id: int) -> bool:
-        """Проверка прав администратора"""
-        return self.admin_manager.is_admin(user_id)
-    
-    def is_owner(self, user_id: int) -> bool:
-        """Проверка, является ли пользователь владельцем"""
-        return user_id == self.owner_id
+SERVER_START_TIMEOUT = 10   # Сколько ждать, пока новый server.py начнет слушать порт
 
-    async def send_message(self, text: str, chat_id: str):
-        """Отправка сообщения в Telegram"""
-        if len(text) > 4096:
-            text = text[:4090] + "\n[...]"
-
-        url = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
-        payload = {'chat_id': chat_id, 'text': text, 'parse_mode': 'Markdown'}
-
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, data=payload, timeout=10) as response:
-                    if response.status == 200:
-                        log.info(f"Сообщение в чат {chat_id} успешно отправлено.")
-                    else:
-                        log.error(f"Ошибка отправки в Telegram: {response.status}, {await response.text()}")
-        except Exception as e:
-            log.error(f"Исключение при отправке в Telegram: {e}")
+class TelegramCommandHandler(BaseTelegramHandler):
+    help_public = [
+        "/key - Получить AES ключ из конфигурации",
+        "/help - Показать это сообщение",
+    ]
+    help_admin = BaseTelegramHandler.help_admin + [
+        "/restart-server - Перезапустить server.py без разрыва соединений",
+        "/reload - Перечитать конфигурацию без перезапуска",
+        "/rotate-key - Выпустить новый AES ключ (старый еще принимается)",
+    ]
 
     async def get_aes_key(self) -> Optional[str]:
-        """Извлечение AES ключа из config_light.py"""
+        """Текущий ключ в виде <id>:<hex> из keyring.json (или aes_key_hex, пока ротаций не было)"""
         try:
-            with open('config_light.py', 'r', encoding='utf-8') as f:
-                content = f.read()
-
-            # Ищем паттерн "aes_key_hex": "значение"
-            match = re.search(r'"aes_key_hex"\s*:\s*"([^"]*)"', content)
-            if match:
-                return match.group(1)
-            return None
+            settings = get_settings()
+            if not settings.aes_key_hex and not os.path.exists(keyring_path(settings)):
+                return ""
+            keyring = await asyncio.to_thread(load_keyring)
+            return format_key_spec(keyring.current_id, keyring.key(keyring.current_id))
         except Exception as e:
             log.error(f"Ошибка при чтении AES ключа: {e}")
             return None
 
-    async def restart_server(self) -> tuple[bool, str]:
-        """Перезапуск server.py"""
+    async def rotate_key(self, chat_id: str) -> bool:
+        """Новый текущий ключ; шлюз подхватит его из keyring.json, открытые потоки не рвутся"""
+        settings = get_settings()
         try:
-            # Находим PID процесса server.py
-            result = subprocess.run(['pgrep', '-f', 'server.py'],
-                                  capture_output=True, text=True)
-
-            if result.returncode != 0 or not result.stdout.strip():
-                return False, "Процесс server.py не найден"
-
-            pids = result.stdout.strip().split('\n')
-
-            # Убиваем процессы
-            for pid in pids:
-                try:
-                    os.kill(int(pid), signal.SIGKILL)
-                    log.info(f"Процесс server.py (PID: {pid}) остановлен")
-                except Exception as e:
-                    log.error(f"Ошибка при остановке PID {pid}: {e}")
+            key_id, key = await asyncio.to_thread(rotate_keyring, keyring_path(settings), settings.aes_key_hex,
+                                                  settings.manager.key_grace_seconds)
+        except Exception as e:
+            log.error(f"Ошибка при ротации ключа: {e}")
+            await self.send_message(f"❌ Не удалось выпустить новый ключ: {e}", chat_id)
+            return False
+
+        spec = format_key_spec(key_id, key)
+        grace_hours = settings.manager.key_grace_seconds / 3600
+        message = (f'🔑 <b>Новый AES ключ (ID {key_id})</b>\n\n<span class="tg-spoiler">{spec}</span>\n\n'
+                   f'Предыдущий ключ принимается еще {grace_hours:.0f} ч. На клиенте выполните:\n'
+                   f'<code>python key_rotation.py add &lt;ключ&gt;</code>')
+        if not await self.send_message(message, chat_id, parse_mode='HTML'):
+            await self.send_message(f"🔑 *Новый AES ключ (ID {key_id}):*\n`{spec}`", chat_id)
+        return True
 
-            # Ждем немного
-            await asyncio.sleep(2)
+    async def restart_server(self) -> tuple[bool, str]:
+        """Перезапуск server.py без разрыва соединений (см. lifecycle.py)"""
+        try:
+            pid_path = pid_file_path()
+            old_pid = read_pid(pid_path)
+            if old_pid is not None and not pid_alive(old_pid):
+                old_pid = None
+
+            # Сначала новый экземпляр: он встанет на тот же порт через SO_REUSEPORT
+            process = subprocess.Popen([sys.executable, 'server.py'], cwd=BASE_DIR,
+                                       stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL,
+                                       start_new_session=True)
+            started = await self._wait_for_pid(pid_path, process, SERVER_START_TIMEOUT)
+
+            # Старый перестает принимать соединения и доживает с открытыми потоками
+            if old_pid is not None and old_pid != process.pid:
+                os.kill(old_pid, signal.SIGTERM)
+                log.info(f"server.py (PID: {old_pid}): SIGTERM, открытые потоки завершаются")
+            if not started:
+                # Старый экземпляр без SO_REUSEPORT освободит порт только после SIGTERM
+                started = await self._wait_for_pid(pid_path, process, SERVER_START_TIMEOUT)
+
+            if not started:
+                if process.poll() is None:
+                    process.terminate()
+                return False, "Не удалось запустить server.py, подробности в логе шлюза"
+            drain = get_settings().server.drain_timeout
+            message = f"Server.py перезапущен. Новый PID: {process.pid}"
+            if old_pid is not None:
+                message += f"; старый ({old_pid}) закроется, когда завершатся его соединения (до {drain:.0f} с)"
+            return True, message
 
-            # Запускаем заново через nohup
-            subprocess.Popen(['nohup', 'python', 'server.py'],
-                           stdout=subprocess.DEVNULL,
-                           stderr=subprocess.DEVNULL,
-                           preexec_fn=os.setpgrp)
+        except Exception as e:
+            log.error(f"Критическая ошибка при перезапуске server.py: {e}")
+            return False, f"Ошибка: {str(e)}"
 
-            await asyncio.sleep(2)
+    def reload_report(self, applied: dict, pending: dict) -> str:
+        """Ответ на /reload: здесь применяются только настройки менеджера.
+
+        Шлюз - отдельный процесс, ему уходит SIGHUP, и он перечитывает конфигурацию сам;
+        client.* живет на машине пользователя, и бот его не касается.
+        """
+        def section(changes: dict, prefix: str) -> dict:
+            return {path: change for path, change in changes.items() if path.startswith(prefix)}
+
+        def own(changes: dict) -> dict:
+            return {path: change for path, change in changes.items()
+                    if not path.startswith(("server.", "client."))}
+
+        gateway = {**section(applied, "server."), **section(pending, "server.")}
+        client = {**section(applied, "client."), **section(pending, "client.")}
+        lines = []
+        if own(applied) or own(pending) or not (gateway or client):
+            lines.append(format_changes(own(applied), own(pending)))
+        if gateway:
+            pid = self.signal_gateway()
+            status = (f"шлюзу (PID: {pid}) отправлен SIGHUP, он применит их сам" if pid
+                      else "шлюз не запущен, они вступят в силу при запуске")
+            lines.append(f"📨 `{'`, `'.join(gateway)}`: {status}")
+        if client:
+            lines.append(f"ℹ️ `{'`, `'.join(client)}`: применяются на клиенте (`kill -HUP` клиенту)")
+        return "\n".join(lines)
+
+    def signal_gateway(self) -> Optional[int]:
+        """SIGHUP работающему server.py по его PID-файлу; None - шлюз не запущен"""
+        if not hasattr(signal, "SIGHUP"):
+            return None
+        pid = read_pid(pid_file_path())
+        if pid is None or not pid_alive(pid):
+            return None
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError as e:
+            log.error(f"Не удалось отправить SIGHUP шлюзу (PID: {pid}): {e}")
+            return None
+        log.info(f"server.py (PID: {pid}): SIGHUP, конфигурация перечитывается")
+        return pid
+
+    async def _wait_for_pid(self, pid_path: str, process: subprocess.Popen, timeout: float) -> bool:
+        """Новый server.py записывает PID-файл, когда уже слушает порт"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while asyncio.get_running_loop().time() < deadline:
+            if read_pid(pid_path) == process.pid:
+                return True
+            if process.poll() is not None:
+                return False
+            await asyncio.sleep(0.2)
+        return False
+
+    async def send_log(self, command: str, chat_id: str):
+        """Последние 20 строк из manager.log"""
+        try:
+            with open('manager.log', 'r', encoding='utf-8') as f:
+                lines = f.readlines()
 
-            # Проверяем, что запустился
-            check_result = subprocess.run(['pgrep', '-f', 'server.py'],
-                                        capture_output=True, text=True)
+            last_lines = lines[-20:]
+            if not last_lines:
+                await self.send_message("ℹ️ Лог-файл пока пуст.", chat_id)
+                return
 
-            if check_result.returncode == 0 and check_result.stdout.strip():
-                new_pids = check_result.stdout.strip().split('\n')
-                return True, f"Server.py успешно перезапущен. Новые PID: {', '.join(new_pids)}"
-            else:
-                return False, "Не удалось запустить server.py"
+            log_output = "".join(last_lines)
+            response_text = f"📄 *Последние 20 строк из лога:*\n\n```{log_output}```"
+            await self.send_message(response_text, chat_id)
 
+        except FileNotFoundError:
+            await self.send_message("⚠️ Лог-файл еще не создан.", chat_id)
         except Exception as e:
-            log.error(f"Критическая ошибка при перезапуске server.py: {e}")
-            return False, f"Ошибка: {str(e)}"
+            await self.send_message(f"❌ Не удалось прочитать лог-файл: {e}", chat_id)
 
     async def handle_command(self, command: str, chat_id: str, user_id: int):
         """Обработка команды"""
-        # Команды управления администраторами (только для владельца)
-        if command.startswith("/add-admin"):
-            if not self.is_owner(user_id):
-                await self.send_message("❌ Только владелец может добавлять администраторов", chat_id)
-                return
-            
-            parts = command.split()
-            if len(parts) != 2:
-                await self.send_message("❌ Использование: `/add-admin USER_ID`", chat_id)
-                return
-            
-            try:
-                new_admin_id = int(parts[1])
-                success, message = self.admin_manager.add_admin(new_admin_id)
-                if success:
-                    await self.send_message(f"✅ {message}", chat_id)
-                else:
-                    await self.send_message(f"⚠️ {message}", chat_id)
-            except ValueError:
-                await self.send_message("❌ USER_ID должен быть числом", chat_id)
-        
-        elif command.startswith("/remove-admin"):
-            if not self.is_owner(user_id):
-                await self.send_message("❌ Только владелец может удалять администраторов", chat_id)
-                return
-            
-            parts = command.split()
-            if len(parts) != 2:
-                await self.send_message("❌ Использование: `/remove-admin USER_ID`", chat_id)
-                return
-            
-            try:
-                admin_id = int(parts[1])
-                if admin_id == self.owner_id:
-                    await self.send_message("❌ Нельзя удалить владельца из администраторов", chat_id)
-                    return
-                
-                success, message = self.admin_manager.remove_admin(admin_id)
-                if success:
-                    await self.send_message(f"✅ {message}", chat_id)
-                else:
-                    await self.send_message(f"⚠️ {message}", chat_id)
-            except ValueError:
-                await self.send_message("❌ USER_ID должен быть числом", chat_id)
-        
-        elif command == "/admin-list":
+        if command == "/restart-server":
             if not self.is_admin(user_id):
-                await self.send_message("❌ Доступ запрещен", chat_id)
+                await self.send_message("❌ Доступ запрещен.", chat_id)
                 return
-            
-            admin_info = self.admin_manager.get_admin_info()
-            await self.send_message(admin_info, chat_id)
-        
-        # Проверка доступа для критичных команд (теперь для всех администраторов)
-        restricted_commands = ['/restart-tunnel', '/restart-server', '/status', '/log']
-        if command in restricted_commands and not self.is_admin(user_id):
-            await self.send_message("❌ Доступ запрещен.", chat_id)
-            return
 
-        if command == "/restart-tunnel":
-            await self.send_message("✅ Принято! Инициирую перезапуск туннеля...", chat_id)
-            self.manual_restart_event.set()
-
-        elif command == "/restart-server":
             await self.send_message("⏳ Перезапускаю server.py...", chat_id)
             success, message = await self.restart_server()
             if success:
@@ -182,41 +182,25 @@ class TelegramCommandHandler:
             else:
                 await self.send_message(f"❌ {message}", chat_id)
 
-        elif command == "/status":
-            if self.state.get('process_pid') and self.state.get('process_start_time'):
-                import time
-                uptime_seconds = int(time.time() - self.state['process_start_time'])
-
-                # Исправляем: используем время последней активности процесса
-                last_activity = self.state.get('last_health_check_time', self.state.get('process_start_time'))
-                last_activity_seconds = int(time.time() - last_activity)
-
-                status_text = (f"📊 *Статус менеджера vk-tunnel*\n\n"
-                             f"PID процесса: `{self.state['process_pid']}`\n"
-                             f"Время работы: `{uptime_seconds // 3600}ч {(uptime_seconds % 3600) // 60}м {uptime_seconds % 60}с`\n"
-                             f"Последняя проверка здоровья: `{last_activity_seconds}с назад`\n")
-                await self.send_message(status_text, chat_id)
-            else:
-                await self.send_message("ℹ️ Процесс vk-tunnel не запущен.", chat_id)
+        elif command == "/reload":
+            if not self.is_admin(user_id):
+                await self.send_message("❌ Доступ запрещен.", chat_id)
+                return
 
-        elif command == "/log":
             try:
-                with open('manager.log', 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-
-                last_lines = lines[-20:]
-                if not last_lines:
-                    await self.send_message("ℹ️ Лог-файл пока пуст.", chat_id)
-                    return
+                fresh = await asyncio.to_thread(load_settings)
+            except Exception as e:
+                await self.send_message(f"❌ Ошибка в конфигурации, оставлена текущая: `{e}`", chat_id)
+                return
+            applied, pending = store.reload(fresh)   # Callback'и менеджера - в цикле событий
+            await self.send_message(f"🔄 *Конфигурация перечитана*\n\n{self.reload_report(applied, pending)}", chat_id)
 
-                log_output = "".join(last_lines)
-                response_text = f"📄 *Последние 20 строк из лога:*\n\n```{log_output}```"
-                await self.send_message(response_text, chat_id)
+        elif command == "/rotate-key":
+            if not self.is_admin(user_id):
+                await self.send_message("❌ Доступ запрещен.", chat_id)
+                return
 
-            except FileNotFoundError:
-                await self.send_message("⚠️ Лог-файл еще не создан.", chat_id)
-            except Exception as e:
-                await self.send_message(f"❌ Не удалось прочитать лог-файл: {e}", chat_id)
+            await self.rotate_key(chat_id)
 
         elif command == "/key":
             # Команда доступна всем в группе
@@ -226,91 +210,15 @@ class TelegramCommandHandler:
                     # Используем HTML для спойлера
                     message = f'🔐 <b>AES ключ:</b>\n\n<span class="tg-spoiler">{aes_key}</span>\n\n<i>Нажмите на затемненный текст, чтобы увидеть ключ</i>'
 
-                    # Отправляем с HTML parse mode
-                    url = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
-                    payload = {'chat_id': chat_id, 'text': message, 'parse_mode': 'HTML'}
-
-                    try:
-                        async with aiohttp.ClientSession() as session:
-                            async with session.post(url, data=payload, timeout=10) as response:
-                                if response.status == 200:
-                                    log.info(f"AES ключ отправлен в чат {chat_id} (как спойлер)")
-                                else:
-                                    # Если не удалось со спойлером, отправляем обычным способом
-                                    await self.send_message(f"🔐 *AES ключ:*\n`{aes_key}`", chat_id)
-                    except Exception as e:
-                        log.error(f"Ошибка при отправке спойлера: {e}")
-                        # Fallback на обычную отправку
+                    if await self.send_message(message, chat_id, parse_mode='HTML'):
+                        log.info(f"AES ключ отправлен в чат {chat_id} (как спойлер)")
+                    else:
+                        # Если не удалось со спойлером, отправляем обычным способом
                         await self.send_message(f"🔐 *AES ключ:*\n`{aes_key}`", chat_id)
                 else:
                     await self.send_message("ℹ️ AES ключ не установлен (пустое значение)", chat_id)
             else:
                 await self.send_message("❌ Не удалось получить AES ключ из config_light.py", chat_id)
 
-        elif command == "/help":
-            # Команда помощи доступна всем
-            help_text = """📋 *Доступные команды:*
-
-/key - Получить AES ключ из конфигурации
-/help - Показать это сообщение
-
-*Команды администратора:*
-/status - Статус vk-tunnel
-/log - Последние 20 строк лога
-/restart-tunnel - Перезапустить vk-tunnel
-/restart-server - Перезапустить server.py
-/admin-list - Список администраторов"""
-            
-            if self.is_owner(user_id):
-                help_text += """
-
-*Команды владельца:*
-/add-admin USER_ID - Добавить администратора
-/remove-admin USER_ID - Удалить администратора"""
-            
-            await self.send_message(help_text, chat_id)
-
         else:
-            # Неизвестная команда - не отвечаем
-            pass
-
-    async def listen_for_commands(self):
-        """Основной цикл прослушивания команд"""
-        last_update_id = 0
-        log.info("Запуск слушателя команд Telegram...")
-
-        while True:
-            try:
-                async with asyncio.timeout(60):
-                    url = f"https://api.telegram.org/bot{self.bot_token}/getUpdates"
-                    params = {'offset': last_update_id + 1, 'timeout': 50}
-
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(url, params=params) as response:
-                            if response.status != 200:
-                                log.error(f"Ошибка API Telegram: {response.status}")
-                                await asyncio.sleep(10)
-                                continue
-
-                            data = await response.json()
-
-                            for update in data.get("result", []):
-                                last_update_id = update["update_id"]
-                                message = update.get("message")
-
-                                if not (message and "text" in message):
-                                    continue
-
-                                user_id = message["from"]["id"]
-                                chat_id = message["chat"]["id"]
-                                command = message["text"].strip()
-
-                                # Обрабатываем только команды (начинаются с /)
-                                if command.startswith('/'):
-                                    await self.handle_command(command, str(chat_id), user_id)
-
-            except asyncio.TimeoutError:
-                continue
-            except Exception as e:
-                log.error(f"Критическая ошибка в слушателе Telegram: {e}. Перезапуск через 10с...")
-                await asyncio.sleep(10)
\ No newline at end of file
+            await super().handle_command(command, chat_id, user_id)
@@ -1,249 +1,189 @@
 import asyncio
+import importlib.util
 import logging
-import socket
+import os
 import sys
 import time
-from asyncio.subprocess import PIPE
-from logging.handlers import TimedRotatingFileHandler
 
-try:
-    import aiohttp
-except ImportError:
-    print("Ошибка: модуль aiohttp не найден. Установите его: pip install aiohttp", file=sys.stderr)
-    sys.exit(1)
+STARTED_AT = time.perf_counter()
 
+# Общее ядро менеджеров лежит в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tunnel_core import TunnelSupervisor, new_state, setup_logging
 from telegram_commands import TelegramCommandHandler
+from discovery import discovery_path, publish, seal_document
+from dns_tunnel import parse_endpoint
+from key_rotation import KEYRING_POLL_SECONDS, KeyringWatcher, keyring_path, load_keyring, newest_key_created
+from settings import BASE_DIR, get_settings, store, install_reload_signal, apply_log_level
+
+# Настройки (BOT_TOKEN, CHAT_ID, интервалы) задаются в разделе "manager" файла config_light.py
+
 
-# --- НАСТРОЙКИ (РЕДАКТИРОВАТЬ ЗДЕСЬ) ---
-BOT_TOKEN = ""
-CHAT_ID = ""
-ALLOWED_USER_ID = ""
-
-RESTART_INTERVAL_SECONDS = 5 * 3600  # 5 часов
-HEALTH_CHECK_INTERVAL_SECONDS = 60  # Проверять каждую минуту
-TUNNEL_HOST = "127.0.0.1"
-TUNNEL_PORT = 8080
-LOG_FILENAME = 'manager.log'
-
-VK_TUNNEL_COMMAND = [
-    "vk-tunnel", "--verbose", "--insecure=1", "--http-protocol=http", "--ws-protocol=ws",
-    "--ws-origin=0", "--host", TUNNEL_HOST, "--port", str(TUNNEL_PORT),
-    "--ws-ping-interval=30"
-]
-# ----------------------------------------------------
-
-# Проверка конфигурации при старте
-if not all([BOT_TOKEN, CHAT_ID, ALLOWED_USER_ID]):
-    print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
-    print("Пожалуйста, откройте скрипт и заполните переменные BOT_TOKEN, CHAT_ID и ALLOWED_USER_ID.", file=sys.stderr)
-    sys.exit(1)
-
-try:
-    ALLOWED_USER_ID = int(ALLOWED_USER_ID)
-except (ValueError, TypeError):
-    print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
-    print("ALLOWED_USER_ID должен быть числом.", file=sys.stderr)
-    sys.exit(1)
-
-# --- КОНФИГУРАЦИЯ ЛОГОВ С АВТОМАТИЧЕСКОЙ РОТАЦИЕЙ ---
-log_formatter = logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s")
-file_handler = TimedRotatingFileHandler(LOG_FILENAME, when='midnight', interval=1, backupCount=7, encoding='utf-8')
-file_handler.setFormatter(log_formatter)
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setFormatter(log_formatter)
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO)
-root_logger.addHandler(file_handler)
-root_logger.addHandler(console_handler)
+def vk_tunnel_command(tunnel_host: str, tunnel_port: int) -> list:
+    return [
+        "vk-tunnel", "--verbose", "--insecure=1", "--http-protocol=http", "--ws-protocol=ws",
+        "--ws-origin=0", "--host", tunnel_host, "--port", str(tunnel_port),
+        "--ws-ping-interval=30"
+    ]
 
 log = logging.getLogger("manager")
-log_vktunnel = logging.getLogger("vk-tunnel")
-log_telegram = logging.getLogger("telegram")
-
-# --- ГЛОБАЛЬНОЕ СОСТОЯНИЕ ---
-STATE = {
-    'notification_sent': False,
-    'process_start_time': None,
-    'last_output_time': None,
-    'process_pid': None,
-    'last_health_check_time': None  # Добавляем отслеживание времени последней проверки
-}
-
-def get_server_info():
-    try:
-        hostname = socket.getfqdn()
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.connect(("8.8.8.8", 80))
-            ip_address = s.getsockname()[0]
-        return ip_address, hostname
-    except Exception:
-        return "127.0.0.1", "localhost"
-
-SERVER_IP, SERVER_HOSTNAME = get_server_info()
-
-# Создаем обработчик команд
-telegram_handler = TelegramCommandHandler(BOT_TOKEN, ALLOWED_USER_ID, STATE)
-
-async def send_telegram_message(text: str, chat_id=None):
-    """Отправка сообщения в Telegram (для обратной совместимости)"""
-    target_chat_id = chat_id or CHAT_ID
-    await telegram_handler.send_message(text, target_chat_id)
-
-async def monitor_stream(stream: asyncio.StreamReader):
-    """Мониторинг вывода процесса"""
-    while True:
-        try:
-            line_bytes = await stream.readline()
-            if not line_bytes:
-                log.warning("Поток вывода процесса был закрыт.")
-                break
-
-            STATE['last_output_time'] = time.time()
-            line = line_bytes.decode('utf-8', errors='ignore').strip()
-            log_vktunnel.info(line)
-
-            if not STATE['notification_sent'] and line.startswith("wss:"):
-                try:
-                    wss_url = line.split(maxsplit=1)[1]
-                    log.info(f"Обнаружен WSS адрес: {wss_url}. Отправка уведомления...")
-                    message = (f"🚀 *VK Tunnel запущен/перезапущен*\n\n"
-                               f"🖥️ *Сервер:* `{SERVER_HOSTNAME}`\n"
-                               f"🌐 *IP:* `{SERVER_IP}`\n\n"
-                               f"📒 *Инструкция:*\nhttps://github.com/Hopper65S/VK-TUN/blob/main/README.md\n\n"
-                               f"✨ *Команда для подключения:*\n`python client.py --wss {wss_url}`")
-                    await send_telegram_message(message)
-                    STATE['notification_sent'] = True
-                except IndexError:
-                    log.warning(f"Не удалось извлечь URL из строки: '{line}'")
-        except asyncio.CancelledError:
-            break
-
-async def check_tunnel_health():
-    """Проверка здоровья туннеля"""
-    log.info(f"Активная проверка здоровья запущена. Интервал: {HEALTH_CHECK_INTERVAL_SECONDS}с.")
-    await asyncio.sleep(15)  # Даем время на запуск
-
-    while True:
+
+
+class Socks5Supervisor(TunnelSupervisor):
+    """vk-tunnel для SOCKS5-шлюза: перезапуск по телеметрии и рассылка команды подключения"""
+
+    def apply_settings(self, settings):
+        """Интервалы и пороги телеметрии читаются на каждом цикле, поэтому меняются без перезапуска"""
+        cfg = settings.manager
+        self.restart_interval = cfg.restart_interval_seconds
+        self.health_check_interval = cfg.health_check_interval_seconds
+        self.telemetry_interval = cfg.telemetry_interval_seconds
+        self.restart_policy.configure(cfg.leak_window_seconds, cfg.leak_rss_mb_per_hour, cfg.leak_fds_per_hour,
+                                      cfg.spin_cpu_percent, cfg.spin_seconds)
+        if self.fleet_agent is not None:
+            self.fleet_agent.timeout = cfg.fleet_timeout_seconds
+            self.fleet_agent.restart_timeout = cfg.fleet_restart_timeout_seconds
+            self.fleet_agent.max_down = cfg.fleet_max_down
+
+    discovery_document = None   # Последний опубликованный документ (для HTTP)
+
+    def background_tasks(self):
+        tasks = {"key_rotation": self.rotate_keys_periodically(),
+                 "discovery_keys": self.republish_on_key_change()}
+        if get_settings().manager.discovery_listen:
+            tasks["discovery"] = self.serve_discovery(get_settings().manager.discovery_listen)
+        return tasks
+
+    async def publish_discovery(self, wss_url: str):
+        """Подписанный текущим ключом адрес для client.py --discovery"""
         try:
-            reader, writer = await asyncio.open_connection(TUNNEL_HOST, TUNNEL_PORT)
-            writer.close()
-            await writer.wait_closed()
-
-            # Обновляем время последней успешной проверки
-            STATE['last_health_check_time'] = time.time()
-            log.info(f"Health check: порт {TUNNEL_HOST}:{TUNNEL_PORT} доступен.")
-
-        except ConnectionRefusedError:
-            log.error(f"HEALTH CHECK FAILED: порт {TUNNEL_HOST}:{TUNNEL_PORT} не отвечает. Инициирую перезапуск.")
-            telegram_handler.manual_restart_event.set()
-            break
-        except asyncio.CancelledError:
-            log.info("Активная проверка здоровья остановлена.")
-            break
+            keyring = await asyncio.to_thread(load_keyring)
+            self.discovery_document = seal_document(keyring, wss_url)
+            if get_settings().manager.discovery_file:
+                await asyncio.to_thread(publish, discovery_path(), self.discovery_document)
+            log.info(f"Адрес опубликован для клиентов с --discovery (ключи {sorted(keyring.keys)}, "
+                     f"текущий {keyring.current_id})")
         except Exception as e:
-            log.error(f"Неизвестная ошибка при проверке порта: {e}")
-
-        await asyncio.sleep(HEALTH_CHECK_INTERVAL_SECONDS)
-
-async def manage_vk_tunnel_lifecycle():
-    """Основной цикл управления жизненным циклом vk-tunnel"""
-    while True:
-        log.info(f"Запуск нового цикла. Следующий плановый перезапуск через {RESTART_INTERVAL_SECONDS / 3600:.1f} часов.")
-        STATE.update({
-            'notification_sent': False,
-            'process_start_time': time.time(),
-            'last_output_time': time.time(),
-            'process_pid': None,
-            'last_health_check_time': time.time()
-        })
-        telegram_handler.manual_restart_event.clear()
+            log.error(f"Не удалось опубликовать адрес: {e}")
 
+    async def republish_on_key_change(self):
+        """Документ зашифрован всеми действующими ключами: после ротации или истечения перекрытия - заново"""
+        watcher, failed = None, False
+        while True:
+            try:
+                if watcher is None:
+                    watcher = await asyncio.to_thread(KeyringWatcher, keyring_path())
+                elif await asyncio.to_thread(watcher.check) and self.state.get('current_wss_url'):
+                    await self.publish_discovery(self.state['current_wss_url'])
+                failed = False
+            except Exception as e:
+                if not failed:   # Не повторяем одну и ту же ошибку каждые несколько секунд
+                    log.error(f"Не удалось прочитать набор ключей: {e}")
+                failed = True
+            await asyncio.sleep(KEYRING_POLL_SECONDS)
+
+    async def serve_discovery(self, listen: str):
+        """GET /discovery - последний документ; без ключа он бесполезен, поэтому отдается всем"""
+        from aiohttp import web
+
+        async def get_document(request):
+            if self.discovery_document is None:
+                return web.Response(status=503, text="not ready\n")
+            return web.Response(text=self.discovery_document + "\n", headers={"Cache-Control": "no-store"})
+
+        app = web.Application()
+        app.router.add_get("/discovery", get_document)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        host, port = parse_endpoint(listen, 8765)
+        await web.TCPSite(runner, host, port).start()
+        log.info(f"Discovery: http://{listen}/discovery")
         try:
-            process = await asyncio.create_subprocess_exec(
-                *VK_TUNNEL_COMMAND,
-                stdout=PIPE,
-                stderr=PIPE,
-                stdin=None
-            )
-            STATE['process_pid'] = process.pid
-            log.info(f"Процесс vk-tunnel запущен с PID: {process.pid}")
-        except FileNotFoundError:
-            log.critical("Команда 'vk-tunnel' не найдена! Повтор через 30с...")
-            await asyncio.sleep(30)
-            continue
-        except Exception as e:
-            log.critical(f"Не удалось запустить процесс vk-tunnel: {e}. Повтор через 30с...")
-            await asyncio.sleep(30)
-            continue
-
-        # Создаем задачи мониторинга
-        monitor_stdout_task = asyncio.create_task(monitor_stream(process.stdout))
-        monitor_stderr_task = asyncio.create_task(monitor_stream(process.stderr))
-        health_check_task = asyncio.create_task(check_tunnel_health())
-
-        # Создаем задачи ожидания событий
-        wait_process_task = asyncio.create_task(process.wait())
-        wait_timer_task = asyncio.create_task(asyncio.sleep(RESTART_INTERVAL_SECONDS))
-        wait_command_task = asyncio.create_task(telegram_handler.manual_restart_event.wait())
-
-        # Ждем первое событие
-        done, pending = await asyncio.wait(
-            [wait_process_task, wait_timer_task, wait_command_task, health_check_task],
-            return_when=asyncio.FIRST_COMPLETED
-        )
-
-        # Определяем причину остановки
-        reason = "неизвестная причина"
-        if wait_process_task in done:
-            reason = f"процесс завершился сам с кодом {process.returncode}"
-        elif wait_timer_task in done:
-            reason = "сработал плановый таймер"
-        elif wait_command_task in done:
-            reason = "получена команда или сработал health check"
-        elif health_check_task in done:
-            reason = "health check обнаружил проблему"
-
-        log.warning(f"Инициирован перезапуск vk-tunnel (PID: {process.pid}). Причина: {reason}.")
-
-        # Отменяем все незавершенные задачи
-        for task in pending:
-            task.cancel()
-
-        monitor_stdout_task.cancel()
-        monitor_stderr_task.cancel()
-        health_check_task.cancel()
-
-        await asyncio.gather(
-            monitor_stdout_task,
-            monitor_stderr_task,
-            health_check_task,
-            return_exceptions=True
-        )
-
-        # Завершаем процесс, если он еще работает
-        if process.returncode is None:
+            await asyncio.Future()
+        finally:
+            await runner.cleanup()
+
+    async def rotate_keys_periodically(self):
+        """Плановая ротация AES ключа; интервал читается заново, поэтому меняется через /reload"""
+        while True:
+            interval = get_settings().manager.key_rotation_interval_seconds
+            if interval <= 0:
+                await asyncio.sleep(60)
+                continue
             try:
-                process.terminate()
-                await asyncio.wait_for(process.wait(), timeout=5)
-                log.info(f"Процесс {process.pid} успешно завершен (terminate).")
-            except asyncio.TimeoutError:
-                log.warning(f"Процесс {process.pid} не ответил на terminate. Убиваем (kill)...")
-                process.kill()
-                await process.wait()
+                created = await asyncio.to_thread(newest_key_created, keyring_path(), get_settings().aes_key_hex)
+            except Exception as e:
+                log.error(f"Не удалось прочитать набор ключей: {e}")
+                await asyncio.sleep(60)
+                continue
+            due = (created or time.time()) + interval
+            if time.time() < due:
+                await asyncio.sleep(min(due - time.time(), 60))
+                continue
+            if not await self.handler.rotate_key(self.chat_id):
+                await asyncio.sleep(60)  # Не повторяем ошибку в цикле
+
+    async def on_wss_url(self, wss_url: str, host):
+        await self.publish_discovery(wss_url)
+        server_ip, server_hostname = await self.server_info()
+        message = (f"🚀 *VK Tunnel запущен/перезапущен*\n\n"
+                   f"🖥️ *Сервер:* `{server_hostname}`\n"
+                   f"🌐 *IP:* `{server_ip}`\n\n"
+                   f"📒 *Инструкция:*\nhttps://github.com/Hopper65S/VK-TUN/blob/main/README.md\n\n"
+                   f"✨ *Команда для подключения:*\n`python client.py --wss {wss_url}`")
+        listen = get_settings().manager.discovery_listen
+        if listen:
+            message += (f"\n\n🔁 *Без ручной смены адреса:*\n"
+                        f"`python client.py --discovery http://{server_ip}:{parse_endpoint(listen, 8765)[1]}/discovery`")
+        await self.send_message(message)
+
+
+def check_config(cfg) -> int:
+    """Проверка конфигурации при старте; возвращает ALLOWED_USER_ID числом"""
+    if importlib.util.find_spec("aiohttp") is None:
+        print("Ошибка: модуль aiohttp не найден. Установите его: pip install aiohttp", file=sys.stderr)
+        sys.exit(1)
+
+    if not all([cfg.bot_token, cfg.chat_id, cfg.allowed_user_id]):
+        print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
+        print("Пожалуйста, заполните bot_token, chat_id и allowed_user_id в разделе \"manager\" файла config_light.py.", file=sys.stderr)
+        sys.exit(1)
+
+    if (cfg.fleet_listen or cfg.fleet_coordinator) and not cfg.fleet_secret:
+        print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
+        print("Для флота (fleet_listen/fleet_coordinator) заполните fleet_secret в разделе \"manager\".", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        return int(cfg.allowed_user_id)
+    except (ValueError, TypeError):
+        print("!!! КРИТИЧЕСКАЯ ОШИБКА !!!", file=sys.stderr)
+        print("ALLOWED_USER_ID должен быть числом.", file=sys.stderr)
+        sys.exit(1)
 
-        log.info("Пауза 5 секунд перед перезапуском...")
-        await asyncio.sleep(5)
 
 async def main():
     """Главная функция"""
+    settings = get_settings()
+    cfg = settings.manager
+    allowed_user_id = check_config(cfg)
+    setup_logging(cfg.log_filename)
+    apply_log_level(cfg.log_level)
     log.info("Запуск менеджера vk-tunnel с управлением через Telegram.")
-    log.info(f"Конфигурация: BOT_TOKEN={'*' * 10}, CHAT_ID={CHAT_ID}, ALLOWED_USER_ID={ALLOWED_USER_ID}")
-
-    # Запускаем обе задачи параллельно
-    await asyncio.gather(
-        manage_vk_tunnel_lifecycle(),
-        telegram_handler.listen_for_commands()
-    )
+    log.info(f"Конфигурация: BOT_TOKEN={'*' * 10}, CHAT_ID={cfg.chat_id}, ALLOWED_USER_ID={allowed_user_id}")
+
+    telegram_handler = TelegramCommandHandler(cfg.bot_token, allowed_user_id, new_state())
+    supervisor = Socks5Supervisor(telegram_handler, cfg.chat_id, cfg.tunnel_host, cfg.tunnel_port,
+                                  vk_tunnel_command(cfg.tunnel_host, cfg.tunnel_port), started_at=STARTED_AT)
+    supervisor.state_file = os.path.join(BASE_DIR, cfg.state_file)
+    supervisor.output_file = os.path.join(BASE_DIR, cfg.tunnel_output_file)
+    supervisor.configure_fleet(cfg.fleet_listen, cfg.fleet_coordinator, cfg.fleet_secret, cfg.fleet_node_name)
+    supervisor.apply_settings(settings)
+    store.subscribe(supervisor.apply_settings)
+    store.subscribe(lambda new_settings: apply_log_level(new_settings.manager.log_level))
+    install_reload_signal()
+    await supervisor.run()
 
 if __name__ == "__main__":
     try:
@@ -252,4 +192,4 @@ if __name__ == "__main__":
         log.info("Менеджер остановлен пользователем.")
     except Exception as e:
         log.critical(f"Критическая ошибка: {e}", exc_info=True)
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,7 @@
+"""Общее ядро менеджеров vk-tunnel: жизненный цикл, Telegram-бот, администраторы, профилирование, телеметрия, флот.
+
+Варианты (socks5/vk_tunnel_manager.py, remnawave/main.py) наследуют TunnelSupervisor
+и BaseTelegramHandler и переопределяют хуки.
+"""
+from .supervisor import TunnelSupervisor, get_server_info, new_state, setup_logging
+from .telegram import BaseTelegramHandler
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import logging
+from typing import Dict, List, Optional
+
+from .persistence import write_json_atomic
+
+log = logging.getLogger("admin")
+
+# Уровни ролей: чем больше число, тем больше прав
+ROLE_VIEWER = 1   # статус и логи
+ROLE_ADMIN = 2    # управление туннелем
+ROLE_OWNER = 3    # управление администраторами
+ROLE_NAMES = {ROLE_VIEWER: "viewer", ROLE_ADMIN: "admin", ROLE_OWNER: "owner"}
+
+SAVE_DELAY_SECONDS = 0.5      # Отложенная запись: изменения за это окно пишутся одним разом
+WATCH_INTERVAL_SECONDS = 5    # Как часто проверять, не изменил ли файл другой процесс
+
+
+def parse_role(name: str) -> Optional[int]:
+    """Разбор названия роли (viewer/admin)"""
+    for level, role_name in ROLE_NAMES.items():
+        if role_name == name.strip().lower():
+            return level
+    return None
+
+
+class AdminManager:
+    def __init__(self, admin_file: str = "admins.json"):
+        self.admin_file = admin_file
+        self._mtime: Optional[float] = None
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+        self.roles: Dict[int, int] = self.load_admins()
+
+    @property
+    def admins(self) -> List[int]:
+        """Список всех пользователей с ролями (для обратной совместимости)"""
+        return list(self.roles)
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.admin_file).st_mtime
+        except OSError:
+            return None
+
+    def _read_file(self) -> Dict[int, int]:
+        self._mtime = self._file_mtime()
+        with open(self.admin_file, 'r') as f:
+            data = json.load(f)
+        # Старый формат хранит только список ID - считаем их администраторами
+        roles = {int(admin_id): ROLE_ADMIN for admin_id in data.get('admins', [])}
+        roles.update({int(admin_id): int(level) for admin_id, level in data.get('roles', {}).items()})
+        return roles
+
+    def load_admins(self) -> Dict[int, int]:
+        """Загрузка администраторов и их ролей из файла"""
+        if os.path.exists(self.admin_file):
+            try:
+                roles = self._read_file()
+                log.info(f"Загружено {len(roles)} администраторов")
+                return roles
+            except Exception as e:
+                log.error(f"Ошибка при загрузке администраторов: {e}")
+                return {}
+        else:
+            log.info("Файл администраторов не найден, создаю новый")
+            return {}
+
+    def _write_atomic(self, roles: Dict[int, int]):
+        """Атомарная запись: читатели не увидят половину файла"""
+        # В 'admins' только роли admin и выше - старые версии читают этот список
+        write_json_atomic(self.admin_file,
+                          {'admins': sorted(i for i, level in roles.items() if level >= ROLE_ADMIN),
+                           'roles': {str(admin_id): level for admin_id, level in sorted(roles.items())}},
+                          prefix=".admins-")
+        self._mtime = self._file_mtime()
+
+    def save_admins(self):
+        """Сохранение администраторов: в фоне вне event loop, если он запущен"""
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save_now()
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._save_later())
+
+    def save_now(self):
+        """Немедленная синхронная запись (при старте и при остановке)"""
+        if not self._dirty:
+            return
+        try:
+            self._dirty = False
+            self._write_atomic(dict(self.roles))
+            log.info(f"Список администраторов сохранен ({len(self.roles)} записей)")
+        except Exception as e:
+            self._dirty = True
+            log.error(f"Ошибка при сохранении администраторов: {e}")
+
+    async def _save_later(self):
+        await asyncio.sleep(SAVE_DELAY_SECONDS)
+        while self._dirty:
+            self._dirty = False
+            snapshot = dict(self.roles)
+            try:
+                await asyncio.to_thread(self._write_atomic, snapshot)
+                log.info(f"Список администраторов сохранен ({len(snapshot)} записей)")
+            except Exception as e:
+                self._dirty = True
+                log.error(f"Ошибка при сохранении администраторов: {e}")
+                return
+
+    async def watch(self):
+        """Отслеживание изменений файла другими процессами менеджера"""
+        try:
+            while True:
+                await asyncio.sleep(WATCH_INTERVAL_SECONDS)
+                mtime = self._file_mtime()
+                # Пока есть несохраненные изменения, наша запись важнее
+                if mtime is None or mtime == self._mtime or self._dirty:
+                    continue
+                try:
+                    self.roles = await asyncio.to_thread(self._read_file)
+                    log.info(f"Файл администраторов изменен извне, перечитан ({len(self.roles)} записей)")
+                except Exception as e:
+                    log.error(f"Ошибка при перечитывании администраторов: {e}")
+        except asyncio.CancelledError:
+            self.save_now()
+            raise
+
+    def ensure_owner(self, user_id: int):
+        """Владелец всегда присутствует в реестре с ролью owner"""
+        if self.roles.get(user_id) != ROLE_OWNER:
+            self.roles[user_id] = ROLE_OWNER
+            self.save_admins()
+
+    def add_admin(self, user_id: int, role: int = ROLE_ADMIN) -> tuple[bool, str]:
+        """Добавление администратора"""
+        if self.roles.get(user_id) == role:
+            return False, f"Пользователь {user_id} уже имеет роль {ROLE_NAMES[role]}"
+        if self.roles.get(user_id) == ROLE_OWNER:
+            return False, f"Пользователь {user_id} является владельцем"
+
+        self.roles[user_id] = role
+        self.save_admins()
+        return True, f"Пользователь {user_id} добавлен с ролью {ROLE_NAMES[role]}"
+
+    def remove_admin(self, user_id: int) -> tuple[bool, str]:
+        """Удаление администратора"""
+        if user_id not in self.roles:
+            return False, f"Пользователь {user_id} не является администратором"
+
+        del self.roles[user_id]
+        self.save_admins()
+        return True, f"Пользователь {user_id} удален из администраторов"
+
+    def get_role(self, user_id: int) -> int:
+        """Уровень роли пользователя (0 - нет прав)"""
+        return self.roles.get(user_id, 0)
+
+    def has_role(self, user_id: int, level: int) -> bool:
+        """Проверка, что роль пользователя не ниже указанной"""
+        return self.roles.get(user_id, 0) >= level
+
+    def is_admin(self, user_id: int) -> bool:
+        """Проверка, является ли пользователь администратором"""
+        return self.roles.get(user_id, 0) >= ROLE_ADMIN
+
+    def get_admin_list(self) -> List[int]:
+        """Получение списка всех администраторов"""
+        return sorted(self.roles)
+
+    def get_admin_info(self) -> str:
+        """Получение информации об администраторах для отображения"""
+        if not self.roles:
+            return "Список администраторов пуст"
+
+        admin_list = "\n".join([f"• `{admin_id}` - {ROLE_NAMES.get(level, level)}"
+                                for admin_id, level in sorted(self.roles.items(), key=lambda x: (-x[1], x[0]))])
+        return f"👥 *Администраторы ({len(self.roles)}):*\n\n{admin_list}"
@@ -0,0 +1,445 @@
+"""Флот: один Telegram-бот управляет менеджерами на многих серверах.
+
+Менеджер-координатор (fleet_listen) опрашивает Telegram и принимает подключения узлов;
+менеджеры-узлы (fleet_coordinator) бота не опрашивают, а подключаются к координатору
+по TCP и выполняют его команды. Сам координатор - тоже узел флота.
+
+Канал аутентифицирован общим секретом (fleet_secret), но не зашифрован: ключи по нему
+не передаются. Подключение начинается с обмена случайными числами и HMAC-доказательств
+в обе стороны; из них выводится ключ сессии, и каждое следующее сообщение подписано
+HMAC с номером по порядку - подделать, повторить или переставить сообщения нельзя.
+
+Команды расходятся по узлам параллельно, у каждого узла свой таймаут. Перезапуск
+нескольких туннелей - волнами: одновременно лежит не больше max_down туннелей, а после
+первой неудачи новые перезапуски не начинаются.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Tuple
+
+from .telegram import format_duration
+
+log = logging.getLogger("fleet")
+
+PROTOCOL = "vktun-fleet/1"
+MESSAGE_LIMIT = 2 ** 20             # Строка протокола; ответ /status меньше 4 КБ
+HANDSHAKE_TIMEOUT = 10
+RECONNECT_SECONDS = (1, 2, 5, 10, 30)
+RESTART_POLL_SECONDS = 0.5
+PING_SECONDS = 30                   # Проверка связи с узлом; узел без сообщений IDLE_SECONDS переподключается
+IDLE_SECONDS = 3 * PING_SECONDS
+CALL_MARGIN_SECONDS = 5             # Координатор ждет перезапуск дольше узла: узел сам сообщит о таймауте
+
+
+class FleetError(Exception):
+    pass
+
+
+def parse_address(value: str, default_port: int = 8790) -> Tuple[str, int]:
+    """'host:port', 'host' или '[v6]:port'"""
+    host, sep, port = value.rpartition(":")
+    if not sep or host.count(":") and not host.startswith("["):
+        return value.strip("[]"), default_port
+    return host.strip("[]") or "0.0.0.0", int(port)
+
+
+def _mac(key: bytes, *parts: str) -> str:
+    return hmac.new(key, "|".join(parts).encode(), hashlib.sha256).hexdigest()
+
+
+class Channel:
+    """JSON-строки с HMAC ключа сессии и номером сообщения"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, key: bytes,
+                 send_label: str, recv_label: str):
+        self.reader = reader
+        self.writer = writer
+        self.key = key
+        self.send_label = send_label    # Направление входит в подпись: свое сообщение не вернуть отправителю
+        self.recv_label = recv_label
+        self.sent = 0
+        self.received = 0
+
+    async def send(self, message: Dict[str, Any]):
+        self.sent += 1
+        body = json.dumps(message, ensure_ascii=False)
+        mac = _mac(self.key, self.send_label, str(self.sent), body)
+        self.writer.write(json.dumps({"seq": self.sent, "body": body, "mac": mac}).encode() + b"\n")
+        await self.writer.drain()
+
+    async def recv(self) -> Dict[str, Any]:
+        line = await _read_line(self.reader)
+        try:
+            frame = json.loads(line)
+            seq, body, mac = frame["seq"], frame["body"], frame["mac"]
+        except (ValueError, KeyError, TypeError):
+            raise FleetError("поврежденное сообщение")
+        if seq != self.received + 1 or not hmac.compare_digest(mac, _mac(self.key, self.recv_label, str(seq), body)):
+            raise FleetError("неверная подпись сообщения")
+        self.received = seq
+        return json.loads(body)
+
+    def close(self):
+        self.writer.close()
+
+
+async def _read_line(reader: asyncio.StreamReader) -> bytes:
+    """Строка протокола; длиннее MESSAGE_LIMIT - такая же ошибка протокола, как битый JSON"""
+    try:
+        line = await reader.readline()
+    except (ValueError, asyncio.LimitOverrunError):
+        raise FleetError("поврежденное сообщение")
+    if not line:
+        raise FleetError("соединение закрыто")
+    return line
+
+
+async def _read_json(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    line = await _read_line(reader)
+    try:
+        message = json.loads(line)
+    except ValueError:
+        raise FleetError("поврежденное сообщение")
+    if not isinstance(message, dict):
+        raise FleetError("поврежденное сообщение")
+    return message
+
+
+def _write_json(writer: asyncio.StreamWriter, message: Dict[str, Any]):
+    writer.write(json.dumps(message).encode() + b"\n")
+
+
+class FleetAgent:
+    """Команды флота для своего менеджера: одинаково у координатора и у узла"""
+
+    def __init__(self, supervisor, name: str):
+        self.supervisor = supervisor
+        self.state = supervisor.state
+        self.name = name
+        self.timeout: float = 10              # Ответ узла на /status
+        self.restart_timeout: float = 180     # Туннель должен снова получить адрес
+        self.max_down: int = 1                # Туннелей, одновременно лежащих при волне перезапусков
+        self.restarting = asyncio.Lock()
+
+    def summary(self) -> str:
+        """Одна строка для /status all"""
+        if self.state.get('is_stopped'):
+            return "⛔ остановлен после падений (нужен /start)"
+        if not (self.state.get('process_pid') and self.state.get('process_start_time')):
+            return "⏳ vk-tunnel не запущен"
+        uptime = format_duration(int(time.time() - self.state['process_start_time']))
+        text = f"✅ PID `{self.state['process_pid']}`, `{uptime}`"
+        text += f", `{self.state['current_host']}`" if self.state.get('current_host') else ", адрес еще не получен"
+        if self.state.get('total_crashes'):
+            text += f", падений: {self.state['total_crashes']}"
+        return text
+
+    def status(self) -> str:
+        if self.state.get('process_pid') and self.state.get('process_start_time'):
+            return self.supervisor.handler.format_status()
+        return "ℹ️ Процесс vk-tunnel не запущен."
+
+    async def restart(self, timeout: float) -> Tuple[bool, str]:
+        """Перезапуск и ожидание нового адреса: True - туннель снова работает"""
+        if self.state.get('is_stopped'):
+            return False, "туннель остановлен после падений (нужен /start)"
+        if self.restarting.locked():
+            return False, "перезапуск уже идет"
+        async with self.restarting:
+            old_pid = self.state.get('process_pid')
+            started = time.monotonic()
+            self.supervisor.handler.manual_restart_event.set()
+            while time.monotonic() - started < timeout:
+                await asyncio.sleep(RESTART_POLL_SECONDS)
+                if self.state.get('process_pid') not in (None, old_pid) and self.state.get('notification_sent'):
+                    return True, (f"перезапущен за {time.monotonic() - started:.0f}с, "
+                                  f"`{self.state.get('current_host') or 'адрес получен'}`")
+            return False, f"туннель не поднялся за {timeout:.0f}с"
+
+    async def execute(self, request: Dict[str, Any]) -> Tuple[bool, str]:
+        command = request.get("cmd")
+        if command == "ping":
+            return True, "pong"
+        if command == "summary":
+            return True, self.summary()
+        if command == "status":
+            return True, self.status()
+        if command == "restart":
+            return await self.restart(min(float(request.get("timeout") or self.restart_timeout), self.restart_timeout))
+        return False, f"неизвестная команда {command!r}"
+
+
+class Peer:
+    """Подключенный узел на стороне координатора"""
+
+    def __init__(self, name: str, channel: Channel, address: str):
+        self.name = name
+        self.channel = channel
+        self.address = address
+        self.connected_at = time.time()
+        self.calls: Dict[int, asyncio.Future] = {}
+        self.next_id = 0
+
+    async def call(self, request: Dict[str, Any]) -> Tuple[bool, str]:
+        self.next_id += 1
+        call_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.calls[call_id] = future
+        try:
+            await self.channel.send(dict(request, id=call_id))
+            return await future
+        finally:
+            self.calls.pop(call_id, None)
+
+    async def read_replies(self):
+        while True:
+            reply = await self.channel.recv()
+            future = self.calls.get(reply.get("id"))
+            if future is not None and not future.done():
+                future.set_result((bool(reply.get("ok")), str(reply.get("text", ""))))
+
+    async def keepalive(self):
+        """Узел, который не отвечает на ping, отключается: иначе он числился бы подключенным"""
+        while True:
+            await asyncio.sleep(PING_SECONDS)
+            try:
+                async with asyncio.timeout(PING_SECONDS):
+                    await self.call({"cmd": "ping"})
+            except (asyncio.TimeoutError, FleetError, OSError):
+                log.warning(f"Узел {self.name} не ответил на ping")
+                self.channel.close()
+                return
+
+    def fail_calls(self, error: Exception):
+        for future in self.calls.values():
+            if not future.done():
+                future.set_exception(error)
+
+
+class FleetCoordinator:
+    """Принимает узлы и раздает им команды бота"""
+
+    def __init__(self, agent: FleetAgent, secret: str, listen: str):
+        self.agent = agent
+        self.secret = secret.encode()
+        self.listen = listen
+        self.peers: Dict[str, Peer] = {}
+        self.last_seen: Dict[str, float] = {}   # Отключившиеся узлы остаются в /status all
+        self.down = 0                            # Туннелей флота, перезапускаемых прямо сейчас
+        self.slot_freed = asyncio.Condition()
+
+    def names(self) -> List[str]:
+        return [self.agent.name] + sorted(set(self.last_seen) - {self.agent.name})
+
+    def resolve(self, targets: List[str]) -> Tuple[List[str], List[str]]:
+        """Известные и неизвестные узлы из аргументов команды; 'all' - все узлы"""
+        if targets == ["all"]:
+            return self.names(), []
+        names = list(dict.fromkeys(name for target in targets for name in target.split(",") if name))
+        known = set(self.names())
+        return [name for name in names if name in known], [name for name in names if name not in known]
+
+    async def serve(self):
+        host, port = parse_address(self.listen)
+        server = await asyncio.start_server(self._accept, host, port, limit=MESSAGE_LIMIT)
+        log.info(f"Координатор флота слушает {self.listen}")
+        async with server:
+            await server.serve_forever()
+
+    async def _handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Tuple[str, Channel]:
+        challenge = os.urandom(16).hex()
+        _write_json(writer, {"protocol": PROTOCOL, "challenge": challenge})
+        hello = await _read_json(reader)
+        name, nonce, proof = str(hello.get("node", "")), str(hello.get("nonce", "")), str(hello.get("mac", ""))
+        if not name or len(nonce) != 32 or not hmac.compare_digest(proof, _mac(self.secret, "hello", challenge, nonce, name)):
+            raise FleetError("неверный секрет флота")
+        _write_json(writer, {"mac": _mac(self.secret, "welcome", nonce, challenge, name)})
+        await writer.drain()
+        key = hmac.new(self.secret, f"session|{challenge}|{nonce}".encode(), hashlib.sha256).digest()
+        return name, Channel(reader, writer, key, "coordinator", "node")
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info("peername")
+        address = f"{address[0]}:{address[1]}" if address else "?"
+        try:
+            async with asyncio.timeout(HANDSHAKE_TIMEOUT):
+                name, channel = await self._handshake(reader, writer)
+        except (FleetError, OSError, asyncio.TimeoutError) as e:
+            log.warning(f"Узел {address} не принят: {e or 'таймаут'}")
+            writer.close()
+            return
+        if name == self.agent.name:
+            log.warning(f"Узел {address} назвался именем координатора ({name}) и не принят")
+            writer.close()
+            return
+
+        peer = Peer(name, channel, address)
+        previous = self.peers.get(name)
+        if previous is not None:
+            log.warning(f"Узел {name} переподключился с {address}; старое соединение закрыто")
+            previous.channel.close()
+        self.peers[name] = peer
+        self.last_seen[name] = time.time()
+        log.info(f"Узел {name} подключен ({address})")
+        keepalive_task = asyncio.create_task(peer.keepalive())
+        try:
+            await peer.read_replies()
+        except (FleetError, OSError) as e:
+            log.warning(f"Узел {name} отключен: {e}")
+        finally:
+            keepalive_task.cancel()
+            peer.fail_calls(FleetError("узел отключился"))
+            if self.peers.get(name) is peer:
+                del self.peers[name]
+                self.last_seen[name] = time.time()
+            writer.close()
+
+    async def call(self, name: str, request: Dict[str, Any], timeout: float) -> Tuple[bool, str]:
+        """Команда одному узлу (или своему менеджеру); ошибки и таймауты - в ответе"""
+        try:
+            async with asyncio.timeout(timeout):
+                if name == self.agent.name:
+                    return await self.agent.execute(request)
+                peer = self.peers.get(name)
+                if peer is None:
+                    return False, "не подключен"
+                return await peer.call(request)
+        except asyncio.TimeoutError:
+            return False, f"нет ответа за {timeout:.0f}с"
+        except (FleetError, OSError) as e:
+            return False, str(e)
+
+    async def fan_out(self, names: List[str], request: Dict[str, Any], timeout: float) -> List[Tuple[str, bool, str]]:
+        """Одна команда всем узлам параллельно: медленный узел не задерживает ответ остальных"""
+        results = await asyncio.gather(*(self.call(name, request, timeout) for name in names))
+        return [(name, ok, text) for name, (ok, text) in zip(names, results)]
+
+    async def _take_slot(self):
+        """Семафор на весь флот, а не на одну команду: две волны подряд тоже не превысят max_down.
+        Предел читается при каждом ожидании, поэтому max_down меняется на лету."""
+        async with self.slot_freed:
+            await self.slot_freed.wait_for(lambda: self.down < max(1, self.agent.max_down))
+            self.down += 1
+
+    async def _release_slot(self):
+        async with self.slot_freed:
+            self.down -= 1
+            self.slot_freed.notify_all()
+
+    async def rolling_restart(self, names: List[str]) -> List[Tuple[str, bool, str]]:
+        """Перезапуск узлов волнами: не больше max_down туннелей лежат одновременно"""
+        timeout = self.agent.restart_timeout
+        failed = False
+
+        async def restart(name: str) -> Tuple[bool, str]:
+            nonlocal failed
+            await self._take_slot()
+            try:
+                if failed:
+                    return False, "пропущен: перезапуск другого узла не удался"
+                log.info(f"Флот: перезапуск {name}")
+                ok, text = await self.call(name, {"cmd": "restart", "timeout": timeout},
+                                           timeout + CALL_MARGIN_SECONDS)
+                failed = failed or not ok
+                return ok, text
+            finally:
+                await self._release_slot()
+
+        results = await asyncio.gather(*(restart(name) for name in names))
+        return [(name, ok, text) for name, (ok, text) in zip(names, results)]
+
+    @staticmethod
+    def format_results(title: str, results: List[Tuple[str, bool, str]]) -> str:
+        succeeded = sum(ok for _, ok, _ in results)
+        text = f"{title} ({succeeded} из {len(results)})\n\n"
+        return text + "".join(f"`{name}`: {line if ok else '❌ ' + line}\n" for name, ok, line in results)
+
+    def format_nodes(self) -> str:
+        """Ответ на /fleet"""
+        text = f"🛰️ *Узлы флота:* {len(self.names())}\n\n`{self.agent.name}` - координатор\n"
+        for name in self.names()[1:]:
+            peer = self.peers.get(name)
+            if peer is not None:
+                text += f"`{name}` - {peer.address}, подключен `{format_duration(int(time.time() - peer.connected_at))}`\n"
+            else:
+                text += f"`{name}` - ⚠️ отключен `{format_duration(int(time.time() - self.last_seen[name]))}`\n"
+        return text
+
+
+class FleetNode:
+    """Подключение менеджера к координатору; переподключается сам"""
+
+    def __init__(self, agent: FleetAgent, secret: str, coordinator: str):
+        self.agent = agent
+        self.secret = secret.encode()
+        self.coordinator = coordinator
+
+    async def _handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Channel:
+        greeting = await _read_json(reader)
+        if greeting.get("protocol") != PROTOCOL:
+            raise FleetError(f"координатор говорит на {greeting.get('protocol')!r}, нужен {PROTOCOL}")
+        challenge, nonce, name = str(greeting.get("challenge", "")), os.urandom(16).hex(), self.agent.name
+        _write_json(writer, {"node": name, "nonce": nonce, "mac": _mac(self.secret, "hello", challenge, nonce, name)})
+        await writer.drain()
+        welcome = await _read_json(reader)
+        # Координатор тоже доказывает знание секрета: чужому узел команды не отдаст
+        if not hmac.compare_digest(str(welcome.get("mac", "")), _mac(self.secret, "welcome", nonce, challenge, name)):
+            raise FleetError("координатор не подтвердил секрет флота")
+        key = hmac.new(self.secret, f"session|{challenge}|{nonce}".encode(), hashlib.sha256).digest()
+        return Channel(reader, writer, key, "node", "coordinator")
+
+    async def _answer(self, channel: Channel, request: Dict[str, Any]):
+        try:
+            ok, text = await self.agent.execute(request)
+        except Exception as e:
+            log.error(f"Флот: ошибка команды {request.get('cmd')!r}: {e}")
+            ok, text = False, f"ошибка: {e}"
+        try:
+            await channel.send({"id": request.get("id"), "ok": ok, "text": text})
+        except OSError:
+            pass   # Соединение уже закрыто: координатор получит таймаут
+
+    async def serve(self, channel: Channel):
+        tasks = set()
+        try:
+            while True:
+                async with asyncio.timeout(IDLE_SECONDS):
+                    request = await channel.recv()
+                # Каждая команда в своей задаче: перезапуск не задерживает ответ на /status
+                task = asyncio.create_task(self._answer(channel, request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run(self):
+        host, port = parse_address(self.coordinator)
+        attempt = 0
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port, limit=MESSAGE_LIMIT)
+            except OSError as e:
+                delay = RECONNECT_SECONDS[min(attempt, len(RECONNECT_SECONDS) - 1)]
+                attempt += 1
+                log.warning(f"Координатор флота {self.coordinator} недоступен: {e}. Повтор через {delay}с")
+                await asyncio.sleep(delay)
+                continue
+            try:
+                async with asyncio.timeout(HANDSHAKE_TIMEOUT):
+                    channel = await self._handshake(reader, writer)
+                attempt = 0
+                log.info(f"Подключен к координатору флота {self.coordinator} как {self.agent.name}")
+                await self.serve(channel)
+            except (FleetError, OSError, asyncio.TimeoutError) as e:
+                log.warning(f"Соединение с координатором флота прервано: {e or 'таймаут'}")
+            finally:
+                writer.close()
+            delay = RECONNECT_SECONDS[min(attempt, len(RECONNECT_SECONDS) - 1)]
+            attempt += 1
+            await asyncio.sleep(delay)
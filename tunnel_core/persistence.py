@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+from typing import Any, Dict, Optional
+
+log = logging.getLogger("persistence")
+
+STATE_SAVE_DELAY_SECONDS = 1.0   # Изменения за это окно (например, смещение в выводе) пишутся одним разом
+
+# Что переживает перезапуск менеджера; объекты процесса и телеметрии восстанавливаются заново
+PERSISTED_KEYS = (
+    'process_pid', 'process_ticks', 'process_start_time', 'current_wss_url', 'current_host',
+    'notification_sent', 'total_crashes', 'telemetry_restarts', 'is_stopped', 'output_offset',
+)
+
+
+def write_json_atomic(path: str, data: Any, prefix: str = ".state-"):
+    """Временный файл + fsync + rename: после падения в любой момент файл целый - старый или новый"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=prefix, suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class StateStore:
+    """Состояние менеджера в JSON-файле: атомарная отложенная запись, как у AdminManager"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+        self._state: Optional[Dict[str, Any]] = None
+
+    def load(self) -> Dict[str, Any]:
+        """Сохраненные поля; пусто, если файла нет или он поврежден"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.error(f"Состояние менеджера не прочитано ({self.path}): {e}")
+            return {}
+        return {key: data[key] for key in PERSISTED_KEYS if key in data}
+
+    def _write_atomic(self, data: Dict[str, Any]):
+        write_json_atomic(self.path, data)
+
+    @staticmethod
+    def snapshot(state: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: state.get(key) for key in PERSISTED_KEYS}
+
+    def save(self, state: Dict[str, Any]):
+        """Записать state в фоне вне event loop (или сразу, если loop не запущен)"""
+        self._state = state
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save_now()
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._save_later())
+
+    def save_now(self):
+        """Немедленная синхронная запись (при остановке менеджера)"""
+        if not self._dirty or self._state is None:
+            return
+        try:
+            self._dirty = False
+            self._write_atomic(self.snapshot(self._state))
+        except Exception as e:
+            self._dirty = True
+            log.error(f"Ошибка при сохранении состояния менеджера: {e}")
+
+    async def _save_later(self):
+        await asyncio.sleep(STATE_SAVE_DELAY_SECONDS)
+        while self._dirty:
+            self._dirty = False
+            try:
+                await asyncio.to_thread(self._write_atomic, self.snapshot(self._state))
+            except Exception as e:
+                self._dirty = True
+                log.error(f"Ошибка при сохранении состояния менеджера: {e}")
+                return
@@ -0,0 +1,163 @@
+"""Процесс vk-tunnel, который переживает перезапуск менеджера.
+
+vk-tunnel запускается в своей сессии (start_new_session), вывод идет в файл, а stdin -
+из именованного канала (FIFO). Ни одно из этого не привязано к менеджеру: после его
+перезапуска туннель продолжает работать, а новый менеджер находит процесс по PID из
+файла состояния, дочитывает вывод с сохраненного места и пишет в тот же FIFO. Тот
+ли это процесс, а не чужой с тем же PID, проверяется по времени запуска из /proc.
+
+Запуск - через subprocess.Popen, а не asyncio: транспорт asyncio убивает процесс,
+когда закрывается вместе с циклом событий. Завершение отслеживается опросом.
+"""
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+from typing import AsyncIterator, List, Optional, Tuple
+
+log = logging.getLogger("manager")
+
+EXIT_POLL_SECONDS = 0.5         # Как часто проверять, работает ли vk-tunnel
+OUTPUT_POLL_SECONDS = 0.2       # Пауза чтения вывода, когда новых строк нет
+OUTPUT_MAX_BYTES = 16 * 2 ** 20  # Дочитанный файл вывода больше этого обнуляется
+
+
+def process_ticks(pid: int) -> Optional[int]:
+    """Время запуска процесса (тики с загрузки системы); None - процесса нет или это не Linux"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Имя процесса в скобках может содержать пробелы: поля считаем после последней ')'
+    fields = stat[stat.rfind(b")") + 2:].split()
+    try:
+        if fields[0] == b"Z":
+            return None   # Зомби: процесс уже завершился
+        return int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+class TunnelProcess:
+    """vk-tunnel: свой дочерний процесс или подхваченный после перезапуска менеджера"""
+
+    def __init__(self, pid: int, ticks: Optional[int], process: subprocess.Popen = None,
+                 input_path: Optional[str] = None):
+        self.pid = pid
+        self.ticks = ticks
+        self.process = process
+        self.input_path = input_path
+        self.exited = False
+
+    @property
+    def adopted(self) -> bool:
+        return self.process is None
+
+    @property
+    def returncode(self) -> Optional[int]:
+        """Код завершения; у подхваченного процесса он неизвестен (None)"""
+        return self.process.returncode if self.process is not None else None
+
+    def alive(self) -> bool:
+        if self.process is not None:
+            return self.process.poll() is None
+        return not self.exited and process_ticks(self.pid) == self.ticks
+
+    async def wait(self) -> Optional[int]:
+        while self.alive():
+            await asyncio.sleep(EXIT_POLL_SECONDS)
+        self.exited = True
+        return self.returncode
+
+    def _signal(self, signum: int):
+        if not self.alive():
+            raise ProcessLookupError(self.pid)
+        try:
+            # Процесс - лидер своей группы: сигнал получат и его потомки (обертка npm и т.п.)
+            os.killpg(self.pid, signum)
+        except (ProcessLookupError, PermissionError):
+            os.kill(self.pid, signum)
+
+    def terminate(self):
+        self._signal(signal.SIGTERM)
+
+    def kill(self):
+        self._signal(signal.SIGKILL)
+
+    def send_input(self, data: bytes):
+        """Запись в stdin vk-tunnel (например, Enter для /accept)"""
+        if self.input_path is None:
+            raise RuntimeError("stdin vk-tunnel не подключен")
+        fd = os.open(self.input_path, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+
+def input_fifo(path: str) -> int:
+    """FIFO для stdin; открыт на чтение и запись, поэтому vk-tunnel не получит EOF без менеджера"""
+    if os.path.exists(path):
+        os.unlink(path)   # Старый канал мог остаться от прежнего процесса с непрочитанными данными
+    os.mkfifo(path, 0o600)
+    return os.open(path, os.O_RDWR)
+
+
+def spawn(command: List[str], output_path: str, input_path: Optional[str] = None) -> TunnelProcess:
+    """Запуск vk-tunnel в отдельной сессии; вывод - в output_path (файл начинается заново)"""
+    output_fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o600)
+    input_fd = input_fifo(input_path) if input_path else None
+    try:
+        process = subprocess.Popen(
+            command,
+            stdout=output_fd,
+            stderr=subprocess.STDOUT,
+            stdin=input_fd if input_fd is not None else subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    finally:
+        os.close(output_fd)
+        if input_fd is not None:
+            os.close(input_fd)
+    return TunnelProcess(process.pid, process_ticks(process.pid), process, input_path)
+
+
+def adopt(pid: Optional[int], ticks: Optional[int], input_path: Optional[str] = None) -> Optional[TunnelProcess]:
+    """Процесс из сохраненного состояния, если он еще работает; иначе None"""
+    if not pid or ticks is None or process_ticks(pid) != ticks:
+        return None
+    if input_path and not os.path.exists(input_path):
+        input_path = None
+    return TunnelProcess(pid, ticks, input_path=input_path)
+
+
+async def follow_output(path: str, offset: int) -> AsyncIterator[Tuple[str, int]]:
+    """Строки файла вывода начиная с offset и смещение после каждой: (строка, смещение).
+
+    vk-tunnel пишет в файл с O_APPEND, поэтому, когда дочитанный файл вырастает больше
+    OUTPUT_MAX_BYTES, его можно обнулить: следующая запись пойдет с начала. Строки,
+    записанные между последним чтением и обнулением, теряются - это редкость и только лог.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        partial = b""
+        while True:
+            chunk = f.readline()
+            if chunk.endswith(b"\n"):
+                line, partial = partial + chunk, b""
+                offset = f.tell()
+                yield line.decode('utf-8', errors='ignore').strip(), offset
+                continue
+            partial += chunk
+            size = os.fstat(f.fileno()).st_size
+            if size < f.tell():
+                f.seek(0)   # Файл обнулили (или начали заново): читаем с начала
+                partial, offset = b"", 0
+                continue
+            if offset >= OUTPUT_MAX_BYTES and not partial and size == offset:
+                os.truncate(path, 0)
+                f.seek(0)
+                offset = 0
+            await asyncio.sleep(OUTPUT_POLL_SECONDS)
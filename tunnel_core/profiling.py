@@ -0,0 +1,193 @@
+import asyncio
+import collections.abc
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Dict, Any, Optional
+
+log = logging.getLogger("profiling")
+
+# --- НАСТРОЙКИ ИНСТРУМЕНТАЦИИ ---
+LOOP_LAG_INTERVAL_SECONDS = 0.5     # Период замера задержки event loop
+LOOP_LAG_WARN_SECONDS = 0.1         # Задержка, при которой пишем предупреждение
+SLOW_CALLBACK_SECONDS = 1.0         # Сколько loop может не отвечать до снятия стека
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
+PROFILE_MAX_SECONDS = 300
+
+
+class _TrackedCoroutine(collections.abc.Coroutine):
+    """Обертка корутины: считает CPU и время выполнения каждого шага задачи"""
+    __slots__ = ('_coro', '_stats')
+
+    def __init__(self, coro, stats: Dict[str, Any]):
+        self._coro = coro
+        self._stats = stats
+
+    def _step(self, method, *args):
+        cpu_start = time.thread_time()
+        wall_start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            stats = self._stats
+            stats['cpu'] += time.thread_time() - cpu_start
+            elapsed = time.perf_counter() - wall_start
+            stats['busy'] += elapsed
+            stats['steps'] += 1
+            if elapsed > stats['max_step']:
+                stats['max_step'] = elapsed
+
+    def send(self, value):
+        return self._step(self._coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self._coro.throw, *args)
+
+    def close(self):
+        return self._coro.close()
+
+    def __next__(self):
+        return self.send(None)
+
+    def __await__(self):
+        return self
+
+
+class LoopMonitor:
+    def __init__(self):
+        self.loop_thread_id: Optional[int] = None
+        self.heartbeat = time.monotonic()
+        self.lag = {'last': 0.0, 'max': 0.0, 'avg': 0.0, 'warnings': 0}
+        self.stalls = {'count': 0, 'last_duration': 0.0, 'last_stack': None}
+        self.task_stats: Dict[str, Dict[str, Any]] = {}
+        self._watchdog: Optional[threading.Thread] = None
+        self._profiling = False
+
+    def track(self, name: str, coro):
+        """Оборачивает корутину для учета CPU/wall time под именем задачи"""
+        stats = self.task_stats.setdefault(name, {
+            'cpu': 0.0, 'busy': 0.0, 'steps': 0, 'max_step': 0.0,
+            'runs': 0, 'started': None, 'wall': 0.0
+        })
+        stats['runs'] += 1
+        return self._run_tracked(_TrackedCoroutine(coro, stats), stats)
+
+    @staticmethod
+    async def _run_tracked(tracked: _TrackedCoroutine, stats: Dict[str, Any]):
+        stats['started'] = time.monotonic()
+        try:
+            return await tracked
+        finally:
+            stats['wall'] += time.monotonic() - stats['started']
+            stats['started'] = None
+
+    async def run(self):
+        """Сэмплер задержки event loop; также запускает сторожевой поток"""
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch_loop, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+        log.info(f"Мониторинг event loop запущен. Интервал: {LOOP_LAG_INTERVAL_SECONDS}с.")
+
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+            now = time.monotonic()
+            self.heartbeat = now
+
+            lag = max(0.0, now - started - LOOP_LAG_INTERVAL_SECONDS)
+            self.lag['last'] = lag
+            self.lag['max'] = max(self.lag['max'], lag)
+            self.lag['avg'] = self.lag['avg'] * 0.9 + lag * 0.1
+            if lag > LOOP_LAG_WARN_SECONDS:
+                self.lag['warnings'] += 1
+                log.warning(f"Задержка event loop: {lag * 1000:.0f}мс")
+
+    def _watch_loop(self):
+        """Сторожевой поток: снимает стек loop-потока, если тот завис"""
+        reported = None
+        while True:
+            time.sleep(SLOW_CALLBACK_SECONDS / 4)
+            heartbeat = self.heartbeat
+            stalled_for = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL_SECONDS
+            if stalled_for < SLOW_CALLBACK_SECONDS or reported == heartbeat:
+                continue
+
+            reported = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<стек недоступен>"
+            self.stalls['count'] += 1
+            self.stalls['last_duration'] = stalled_for
+            self.stalls['last_stack'] = stack
+            log.warning(f"Event loop не отвечает {stalled_for:.2f}с. Стек:\n{stack}")
+
+    def _sample_stacks(self, seconds: float) -> Counter:
+        """Сэмплирующий профайлер: собирает стеки loop-потока (выполняется в отдельном потоке)"""
+        samples = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                samples[";".join(reversed(stack))] += 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL_SECONDS)
+        return samples
+
+    async def profile(self, seconds: float) -> bytes:
+        """Профилирование event loop; возвращает collapsed-stack файл для flamegraph"""
+        if self._profiling:
+            raise RuntimeError("Профилирование уже запущено")
+        if self.loop_thread_id is None:
+            self.loop_thread_id = threading.get_ident()
+
+        self._profiling = True
+        try:
+            seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+            log.info(f"Запуск сэмплирующего профайлера на {seconds:.0f}с")
+            samples = await asyncio.to_thread(self._sample_stacks, seconds)
+        finally:
+            self._profiling = False
+
+        lines = [f"{stack} {count}" for stack, count in samples.most_common()]
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+    def format_report(self) -> str:
+        """Отчет о задержках loop и нагрузке задач для /status"""
+        text = (f"🌀 *Event loop:* задержка `{self.lag['last'] * 1000:.0f}мс` "
+                f"(сред. `{self.lag['avg'] * 1000:.0f}мс`, макс. `{self.lag['max'] * 1000:.0f}мс`)\n"
+                f"🐢 *Зависаний loop:* `{self.stalls['count']}`")
+        if self.stalls['count']:
+            text += f" (последнее `{self.stalls['last_duration']:.1f}с`)"
+        text += "\n"
+
+        now = time.monotonic()
+        for name, stats in sorted(self.task_stats.items()):
+            wall = stats['wall'] + (now - stats['started'] if stats['started'] else 0.0)
+            text += (f"• `{name}`: CPU `{stats['cpu']:.2f}с`, в работе `{stats['busy']:.2f}с` "
+                     f"из `{wall:.0f}с`, макс. шаг `{stats['max_step'] * 1000:.0f}мс`\n")
+        return text
+
+
+def parse_duration(value: str, default: float = 30) -> float:
+    """Разбор длительности вида '30s', '2m' или '45'"""
+    value = value.strip().lower()
+    if not value:
+        return default
+    multiplier = 1
+    if value.endswith('m'):
+        multiplier, value = 60, value[:-1]
+    elif value.endswith('s'):
+        value = value[:-1]
+    return float(value) * multiplier
+
+
+loop_monitor = LoopMonitor()
@@ -0,0 +1,530 @@
+import asyncio
+import importlib
+import logging
+import os
+import re
+import signal
+import socket
+import sys
+import time
+from typing import Optional, Dict, Any, List, Tuple, Awaitable
+
+from .fleet import FleetAgent, FleetCoordinator, FleetNode
+from .persistence import StateStore
+from .process import TunnelProcess, adopt, follow_output, spawn
+from .profiling import loop_monitor
+from .telemetry import RestartPolicy, Telemetry
+
+# Время импорта ядра - точка отсчета для замера холодного старта
+CORE_IMPORTED_AT = time.perf_counter()
+
+log = logging.getLogger("manager")
+log_vktunnel = logging.getLogger("vk-tunnel")
+
+HEALTH_PROBE_TIMEOUT = 5               # Подключение к туннелю дольше этого - неудачная проверка
+TELEMETRY_HISTORY_SECONDS = 2 * 3600   # Сколько истории держать для /status, даже если окна политики короче
+TELEMETRY_PARK_SECONDS = 5             # Как часто выключенная телеметрия проверяет, не включили ли ее
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+
+
+def setup_logging(log_file: Optional[str] = None):
+    """Настройка логов: консоль и (опционально) файл с ротацией по дням"""
+    log_formatter = logging.Formatter(LOG_FORMAT)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(log_formatter)
+    root_logger.addHandler(console_handler)
+
+    if log_file:
+        from logging.handlers import TimedRotatingFileHandler
+        file_handler = TimedRotatingFileHandler(log_file, when='midnight', interval=1, backupCount=7, encoding='utf-8')
+        file_handler.setFormatter(log_formatter)
+        root_logger.addHandler(file_handler)
+
+
+def get_server_info() -> Tuple[str, str]:
+    """IP и имя хоста сервера (блокирующий вызов - запускать в потоке)"""
+    try:
+        hostname = socket.getfqdn()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(("8.8.8.8", 80))
+            ip_address = s.getsockname()[0]
+        return ip_address, hostname
+    except Exception:
+        return "127.0.0.1", "localhost"
+
+
+def new_state() -> Dict[str, Any]:
+    """Начальное состояние менеджера"""
+    return {
+        'notification_sent': False,
+        'process_start_time': None,
+        'last_output_time': None,
+        'process_pid': None,
+        'last_health_check_time': None,
+        'current_wss_url': None,
+        'current_host': None,
+        'consecutive_failures': 0,
+        'total_crashes': 0,
+        'is_stopped': False,
+        'auth_url': None,
+        'waiting_for_auth': False,
+        'vk_process': None,
+        'server_ip': None,
+        'server_hostname': None,
+        'cold_start_seconds': None,
+        'time_to_url_seconds': None,
+        'telemetry': None,               # Telemetry текущего процесса (для /status)
+        'telemetry_restarts': 0,
+        'process_ticks': None,           # Время запуска vk-tunnel из /proc: PID мог достаться другому процессу
+        'output_offset': 0,              # Сколько байт вывода vk-tunnel уже обработано
+    }
+
+
+class TunnelSupervisor:
+    """Общий жизненный цикл vk-tunnel; варианты (socks5, remnawave) переопределяют хуки"""
+
+    restart_interval: Optional[float] = None      # Плановый перезапуск (None - без таймера)
+    health_check_interval: float = 60
+    health_check_start_delay: float = 15          # Даем время на запуск
+    health_failures_before_restart: int = 1
+    max_crashes: Optional[int] = None             # После стольких падений автозапуск отключается
+    restart_pause: float = 5
+    stdin_pipe: bool = False                      # Нужен ли stdin (например, для /accept)
+    telemetry_interval: float = 30                # Замер ресурсов vk-tunnel (telemetry.py); 0 - без телеметрии
+    state_file: str = "manager_state.json"        # Состояние для перезапуска менеджера без перезапуска туннеля
+    output_file: str = "vk-tunnel.out"            # Вывод vk-tunnel; stdin (если нужен) - FIFO output_file + ".stdin"
+    optional_imports: List[str] = ["psutil"]
+
+    def __init__(self, handler, chat_id: str, tunnel_host: str, tunnel_port: int,
+                 command: List[str], started_at: Optional[float] = CORE_IMPORTED_AT):
+        self.handler = handler
+        self.state = handler.state
+        self.chat_id = chat_id
+        self.tunnel_host = tunnel_host
+        self.tunnel_port = tunnel_port
+        self.command = command
+        self.started_at = started_at
+        self.server_info_task: Optional[asyncio.Task] = None
+        self.telemetry = Telemetry()
+        self.restart_policy = RestartPolicy()
+        self.state['telemetry'] = self.telemetry
+        self.state_store: Optional[StateStore] = None
+        self.fleet_agent: Optional[FleetAgent] = None
+        self.fleet = None                 # FleetCoordinator или FleetNode (fleet.py)
+
+    def configure_fleet(self, listen: str, coordinator: str, secret: str, name: str = ""):
+        """Режим флота: coordinator - подключиться к координатору узлом, listen - самому стать координатором"""
+        if not (listen or coordinator):
+            return
+        if not secret:
+            raise ValueError("для флота нужен общий секрет (fleet_secret)")
+        self.fleet_agent = FleetAgent(self, name or socket.gethostname())
+        if coordinator:
+            self.fleet = FleetNode(self.fleet_agent, secret, coordinator)
+        else:
+            self.fleet = FleetCoordinator(self.fleet_agent, secret, listen)
+            self.handler.fleet = self.fleet
+
+    # --- Хуки вариантов ---
+
+    async def probe_health(self) -> bool:
+        """Одна проверка здоровья; False - туннель не отвечает"""
+        try:
+            async with asyncio.timeout(HEALTH_PROBE_TIMEOUT):
+                reader, writer = await asyncio.open_connection(self.tunnel_host, self.tunnel_port)
+                writer.close()
+                await writer.wait_closed()
+            return True
+        except (OSError, asyncio.TimeoutError) as e:
+            # Отказ, сброс, недоступный адрес и зависшее подключение - все это неудачная проверка
+            log.warning(f"Health check: {type(e).__name__}")
+            return False
+
+    def background_tasks(self) -> Dict[str, Awaitable]:
+        """Дополнительные фоновые задачи варианта: {имя: корутина}"""
+        return {}
+
+    async def on_output_line(self, line: str, stream_name: str):
+        """Обработка строки вывода vk-tunnel"""
+        if not self.state['notification_sent'] and line.startswith("wss:"):
+            try:
+                wss_url = line.split(maxsplit=1)[1] if len(line.split()) > 1 else line
+                match = re.search(r'wss://([^/]+)', wss_url)
+                self.state['current_wss_url'] = wss_url
+                self.state['current_host'] = match.group(1) if match else None
+                self.state['waiting_for_auth'] = False
+                if self.state['time_to_url_seconds'] is None and self.started_at is not None:
+                    self.state['time_to_url_seconds'] = time.perf_counter() - self.started_at
+                    log.info(f"Холодный старт: WSS адрес получен через {self.state['time_to_url_seconds']:.1f}с")
+
+                log.info(f"Обнаружен WSS адрес: {wss_url}. Отправка уведомления...")
+                await self.on_wss_url(wss_url, self.state['current_host'])
+                self.state['notification_sent'] = True
+                self.state['consecutive_failures'] = 0
+                self.save_state()
+            except Exception as e:
+                log.error(f"Ошибка при обработке WSS URL: {e}")
+
+    async def on_wss_url(self, wss_url: str, host: Optional[str]):
+        """Вызывается, когда vk-tunnel сообщил новый WSS адрес"""
+
+    # --- Общая логика ---
+
+    async def send_message(self, text: str):
+        await self.handler.send_message(text, self.chat_id)
+
+    async def server_info(self) -> Tuple[str, str]:
+        """IP и имя сервера; определяются в фоне, чтобы не задерживать запуск туннеля"""
+        if self.server_info_task is None:
+            self.server_info_task = asyncio.create_task(asyncio.to_thread(get_server_info))
+        try:
+            ip_address, hostname = await asyncio.wait_for(asyncio.shield(self.server_info_task), timeout=5)
+        except Exception:
+            return "127.0.0.1", "localhost"
+        self.state['server_ip'], self.state['server_hostname'] = ip_address, hostname
+        return ip_address, hostname
+
+    async def preload_optional_imports(self):
+        """Фоновый импорт тяжелых модулей вне event loop"""
+        for name in self.optional_imports:
+            try:
+                await asyncio.to_thread(importlib.import_module, name)
+            except ImportError:
+                log.info(f"Необязательный модуль {name} не установлен")
+
+    def save_state(self):
+        """Отложенная запись состояния (см. persistence.py)"""
+        if self.state_store is not None:
+            self.state_store.save(self.state)
+
+    def restore_state(self) -> Optional[TunnelProcess]:
+        """Состояние прошлого запуска менеджера; работающий vk-tunnel из него, если он есть"""
+        self.state_store = StateStore(self.state_file)
+        saved = self.state_store.load()
+        if not saved:
+            return None
+        # Счетчики и остановка по /stop переживают перезапуск менеджера в любом случае
+        for key in ('total_crashes', 'telemetry_restarts', 'is_stopped'):
+            if key in saved:
+                self.state[key] = saved[key]
+        process = adopt(saved.get('process_pid'), saved.get('process_ticks'),
+                        self.input_path() if self.stdin_pipe else None)
+        if process is None:
+            if saved.get('process_pid'):
+                log.info(f"vk-tunnel из прошлого запуска (PID: {saved['process_pid']}) уже не работает.")
+            return None
+        self.state.update(saved)
+        self.state.update({
+            'vk_process': process,
+            'last_output_time': time.time(),
+            'last_health_check_time': time.time(),
+            'consecutive_failures': 0,
+        })
+        return process
+
+    def input_path(self) -> str:
+        return self.output_file + ".stdin"
+
+    async def monitor_output(self):
+        """Мониторинг вывода процесса: строки из файла вывода, начиная с необработанных"""
+        try:
+            async for line, offset in follow_output(self.output_file, self.state['output_offset']):
+                self.state['output_offset'] = offset
+                self.save_state()
+                if not line:
+                    continue
+                self.state['last_output_time'] = time.time()
+                log_vktunnel.info(line)
+                try:
+                    await self.on_output_line(line, "output")
+                except Exception as e:
+                    log.error(f"Ошибка при обработке вывода vk-tunnel: {e}")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.error(f"Ошибка в monitor_output: {e}")
+
+    async def check_tunnel_health(self):
+        """Периодическая проверка здоровья туннеля"""
+        log.info(f"Проверка здоровья туннеля запущена. Интервал: {self.health_check_interval}с.")
+        await asyncio.sleep(self.health_check_start_delay)
+
+        while True:
+            try:
+                if await self.probe_health():
+                    self.state['last_health_check_time'] = time.time()
+                    self.state['consecutive_failures'] = 0
+                    log.info(f"Health check: туннель {self.tunnel_host}:{self.tunnel_port} отвечает.")
+                else:
+                    self.state['consecutive_failures'] += 1
+                    log.warning(f"Health check failed ({self.state['consecutive_failures']}): "
+                                f"{self.tunnel_host}:{self.tunnel_port} не отвечает")
+
+                    if self.state['consecutive_failures'] >= self.health_failures_before_restart:
+                        log.error(f"Туннель не отвечает после {self.state['consecutive_failures']} проверок. "
+                                  f"Инициирую перезапуск.")
+                        await self.send_message("⚠️ *Туннель не отвечает*\n\nИнициирую перезапуск...")
+                        self.handler.manual_restart_event.set()
+                        break
+
+            except asyncio.CancelledError:
+                log.info("Проверка здоровья остановлена.")
+                break
+            except Exception as e:
+                log.error(f"Неизвестная ошибка при проверке здоровья: {e}")
+
+            await asyncio.sleep(self.health_check_interval)
+
+    async def watch_resources(self, pid: int) -> str:
+        """Телеметрия vk-tunnel; завершается с причиной, когда RestartPolicy просит перезапуск"""
+        while self.telemetry_interval <= 0:
+            await asyncio.sleep(TELEMETRY_PARK_SECONDS)   # Выключена; /reload может включить
+        try:
+            self.telemetry.attach(pid)
+        except ImportError:
+            log.info("psutil не установлен: телеметрия vk-tunnel и перезапуск по ней отключены")
+            await asyncio.Future()
+        except Exception as e:
+            log.error(f"Телеметрия vk-tunnel (PID: {pid}) недоступна: {e}")
+            await asyncio.Future()
+
+        while True:
+            # Интервал и окна политики читаются на каждом шаге, поэтому меняются без перезапуска
+            if self.telemetry_interval <= 0:
+                await asyncio.sleep(TELEMETRY_PARK_SECONDS)
+                continue
+            span = max(self.restart_policy.leak_window, self.restart_policy.spin_seconds, TELEMETRY_HISTORY_SECONDS)
+            self.telemetry.resize(int(span / self.telemetry_interval) + 2)
+            await asyncio.sleep(self.telemetry_interval)
+            try:
+                await self.telemetry.sample()
+            except Exception as e:
+                log.error(f"Ошибка замера vk-tunnel: {e}")
+                continue
+            reason = self.restart_policy.check(self.telemetry)
+            if reason:
+                log.error(f"Телеметрия vk-tunnel: {reason}. Инициирую перезапуск.")
+                await self.send_message(f"⚠️ *vk-tunnel:* {reason}\n\nИнициирую перезапуск...")
+                return reason
+
+    async def stop_process(self, process: TunnelProcess):
+        """Завершение vk-tunnel: SIGTERM, затем SIGKILL, затем проверка через psutil"""
+        if not process.alive():
+            return
+
+        log.warning(f"Пытаюсь завершить процесс {process.pid}...")
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), timeout=5)
+            log.info(f"Процесс {process.pid} успешно завершен (SIGTERM).")
+            return
+        except asyncio.TimeoutError:
+            log.warning(f"Процесс {process.pid} не ответил на SIGTERM. Убиваем (SIGKILL)...")
+        except ProcessLookupError:
+            return
+
+        try:
+            process.kill()
+            await asyncio.wait_for(process.wait(), timeout=5)
+            log.info(f"Процесс {process.pid} успешно убит (SIGKILL).")
+        except Exception as e:
+            log.error(f"Ошибка при убийстве процесса {process.pid}: {e}")
+
+        # Дополнительная проверка: убедимся, что PID мёртв
+        await asyncio.sleep(2)
+        try:
+            import psutil
+        except ImportError:
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            return
+
+        if psutil.pid_exists(process.pid):
+            log.error(f"Процесс {process.pid} всё ещё жив! Принудительное убийство через psutil...")
+            try:
+                p = psutil.Process(process.pid)
+                p.kill()
+                await asyncio.to_thread(p.wait, 5)
+                log.info(f"Процесс {process.pid} успешно убит через psutil.")
+            except psutil.NoSuchProcess:
+                log.info(f"Процесс {process.pid} уже не существует.")
+            except psutil.TimeoutExpired:
+                log.warning(f"Таймаут при ожидании завершения {process.pid}.")
+            except Exception as e:
+                log.error(f"Ошибка при убийстве через psutil: {e}")
+
+    async def manage_vk_tunnel_lifecycle(self):
+        """Основной цикл управления жизненным циклом vk-tunnel"""
+        adopted = self.restore_state()
+        while True:
+            # Проверяем, остановлен ли процесс
+            if self.state['is_stopped'] and adopted is None:
+                await asyncio.sleep(5)
+                continue
+
+            if self.max_crashes is not None and self.state['total_crashes'] >= self.max_crashes:
+                await self.send_message(
+                    f"❌ *Туннель упал {self.max_crashes} раз*\n\n"
+                    "Автоматический перезапуск отключен.\n"
+                    "Используйте /start для запуска вручную."
+                )
+                self.state['is_stopped'] = True
+                self.save_state()
+                continue
+
+            self.handler.manual_restart_event.clear()
+            self.handler.start_event.clear()
+
+            if adopted is not None:
+                # Менеджер перезапущен, туннель - нет: адрес прежний, клиентов не трогаем
+                process, adopted = adopted, None
+                self.started_at = None   # Холодного старта не было: следующий запуск его не покажет
+                log.info(f"Подхвачен работающий vk-tunnel (PID: {process.pid}), host {self.state['current_host']}")
+                await self.send_message(f"♻️ *Менеджер перезапущен*\n\nvk-tunnel продолжает работать "
+                                        f"(PID `{process.pid}`), адрес не изменился.")
+            else:
+                if self.restart_interval:
+                    log.info(f"Запуск нового цикла. Следующий плановый перезапуск через "
+                             f"{self.restart_interval / 3600:.1f} часов.")
+                else:
+                    log.info("Запуск нового цикла vk-tunnel.")
+                self.state.update({
+                    'notification_sent': False,
+                    'process_start_time': time.time(),
+                    'last_output_time': time.time(),
+                    'process_pid': None,
+                    'process_ticks': None,
+                    'last_health_check_time': time.time(),
+                    'current_wss_url': None,
+                    'current_host': None,
+                    'consecutive_failures': 0,
+                    'output_offset': 0,
+                })
+
+                try:
+                    process = spawn(self.command, self.output_file, self.input_path() if self.stdin_pipe else None)
+                    self.state['process_pid'] = process.pid
+                    self.state['process_ticks'] = process.ticks
+                    self.state['vk_process'] = process
+                    self.save_state()
+                    log.info(f"Процесс vk-tunnel запущен с PID: {process.pid}")
+                    if self.state['cold_start_seconds'] is None and self.started_at is not None:
+                        self.state['cold_start_seconds'] = time.perf_counter() - self.started_at
+                        log.info(f"Холодный старт: vk-tunnel запущен через "
+                                 f"{self.state['cold_start_seconds'] * 1000:.0f}мс")
+                except FileNotFoundError:
+                    log.critical("Команда 'vk-tunnel' не найдена! Повтор через 30с...")
+                    await asyncio.sleep(30)
+                    continue
+                except Exception as e:
+                    log.critical(f"Не удалось запустить процесс vk-tunnel: {e}. Повтор через 30с...")
+                    await asyncio.sleep(30)
+                    continue
+
+            # Создаем задачи мониторинга
+            monitor_output_task = asyncio.create_task(
+                loop_monitor.track("monitor_output", self.monitor_output()), name="monitor_output")
+            health_check_task = asyncio.create_task(
+                loop_monitor.track("health_check", self.check_tunnel_health()), name="health_check")
+            telemetry_task = asyncio.create_task(
+                loop_monitor.track("telemetry", self.watch_resources(process.pid)), name="telemetry")
+
+            # Создаем задачи ожидания событий
+            wait_process_task = asyncio.create_task(process.wait())
+            wait_command_task = asyncio.create_task(self.handler.manual_restart_event.wait())
+            wait_start_task = asyncio.create_task(self.handler.start_event.wait())
+            wait_tasks = [wait_process_task, wait_command_task, wait_start_task, health_check_task, telemetry_task]
+            wait_timer_task = None
+            if self.restart_interval:
+                # От запуска процесса: подхваченный туннель мог проработать часть интервала
+                left = self.state['process_start_time'] + self.restart_interval - time.time()
+                wait_timer_task = asyncio.create_task(asyncio.sleep(max(0.0, left)))
+                wait_tasks.append(wait_timer_task)
+
+            # Ждем первое событие
+            while True:
+                done, pending = await asyncio.wait(wait_tasks, return_when=asyncio.FIRST_COMPLETED)
+                if done == {telemetry_task} and telemetry_task.exception() is not None:
+                    # Сбой самой телеметрии - не повод перезапускать рабочий туннель
+                    log.error(f"Телеметрия vk-tunnel остановлена ошибкой: {telemetry_task.exception()!r}")
+                    wait_tasks.remove(telemetry_task)
+                    continue
+                break
+
+            # Определяем причину остановки
+            reason = "неизвестная причина"
+            if wait_process_task in done:
+                self.state['total_crashes'] += 1
+                code = process.returncode if process.returncode is not None else "неизвестен"
+                reason = f"процесс завершился сам с кодом {code} (падение {self.state['total_crashes']})"
+                await self.send_message(f"⚠️ *Туннель упал*\n\nПричина: {reason}\nПерезапускаю...")
+            elif wait_timer_task is not None and wait_timer_task in done:
+                reason = "сработал плановый таймер"
+            elif wait_command_task in done:
+                reason = "получена команда перезапуска"
+                self.state['total_crashes'] = 0  # Сбрасываем счетчик при ручном перезапуске
+            elif wait_start_task in done:
+                reason = "получена команда запуска"
+                self.state['total_crashes'] = 0
+            elif health_check_task in done:
+                self.state['total_crashes'] += 1
+                reason = f"health check обнаружил проблему (падение {self.state['total_crashes']})"
+            elif telemetry_task in done:
+                self.state['telemetry_restarts'] += 1
+                reason = f"телеметрия: {telemetry_task.result()}"
+            self.save_state()
+
+            log.warning(f"Инициирован перезапуск vk-tunnel (PID: {process.pid}). Причина: {reason}.")
+
+            # Отменяем все незавершенные задачи
+            for task in pending:
+                task.cancel()
+
+            monitor_output_task.cancel()
+            health_check_task.cancel()
+            telemetry_task.cancel()
+
+            await asyncio.gather(
+                monitor_output_task,
+                health_check_task,
+                telemetry_task,
+                return_exceptions=True
+            )
+
+            await self.stop_process(process)
+
+            log.info(f"Пауза {self.restart_pause:.0f} секунд перед перезапуском...")
+            await asyncio.sleep(self.restart_pause)
+
+    async def run(self):
+        """Запуск всех задач менеджера.
+
+        При остановке менеджера vk-tunnel продолжает работать: следующий запуск его подхватит.
+        """
+        self.server_info_task = asyncio.create_task(asyncio.to_thread(get_server_info))
+        if isinstance(self.fleet, FleetNode):
+            # Бота опрашивает координатор; узел только отправляет уведомления
+            commands = loop_monitor.track("fleet_node", self.fleet.run())
+        else:
+            commands = loop_monitor.track("telegram_poller", self.handler.listen_for_commands())
+        tasks = self.background_tasks()
+        if isinstance(self.fleet, FleetCoordinator):
+            tasks["fleet"] = self.fleet.serve()
+        try:
+            await asyncio.gather(
+                loop_monitor.track("lifecycle", self.manage_vk_tunnel_lifecycle()),
+                commands,
+                loop_monitor.track("admin_watch", self.handler.admin_manager.watch()),
+                self.preload_optional_imports(),
+                loop_monitor.run(),
+                *(loop_monitor.track(name, coro) for name, coro in tasks.items())
+            )
+        finally:
+            if self.state_store is not None:
+                self.state_store.save_now()
@@ -0,0 +1,371 @@
+import asyncio
+import importlib
+import logging
+import time
+from typing import Optional, Dict, Any, List
+
+from .admin import AdminManager, ROLE_VIEWER, ROLE_ADMIN, parse_role
+from .profiling import loop_monitor, parse_duration
+
+log = logging.getLogger("telegram")
+
+
+def format_duration(seconds: int) -> str:
+    return f"{seconds // 3600}ч {(seconds % 3600) // 60}м {seconds % 60}с"
+
+
+class BaseTelegramHandler:
+    """Общие команды бота; варианты добавляют свои через handle_command и списки помощи"""
+
+    help_public: List[str] = [
+        "/help - Показать это сообщение",
+    ]
+    help_admin: List[str] = [
+        "/status - Статус vk-tunnel",
+        "/log - Последние 20 строк лога",
+        "/restart-tunnel - Перезапустить vk-tunnel",
+        "/profile 30s - Профиль event loop (collapsed stacks)",
+        "/admin-list - Список администраторов",
+    ]
+
+    def __init__(self, bot_token: str, allowed_user_id: int, state: Dict[str, Any]):
+        self.bot_token = bot_token
+        self.owner_id = allowed_user_id  # Главный администратор (владелец)
+        self.state = state
+        self.manual_restart_event = asyncio.Event()
+        self.start_event = asyncio.Event()
+        self.admin_manager = AdminManager()
+        self.profile_task: Optional[asyncio.Task] = None
+        self.fleet = None                 # FleetCoordinator, если этот менеджер - координатор флота
+        self.fleet_tasks = set()
+
+        # Владелец всегда есть в реестре администраторов
+        self.admin_manager.ensure_owner(allowed_user_id)
+
+    def is_admin(self, user_id: int) -> bool:
+        """Проверка прав администратора"""
+        return self.admin_manager.is_admin(user_id)
+
+    def is_viewer(self, user_id: int) -> bool:
+        """Проверка права на просмотр статуса и логов"""
+        return self.admin_manager.has_role(user_id, ROLE_VIEWER)
+
+    def is_owner(self, user_id: int) -> bool:
+        """Проверка, является ли пользователь владельцем"""
+        return user_id == self.owner_id
+
+    async def send_message(self, text: str, chat_id: str, parse_mode: str = 'Markdown') -> bool:
+        """Отправка сообщения в Telegram"""
+        import aiohttp
+
+        if len(text) > 4096:
+            text = text[:4090] + "\n[...]"
+
+        url = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
+        payload = {'chat_id': chat_id, 'text': text, 'parse_mode': parse_mode}
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, data=payload, timeout=10) as response:
+                    if response.status == 200:
+                        log.info(f"Сообщение в чат {chat_id} успешно отправлено.")
+                        return True
+                    log.error(f"Ошибка отправки в Telegram: {response.status}, {await response.text()}")
+        except Exception as e:
+            log.error(f"Исключение при отправке в Telegram: {e}")
+        return False
+
+    async def send_document(self, filename: str, data: bytes, chat_id: str, caption: str = ""):
+        """Отправка файла в Telegram"""
+        import aiohttp
+
+        url = f"https://api.telegram.org/bot{self.bot_token}/sendDocument"
+        form = aiohttp.FormData()
+        form.add_field('chat_id', str(chat_id))
+        if caption:
+            form.add_field('caption', caption)
+        form.add_field('document', data, filename=filename, content_type='text/plain')
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(url, data=form, timeout=30) as response:
+                    if response.status == 200:
+                        log.info(f"Файл {filename} отправлен в чат {chat_id}.")
+                    else:
+                        log.error(f"Ошибка отправки файла в Telegram: {response.status}, {await response.text()}")
+        except Exception as e:
+            log.error(f"Исключение при отправке файла в Telegram: {e}")
+
+    async def run_profile(self, seconds: float, chat_id: str):
+        """Профилирование event loop и отправка collapsed-stack файла"""
+        try:
+            data = await loop_monitor.profile(seconds)
+        except RuntimeError as e:
+            await self.send_message(f"⚠️ {e}", chat_id)
+            return
+        filename = f"profile-{int(time.time())}.collapsed"
+        await self.send_document(filename, data, chat_id,
+                                 caption="🔥 Collapsed stacks (flamegraph.pl / speedscope)")
+
+    def format_status(self) -> str:
+        """Текст ответа на /status"""
+        uptime_seconds = int(time.time() - self.state['process_start_time'])
+        last_health_check = self.state.get('last_health_check_time') or self.state['process_start_time']
+        last_health_seconds = int(time.time() - last_health_check)
+
+        status_text = (f"📊 *Статус VK Tunnel*\n\n"
+                       f"✅ *Статус:* Работает\n"
+                       f"🔢 *PID:* `{self.state['process_pid']}`\n"
+                       f"⏱️ *Время работы:* `{format_duration(uptime_seconds)}`\n"
+                       f"💓 *Последняя проверка:* `{last_health_seconds}с назад`\n")
+
+        if self.state.get('current_host'):
+            status_text += f"🔗 *Текущий host:* `{self.state['current_host']}`\n"
+
+        if self.state.get('consecutive_failures', 0) > 0:
+            status_text += f"⚠️ *Неудачных проверок:* `{self.state['consecutive_failures']}`\n"
+
+        if self.state.get('cold_start_seconds') is not None:
+            status_text += f"🚀 *Холодный старт:* `{self.state['cold_start_seconds'] * 1000:.0f}мс`"
+            if self.state.get('time_to_url_seconds') is not None:
+                status_text += f", WSS через `{self.state['time_to_url_seconds']:.1f}с`"
+            status_text += "\n"
+
+        if self.state.get('telemetry_restarts'):
+            status_text += f"🩺 *Перезапусков по телеметрии:* `{self.state['telemetry_restarts']}`\n"
+
+        telemetry = self.state.get('telemetry')
+        if telemetry is not None and telemetry.samples:
+            status_text += "\n" + telemetry.format_report()
+
+        return status_text + "\n" + loop_monitor.format_report()
+
+    def format_help(self, user_id: int) -> str:
+        """Текст ответа на /help"""
+        help_text = "📋 *Доступные команды:*\n\n" + "\n".join(self.help_public)
+        help_text += "\n\n*Команды администратора:*\n" + "\n".join(self.help_admin)
+
+        if self.fleet is not None:
+            help_text += ("\n\n*Флот:*\n"
+                          "/fleet - Узлы флота\n"
+                          "/status all|УЗЕЛ - Статус всех узлов или одного\n"
+                          "/restart-tunnel all|УЗЕЛ[,УЗЕЛ] - Перезапуск узлов волнами")
+
+        if self.is_owner(user_id):
+            help_text += ("\n\n*Команды владельца:*\n"
+                          "/add-admin USER_ID [viewer|admin] - Добавить администратора\n"
+                          "/remove-admin USER_ID - Удалить администратора")
+        return help_text
+
+    async def send_log(self, command: str, chat_id: str):
+        """Ответ на /log; варианты берут строки из файла или из памяти"""
+        await self.send_message("ℹ️ Лог недоступен.", chat_id)
+
+    async def fleet_status(self, target: str, chat_id: str):
+        """/status all - строка от каждого узла, /status УЗЕЛ - полный статус узла"""
+        fleet = self.fleet
+        if target == "all":
+            results = await fleet.fan_out(fleet.names(), {"cmd": "summary"}, fleet.agent.timeout)
+            await self.send_message(fleet.format_results("📊 *Статус флота*", results), chat_id)
+            return
+        ok, text = await fleet.call(target, {"cmd": "status"}, fleet.agent.timeout)
+        await self.send_message(f"🛰️ *Узел* `{target}`\n\n" + (text if ok else f"❌ {text}"), chat_id)
+
+    async def fleet_restart(self, names: List[str], chat_id: str):
+        fleet = self.fleet
+        await self.send_message(f"✅ Перезапуск: `{', '.join(names)}` (одновременно не больше "
+                                f"{max(1, fleet.agent.max_down)})...", chat_id)
+        results = await fleet.rolling_restart(names)
+        await self.send_message(fleet.format_results("♻️ *Перезапуск флота*", results), chat_id)
+
+    def run_fleet_command(self, coro):
+        """Команды флота ждут узлы, поэтому идут в фоне: прием команд не блокируется"""
+        task = asyncio.create_task(coro)
+        self.fleet_tasks.add(task)
+        task.add_done_callback(self.fleet_tasks.discard)
+
+    async def handle_fleet_command(self, command: str, chat_id: str, user_id: int) -> bool:
+        """/fleet, /status УЗЕЛ, /restart-tunnel УЗЕЛ; False - команда не для флота"""
+        parts = command.split()
+        if parts[0] == "/fleet" and len(parts) == 1:
+            if not self.is_viewer(user_id):
+                await self.send_message("❌ Доступ запрещен.", chat_id)
+                return True
+            await self.send_message(self.fleet.format_nodes(), chat_id)
+            return True
+
+        if parts[0] not in ("/status", "/restart-tunnel") or len(parts) == 1:
+            return False
+
+        names, unknown = self.fleet.resolve(parts[1:])
+        if parts[0] == "/status":
+            if not self.is_viewer(user_id):
+                await self.send_message("❌ Доступ запрещен.", chat_id)
+            elif len(parts) != 2 or "," in parts[1]:
+                await self.send_message("❌ Использование: `/status all` или `/status УЗЕЛ`", chat_id)
+            elif unknown:
+                await self.send_message(f"❌ Неизвестный узел `{parts[1]}` (список - /fleet)", chat_id)
+            else:
+                self.run_fleet_command(self.fleet_status(parts[1], chat_id))
+            return True
+
+        if not self.is_admin(user_id):
+            await self.send_message("❌ Доступ запрещен.", chat_id)
+        elif unknown or not names:
+            await self.send_message(f"❌ Неизвестные узлы: `{', '.join(unknown) or '-'}` (список - /fleet)", chat_id)
+        else:
+            self.run_fleet_command(self.fleet_restart(names, chat_id))
+        return True
+
+    async def handle_command(self, command: str, chat_id: str, user_id: int):
+        """Обработка общих команд"""
+        if self.fleet is not None and await self.handle_fleet_command(command, chat_id, user_id):
+            return
+
+        # Команды управления администраторами (только для владельца)
+        if command.startswith("/add-admin"):
+            if not self.is_owner(user_id):
+                await self.send_message("❌ Только владелец может добавлять администраторов", chat_id)
+                return
+
+            parts = command.split()
+            if len(parts) not in (2, 3):
+                await self.send_message("❌ Использование: `/add-admin USER_ID [viewer|admin]`", chat_id)
+                return
+
+            role = parse_role(parts[2]) if len(parts) == 3 else ROLE_ADMIN
+            if role not in (ROLE_VIEWER, ROLE_ADMIN):
+                await self.send_message("❌ Роль должна быть `viewer` или `admin`", chat_id)
+                return
+
+            try:
+                new_admin_id = int(parts[1])
+                success, message = self.admin_manager.add_admin(new_admin_id, role)
+                if success:
+                    await self.send_message(f"✅ {message}", chat_id)
+                else:
+                    await self.send_message(f"⚠️ {message}", chat_id)
+            except ValueError:
+                await self.send_message("❌ USER_ID должен быть числом", chat_id)
+
+        elif command.startswith("/remove-admin"):
+            if not self.is_owner(user_id):
+                await self.send_message("❌ Только владелец может удалять администраторов", chat_id)
+                return
+
+            parts = command.split()
+            if len(parts) != 2:
+                await self.send_message("❌ Использование: `/remove-admin USER_ID`", chat_id)
+                return
+
+            try:
+                admin_id = int(parts[1])
+                if admin_id == self.owner_id:
+                    await self.send_message("❌ Нельзя удалить владельца из администраторов", chat_id)
+                    return
+
+                success, message = self.admin_manager.remove_admin(admin_id)
+                if success:
+                    await self.send_message(f"✅ {message}", chat_id)
+                else:
+                    await self.send_message(f"⚠️ {message}", chat_id)
+            except ValueError:
+                await self.send_message("❌ USER_ID должен быть числом", chat_id)
+
+        elif command == "/admin-list":
+            if not self.is_viewer(user_id):
+                await self.send_message("❌ Доступ запрещен", chat_id)
+                return
+
+            await self.send_message(self.admin_manager.get_admin_info(), chat_id)
+
+        elif command == "/restart-tunnel":
+            if not self.is_admin(user_id):
+                await self.send_message("❌ Доступ запрещен.", chat_id)
+                return
+
+            await self.send_message("✅ Принято! Инициирую перезапуск туннеля...", chat_id)
+            self.manual_restart_event.set()
+
+        elif command == "/status":
+            if not self.is_viewer(user_id):
+                await self.send_message("❌ Доступ запрещен.", chat_id)
+                return
+
+            if self.state.get('process_pid') and self.state.get('process_start_time'):
+                await self.send_message(self.format_status(), chat_id)
+            else:
+                await self.send_message("ℹ️ Процесс vk-tunnel не запущен.", chat_id)
+
+        elif command == "/log" or command.startswith("/log "):
+            if not self.is_viewer(user_id):
+                await self.send_message("❌ Доступ запрещен", chat_id)
+                return
+
+            await self.send_log(command, chat_id)
+
+        elif command.startswith("/profile"):
+            if not self.is_admin(user_id):
+                await self.send_message("❌ Доступ запрещен", chat_id)
+                return
+
+            parts = command.split()
+            try:
+                seconds = parse_duration(parts[1]) if len(parts) > 1 else 30
+            except ValueError:
+                await self.send_message("❌ Использование: `/profile 30s`", chat_id)
+                return
+
+            await self.send_message(f"⏳ Профилирую event loop {seconds:.0f}с...", chat_id)
+            # Профилируем в фоне, чтобы не блокировать прием команд
+            self.profile_task = asyncio.create_task(self.run_profile(seconds, chat_id))
+
+        elif command == "/help":
+            await self.send_message(self.format_help(user_id), chat_id)
+
+        else:
+            # Неизвестная команда - не отвечаем
+            pass
+
+    async def listen_for_commands(self):
+        """Основной цикл прослушивания команд"""
+        # aiohttp импортируем в потоке, чтобы не задерживать запуск туннеля
+        aiohttp = await asyncio.to_thread(importlib.import_module, "aiohttp")
+        last_update_id = 0
+        log.info("Запуск слушателя команд Telegram...")
+
+        while True:
+            try:
+                async with asyncio.timeout(60):
+                    url = f"https://api.telegram.org/bot{self.bot_token}/getUpdates"
+                    params = {'offset': last_update_id + 1, 'timeout': 50}
+
+                    async with aiohttp.ClientSession() as session:
+                        async with session.get(url, params=params) as response:
+                            if response.status != 200:
+                                log.error(f"Ошибка API Telegram: {response.status}")
+                                await asyncio.sleep(10)
+                                continue
+
+                            data = await response.json()
+
+                            for update in data.get("result", []):
+                                last_update_id = update["update_id"]
+                                message = update.get("message")
+
+                                if not (message and "text" in message):
+                                    continue
+
+                                user_id = message["from"]["id"]
+                                chat_id = message["chat"]["id"]
+                                command = message["text"].strip()
+
+                                # Обрабатываем только команды (начинаются с /)
+                                if command.startswith('/'):
+                                    await self.handle_command(command, str(chat_id), user_id)
+
+            except asyncio.TimeoutError:
+                continue
+            except Exception as e:
+                log.error(f"Критическая ошибка в слушателе Telegram: {e}. Перезапуск через 10с...")
+                await asyncio.sleep(10)
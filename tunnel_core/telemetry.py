@@ -0,0 +1,187 @@
+"""Телеметрия процесса vk-tunnel и перезапуск по ней вместо таймера.
+
+Раз в interval секунд снимается замер процесса и его потомков (CPU, RSS, файловые
+дескрипторы, потоки, сокеты) в кольцевой буфер фиксированного размера. RestartPolicy
+смотрит на историю и просит перезапуск, когда:
+    * RSS или число дескрипторов растет устойчиво: наклон линейной регрессии за окно
+      leak_window выше порога, и рост ровный (R² не ниже LEAK_MIN_R2), а не один всплеск;
+    * CPU не опускается ниже spin_cpu_percent дольше spin_seconds (процесс зациклился).
+Нужен psutil; без него телеметрия выключена.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, List, Optional, Sequence
+
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+SPARK_WIDTH = 24            # Столбиков в /status; замеры усредняются по группам
+LEAK_MIN_R2 = 0.8           # Насколько ровным должен быть рост, чтобы считаться утечкой
+WINDOW_COVERAGE = 0.9       # Какую часть окна должна покрывать история для решения
+
+
+class Sample:
+    __slots__ = ('time', 'cpu', 'rss', 'fds', 'threads', 'sockets')
+
+    def __init__(self, at: float, cpu: float, rss: int, fds: int, threads: int, sockets: int):
+        self.time = at
+        self.cpu = cpu            # % одного ядра с прошлого замера
+        self.rss = rss
+        self.fds = fds
+        self.threads = threads
+        self.sockets = sockets
+
+
+def trend(points: Sequence[tuple]) -> tuple:
+    """Наклон (в единицах за секунду) и R² линейной регрессии по точкам (t, y)"""
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_t = sum((t - mean_t) ** 2 for t, _ in points)
+    var_y = sum((y - mean_y) ** 2 for _, y in points)
+    if not var_t or not var_y:
+        return 0.0, 0.0
+    cov = sum((t - mean_t) * (y - mean_y) for t, y in points)
+    return cov / var_t, cov * cov / (var_t * var_y)
+
+
+def sparkline(values: Sequence[float], width: int = SPARK_WIDTH) -> str:
+    """Строка из SPARK_CHARS; больше width значений - среднее по группам"""
+    if not values:
+        return ""
+    if len(values) > width:
+        step = len(values) / width
+        values = [sum(group) / len(group) for group in
+                  (values[int(i * step):int((i + 1) * step)] for i in range(width)) if group]
+    low, high = min(values), max(values)
+    if high == low:
+        return SPARK_CHARS[0] * len(values)
+    scale = (len(SPARK_CHARS) - 1) / (high - low)
+    return "".join(SPARK_CHARS[round((value - low) * scale)] for value in values)
+
+
+class Telemetry:
+    """Замеры текущего процесса vk-tunnel в кольцевом буфере"""
+
+    def __init__(self, capacity: int = 240):
+        self.samples: Deque[Sample] = deque(maxlen=capacity)
+        self.pid: Optional[int] = None
+        self.process = None
+        self.cpu_total: Optional[float] = None
+        self.sampled_at = 0.0
+
+    def resize(self, capacity: int):
+        """Размер буфера; история сохраняется (при уменьшении - самые свежие замеры)"""
+        if capacity != self.samples.maxlen:
+            self.samples = deque(self.samples, maxlen=capacity)
+
+    def attach(self, pid: int):
+        """Новый процесс: история прошлого к нему не относится"""
+        import psutil
+
+        self.samples.clear()
+        self.pid = pid
+        self.process = psutil.Process(pid)
+        self.cpu_total = None
+
+    def _collect(self) -> Optional[Sample]:
+        """Один замер процесса и его потомков (блокирующий - вызывать в потоке).
+
+        None - процесс завершился или это первый замер: CPU считается по разнице с предыдущим.
+        """
+        import psutil
+
+        now = time.monotonic()
+        cpu_total, rss, fds, threads, sockets = 0.0, 0, 0, 0, 0
+        try:
+            processes = [self.process] + self.process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return None
+        for process in processes:
+            try:
+                with process.oneshot():
+                    times = process.cpu_times()
+                    cpu_total += times.user + times.system
+                    rss += process.memory_info().rss
+                    fds += process.num_fds()
+                    threads += process.num_threads()
+                    connections = getattr(process, "net_connections", None) or process.connections   # psutil < 6
+                    sockets += len(connections(kind="all"))
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue   # Потомок завершился между замерами
+        previous, elapsed = self.cpu_total, now - self.sampled_at
+        self.cpu_total, self.sampled_at = cpu_total, now
+        if previous is None or elapsed <= 0:
+            return None
+        cpu = max(0.0, cpu_total - previous) / elapsed * 100
+        return Sample(now, cpu, rss, fds, threads, sockets)
+
+    async def sample(self) -> Optional[Sample]:
+        sample = await asyncio.to_thread(self._collect)
+        if sample is not None:
+            self.samples.append(sample)
+        return sample
+
+    def window(self, seconds: float) -> List[Sample]:
+        """Замеры за последние seconds секунд; пусто, если история короче окна"""
+        if not self.samples or self.samples[-1].time - self.samples[0].time < seconds * WINDOW_COVERAGE:
+            return []
+        since = self.samples[-1].time - seconds
+        return [sample for sample in self.samples if sample.time >= since]
+
+    def format_report(self) -> str:
+        """История для /status"""
+        if not self.samples:
+            return ""
+        samples = list(self.samples)
+        last = samples[-1]
+        span = last.time - samples[0].time
+        rss_rate = trend([(s.time, s.rss) for s in samples])[0] * 3600 / 2 ** 20 if len(samples) > 2 else 0.0
+
+        def row(title: str, values: List[float], current: str) -> str:
+            return f"{title} `{sparkline(values)}` {current}\n"
+
+        return (f"📈 *vk-tunnel за {span / 60:.0f} мин* ({len(samples)} замеров):\n"
+                + row("CPU", [s.cpu for s in samples], f"`{last.cpu:.0f}%` (макс. `{max(s.cpu for s in samples):.0f}%`)")
+                + row("RSS", [s.rss for s in samples], f"`{last.rss / 2 ** 20:.0f} МБ` (`{rss_rate:+.1f} МБ/ч`)")
+                + row("FD", [s.fds for s in samples], f"`{last.fds}`")
+                + row("Потоки", [s.threads for s in samples], f"`{last.threads}`")
+                + row("Сокеты", [s.sockets for s in samples], f"`{last.sockets}`"))
+
+
+class RestartPolicy:
+    """Решение о перезапуске по истории Telemetry; пороги 0 отключают проверку"""
+
+    def __init__(self, leak_window: float = 3600, rss_mb_per_hour: float = 50, fds_per_hour: float = 200,
+                 spin_cpu_percent: float = 95, spin_seconds: float = 600):
+        self.configure(leak_window, rss_mb_per_hour, fds_per_hour, spin_cpu_percent, spin_seconds)
+
+    def configure(self, leak_window: float, rss_mb_per_hour: float, fds_per_hour: float,
+                  spin_cpu_percent: float, spin_seconds: float):
+        self.leak_window = leak_window
+        self.rss_mb_per_hour = rss_mb_per_hour
+        self.fds_per_hour = fds_per_hour
+        self.spin_cpu_percent = spin_cpu_percent
+        self.spin_seconds = spin_seconds
+
+    def check(self, telemetry: Telemetry) -> Optional[str]:
+        """Причина перезапуска или None"""
+        if self.spin_cpu_percent > 0 and self.spin_seconds > 0:
+            spin = telemetry.window(self.spin_seconds)
+            if len(spin) > 1 and all(s.cpu >= self.spin_cpu_percent for s in spin):
+                return f"CPU не ниже {self.spin_cpu_percent:.0f}% уже {(spin[-1].time - spin[0].time) / 60:.0f} мин"
+
+        leak = telemetry.window(self.leak_window) if self.leak_window > 0 else []
+        if len(leak) < 3:
+            return None
+        minutes = (leak[-1].time - leak[0].time) / 60
+        checks = ((self.rss_mb_per_hour, "RSS", "МБ", [(s.time, s.rss / 2 ** 20) for s in leak]),
+                  (self.fds_per_hour, "число FD", "", [(s.time, s.fds) for s in leak]))
+        for limit, name, unit, points in checks:
+            if limit <= 0:
+                continue
+            slope, r2 = trend(points)
+            per_hour = slope * 3600
+            if per_hour > limit and r2 >= LEAK_MIN_R2:
+                return (f"{name} растет на {per_hour:.0f}{' ' + unit if unit else ''}/ч "
+                        f"{minutes:.0f} мин подряд (R² {r2:.2f}) - похоже на утечку")
+        return None